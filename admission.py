@@ -0,0 +1,133 @@
+import time
+import asyncio
+import threading
+
+
+class Ticket():
+
+    def __init__(self, channel, deadline):
+        self.channel = channel
+        self.deadline = deadline
+        self.started = False
+        self.shed = False
+        self.timer = None # Sheds the request at its deadline if it is still queued
+
+
+class AdmissionController():
+    """
+    Bounds the requests admitted globally and per channel, and sheds the ones that waited past their deadline.
+    Cheap modes bypass it through a fast lane.
+    """
+
+    def __init__(self, max_in_flight : int = 64, max_in_flight_per_channel : int = 16, max_queue_wait : float = 30.0, fast_modes : tuple = ("ping", "help")):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_channel = max_in_flight_per_channel
+        self.max_queue_wait = max_queue_wait
+        self.fast_modes = set(fast_modes)
+
+        self.in_flight = 0
+        self.in_flight_per_channel = {}
+        self.lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def is_fast(self, mode):
+        return mode in self.fast_modes
+
+    def try_admit(self, channel):
+        """
+        Return a ticket for the request, or None if it must be turned down right away
+        """
+        with self.lock:
+            channel_in_flight = self.in_flight_per_channel.get(channel, 0)
+            if self.in_flight >= self.max_in_flight or channel_in_flight >= self.max_in_flight_per_channel:
+                self.rejected += 1
+                return None
+            self.in_flight += 1
+            self.in_flight_per_channel[channel] = channel_in_flight + 1
+            self.admitted += 1
+        return Ticket(channel, time.monotonic() + self.max_queue_wait)
+
+    def watch(self, ticket, on_expired, async_mode : bool = False):
+        """
+        Shed the request with on_expired as soon as its deadline passes, if it has not started by then.
+        In async mode, call it on the event loop.
+        """
+        delay = max(0.0, ticket.deadline - time.monotonic())
+        if async_mode:
+            ticket.timer = asyncio.get_running_loop().call_later(delay, self._expire, ticket, on_expired)
+        else:
+            ticket.timer = threading.Timer(delay, self._expire, args=(ticket, on_expired))
+            ticket.timer.daemon = True
+            ticket.timer.start()
+
+    def _expire(self, ticket, on_expired):
+        with self.lock:
+            if ticket.started or ticket.shed:
+                return
+            ticket.shed = True
+        self.release(ticket) # The job stays in its queue and does nothing once it gets there
+        self._shed(on_expired)
+
+    def _start(self, ticket):
+        # False if the request was already shed at its deadline
+        with self.lock:
+            if ticket.shed:
+                return False
+            ticket.started = True
+        if ticket.timer is not None:
+            ticket.timer.cancel()
+        return True
+
+    def release(self, ticket):
+        if ticket.timer is not None:
+            ticket.timer.cancel()
+        with self.lock:
+            self.in_flight -= 1
+            self.in_flight_per_channel[ticket.channel] -= 1
+            if self.in_flight_per_channel[ticket.channel] == 0:
+                del self.in_flight_per_channel[ticket.channel]
+
+    def expired(self, ticket):
+        return time.monotonic() > ticket.deadline
+
+    def _shed(self, on_expired):
+        with self.lock:
+            self.shed += 1
+        print("Dropping a request that waited more than", self.max_queue_wait, "seconds.")
+        if on_expired is not None:
+            on_expired()
+
+    def run(self, ticket, on_expired, function, *args):
+        """
+        Run an admitted request unless its deadline passed while it was queued
+        """
+        if not self._start(ticket):
+            return None
+        try:
+            if self.expired(ticket):
+                self._shed(on_expired)
+                return None
+            return function(*args)
+        finally:
+            self.release(ticket)
+
+    async def run_async(self, ticket, on_expired, function, *args):
+        if not self._start(ticket):
+            return None
+        try:
+            if self.expired(ticket):
+                self._shed(on_expired)
+                return None
+            result = function(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": self.in_flight, "admitted": self.admitted, "rejected": self.rejected, "shed": self.shed}
@@ -1,62 +1,276 @@
+import time
+boot_start = time.perf_counter() # Before the imports, which are part of the startup time
 
+import os
+import sys
 import argparse
-import re
+import importlib
+import asyncio
 import atexit
+import threading
+import traceback
 
-from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_bolt import App
 
-from bot import SlackBot
-from client_interface import ClientInterface, OpenaiInterface
+from events import EventDispatcher, BootDispatcher
+from metrics import Metrics, MetricsServer
+
+# The bot, the OpenAI client and the asyncio adapters are imported where they are first used,
+# so --fast_boot can connect to Slack before loading them
+
+
+class BootTimer():
+    """
+    Duration of each startup step, reported once the step that matters is done
+    """
+
+    def __init__(self, start : float = None):
+        self.start = start if start is not None else time.perf_counter()
+        self.last = self.start
+        self.steps = []
+
+    def step(self, name):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def elapsed(self):
+        return self.last - self.start
+
+    def report(self, what):
+        steps = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.steps)
+        print(f"{what} in {self.elapsed:.3f}s ({steps})")
 
 
 # Parse tokens and API keys
-parser = argparse.ArgumentParser(description = 'Start slack bot. Slack app token, slack bot token, and openai API key are required.')
-parser.add_argument('--slack_app_token', type=str, required=True, help='Slack app token')
-parser.add_argument('--slack_bot_token', type=str, required=True, help='Slack bot token')
-parser.add_argument('--openai_api_key', type=str, required=True, help='OpenAI API key')
-args = parser.parse_args()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description = 'Start slack bot. Slack app token, slack bot token, and openai API key are required.')
+    parser.add_argument('--slack_app_token', type=str, required=True, help='Slack app token')
+    parser.add_argument('--slack_bot_token', type=str, required=True, help='Slack bot token')
+    parser.add_argument('--openai_api_key', type=str, required=True, help='OpenAI API key')
+    parser.add_argument('--async_mode', action='store_true', help='Handle events on an asyncio event loop instead of listener threads')
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads handling messages (default 8), or of concurrent coroutines in async mode (default 64)')
+    parser.add_argument('--max_pending_per_thread', type=int, default=5, help='Messages queued per Slack thread before new ones are turned down')
+    parser.add_argument('--max_in_flight', type=int, default=64, help='Requests admitted at once, queued or running, before new ones get a busy reply')
+    parser.add_argument('--max_in_flight_per_channel', type=int, default=16, help='Requests admitted at once for a single channel')
+    parser.add_argument('--max_queue_wait', type=float, default=30.0, help='Seconds a request may wait in the queue before it is dropped with a busy reply')
+    parser.add_argument('--cache_path', type=str, default=None, help='SQLite file keeping cached replies across restarts (memory only if not set)')
+    parser.add_argument('--history_backend', type=str, default='json', choices=['json', 'sqlite'], help='Keep the whole history in memory with a JSON log, or in SQLite shards with only recently used threads in memory')
+    parser.add_argument('--history_path', type=str, default=None, help='History file for the json backend (default history.json), or directory of the shards for the sqlite backend (default history)')
+    parser.add_argument('--history_cache_mb', type=int, default=64, help='Memory budget of the threads cached by the sqlite history backend, in MB')
+    parser.add_argument('--processes', type=int, default=1, help='Number of worker processes, events are routed to them by channel and each one keeps the history of its channels')
+    parser.add_argument('--drain_timeout', type=float, default=60.0, help='Seconds a worker process may take to finish its requests when it is stopped or restarted')
+    parser.add_argument('--request_timeout', type=float, default=60.0, help='Seconds an OpenAI call may take before it is abandoned and retried')
+    parser.add_argument('--max_retries', type=int, default=2, help='Retries of an OpenAI call failing with a timeout or an API error')
+    parser.add_argument('--hedge', action='store_true', help='Send a duplicate OpenAI request when the first one is slower than 95%% of the recent ones')
+    parser.add_argument('--fallback_engine', type=str, default=None, help='Engine used while the configured one keeps failing (fail fast if not set)')
+    parser.add_argument('--engine_router', action='store_true', help='Pick the engine of each request from its size, the observed latencies and the channel budget, for channels whose engine is auto (the default with this option)')
+    parser.add_argument('--router_log', type=str, default=None, help='JSONL file receiving each routing decision with its latency and cost (printed if not set)')
+    parser.add_argument('--semantic_index', action='store_true', help='Index the messages of each channel by embedding, for the search mode and the related messages added to the context')
+    parser.add_argument('--index_path', type=str, default='index.db', help='SQLite file keeping the embeddings and the indexed messages')
+    parser.add_argument('--plugins', type=str, nargs='*', default=[], help='Modules imported before the bot is created, they add modes with commands.register_mode')
+    parser.add_argument('--fast_boot', action='store_true', help='Connect to Slack before loading the bot and its history in the background, events received meanwhile are handled once it is ready')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve Prometheus metrics on this port at /metrics, worker N of --processes uses port + N (disabled if not set)')
+    parser.add_argument('--metrics_host', type=str, default='127.0.0.1', help='Address the metrics endpoint listens on')
+    return parser.parse_args(argv)
+
+
+def worker_path(path, worker):
+    # Each worker process keeps its own history and cache files
+    if path is None or worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{worker}{ext}"
+
+
+def create_bot(args, worker=None):
+    from bot import SlackBot, AsyncSlackBot
+    from transport import HttpTransport, AsyncHttpTransport
+    from client_interface import ClientInterface, OpenaiInterface, AsyncClientInterface, AsyncOpenaiInterface
+    for plugin in args.plugins:
+        importlib.import_module(plugin)
+
+    # Event API & Web API
+    # Slack and OpenAI share one set of keep-alive connection pools
+    default_history_path = "history" if args.history_backend == "sqlite" else "history.json"
+    history_path = worker_path(args.history_path or default_history_path, worker)
+    cache_path = worker_path(args.cache_path, worker)
+    metrics = Metrics() # Shared by the clients and the bot, so one endpoint shows the whole request path
+    resilience = {"request_timeout": args.request_timeout, "max_retries": args.max_retries, "hedge": args.hedge, "fallback_engine": args.fallback_engine, "router": args.engine_router, "router_log": args.router_log}
+
+    if args.async_mode:
+        transport = AsyncHttpTransport()
+        client = AsyncClientInterface(args.slack_bot_token, transport=transport, metrics=metrics)
+        openai_client = AsyncOpenaiInterface(args.openai_api_key, cache_path=cache_path, transport=transport, metrics=metrics, **resilience)
+    else:
+        transport = HttpTransport()
+        client = ClientInterface(args.slack_bot_token, transport=transport, metrics=metrics)
+        openai_client = OpenaiInterface(args.openai_api_key, cache_path=cache_path, transport=transport, metrics=metrics, **resilience)
+
+    # Bot class
+    bot_class = AsyncSlackBot if args.async_mode else SlackBot
+    index = None
+    if args.semantic_index:
+        from semantic_index import SemanticIndex # numpy is only needed with the index
+        index = SemanticIndex(openai_client, path=worker_path(args.index_path, worker))
+
+    history_import_path, history_import_channels = None, None
+    if worker is not None:
+        # A worker starting with an empty history takes its channels from the history of a single process
+        from supervisor import channel_worker
+        history_import_path = args.history_path if args.history_backend == "json" and args.history_path is not None else "history.json"
+        history_import_channels = lambda channel: channel_worker(channel, args.processes) == worker
+
+    bot = bot_class(client, openai_client, history_backend=args.history_backend, history_path=history_path, history_max_bytes=args.history_cache_mb * 1024 * 1024, metrics=metrics, index=index,
+                    history_import_path=history_import_path, history_import_channels=history_import_channels)
+    atexit.register(bot.save_history)
+    return bot
+
+
+def start_metrics_server(args, bot, worker=None):
+    if args.metrics_port is None:
+        return None
+    server = MetricsServer(bot.metrics, host=args.metrics_host, port=args.metrics_port + (worker or 0))
+    server.start()
+    return server
+
+
+def create_dispatcher(args, bot):
+    return EventDispatcher(bot, async_mode=args.async_mode, workers=args.workers, max_pending_per_thread=args.max_pending_per_thread,
+                           max_in_flight=args.max_in_flight, max_in_flight_per_channel=args.max_in_flight_per_channel, max_queue_wait=args.max_queue_wait)
+
+
+def create_app(args, dispatcher, client=None):
+    # A Web API client can be given in place of the token, e.g. a fake one for benchmarks
+    if args.async_mode:
+        from slack_bolt.async_app import AsyncApp
+        app = AsyncApp(client=client) if client is not None else AsyncApp(token=args.slack_bot_token)
+
+        # This gets activated when the bot is tagged in a channel
+        @app.event("app_mention")
+        async def handle_message_events(body, logger):
+            dispatcher.handle("app_mention", body)
+
+        @app.action("top_k_callback")
+        async def handle_top_k_callback(ack, body, logger):
+            await ack()
+            dispatcher.handle("top_k_callback", body)
+
+    else:
+        app = App(client=client) if client is not None else App(token=args.slack_bot_token, token_verification_enabled=not args.fast_boot) # auth.test then waits for the first event
+
+        # This gets activated when the bot is tagged in a channel
+        @app.event("app_mention")
+        def handle_message_events(body, logger):
+            dispatcher.handle("app_mention", body)
+
+        @app.action("top_k_callback")
+        def handle_top_k_callback(ack, body, logger):
+            ack()
+            dispatcher.handle("top_k_callback", body)
+
+    return app
+
+
+def start_bot(args, timer, worker=None):
+    bot = create_bot(args, worker)
+    timer.step("bot")
+    start_metrics_server(args, bot, worker)
+    dispatcher = create_dispatcher(args, bot)
+    timer.step("dispatcher")
+    bot.metrics.gauge("startup_seconds", lambda: timer.elapsed, "Seconds from the start of the process until the bot handled events")
+    return bot, dispatcher
+
+
+def boot(args):
+    # Connect first, the bot is loaded in a background thread and the events wait for it in the boot dispatcher
+    from slack_bolt.adapter.socket_mode import SocketModeHandler
+    timer = BootTimer(boot_start)
+    timer.step("imports")
+    pending = BootDispatcher()
+    handler = SocketModeHandler(create_app(args, pending), args.slack_app_token)
+    timer.step("app")
+    handler.connect()
+    timer.step("connect")
+    timer.report("Connected to Slack")
+
+    def load():
+        try:
+            bot_timer = BootTimer(boot_start)
+            bot_timer.step("connect")
+            _, dispatcher = start_bot(args, bot_timer)
+            pending.attach(dispatcher)
+            bot_timer.report("Bot ready")
+        except Exception:
+            traceback.print_exc()
+            print("Bot failed to start, exiting.")
+            os._exit(1) # Connected but unable to reply, better let the process manager restart it
+
+    threading.Thread(target=load, daemon=True, name="boot").start()
+    threading.Event().wait()
 
-SLACK_BOT_TOKEN = args.slack_bot_token
-SLACK_APP_TOKEN = args.slack_app_token
-OPENAI_API_KEY  = args.openai_api_key
 
+async def boot_async(args):
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+    timer = BootTimer(boot_start)
+    timer.step("imports")
+    pending = BootDispatcher()
+    handler = AsyncSocketModeHandler(create_app(args, pending), args.slack_app_token)
+    timer.step("app")
+    await handler.connect_async()
+    timer.step("connect")
+    timer.report("Connected to Slack")
 
-# Event API & Web API
-app = App(token=SLACK_BOT_TOKEN) 
-client = ClientInterface(SLACK_BOT_TOKEN)
-openai_client = OpenaiInterface(OPENAI_API_KEY)
+    bot_timer = BootTimer(boot_start)
+    bot_timer.step("connect")
+    try:
+        _, dispatcher = await asyncio.get_running_loop().run_in_executor(None, start_bot, args, bot_timer) # The blocking startup runs off the event loop
+    except Exception:
+        traceback.print_exc()
+        print("Bot failed to start, exiting.")
+        sys.exit(1)
+    pending.attach(dispatcher)
+    bot_timer.report("Bot ready")
+    await asyncio.sleep(float("inf"))
 
-# Bot class
-bot = SlackBot(client, openai_client)
-atexit.register(bot.save_history)
 
-# create regex to catch optional mention and slash command, in any order
-regex = re.compile(r"^\s*(?:<@(.*?)>\s*\/(\w+)|\/(\w+)\s*<@(.*?)>|<@(.*?)>|\/(\w+))")
+def main(argv=None):
+    args = parse_args(argv)
 
-# This gets activated when the bot is tagged in a channel    
-@app.event("app_mention")
-def handle_message_events(body, logger):
-    channel = body["event"]["channel"]
-    thread = body["event"]["ts"] if "thread_ts" not in body["event"] else body["event"]["thread_ts"]
-    user = body["event"]["user"]
+    if args.processes > 1:
+        from supervisor import Supervisor
+        Supervisor(args).start()
+        return
 
-    text = body["event"]["text"]
-    pattern = re.findall(regex, text)[0]
-    mode = pattern[1] if len(pattern[1]) > 0 else pattern[2] if len(pattern[2]) > 0 else pattern[5] if len(pattern[5]) > 0 else None
-    message = re.sub(regex, "", text)
-    
-    bot.receive_message(channel, thread, message, user, mode)
+    if args.fast_boot:
+        if args.async_mode:
+            asyncio.run(boot_async(args))
+        else:
+            boot(args)
+        return
 
-@app.action("top_k_callback")
-def handle_top_k_callback(ack, body, logger):
-    ack()
-    channel = body["channel"]["id"]
-    thread = body["original_message"]["thread_ts"]
-    message = body["actions"][0]["value"]
+    timer = BootTimer(boot_start)
+    timer.step("imports")
+    _, dispatcher = start_bot(args, timer)
+    app = create_app(args, dispatcher)
+    timer.step("app")
+    if args.async_mode:
+        asyncio.run(serve_async(args, app, timer))
+    else:
+        from slack_bolt.adapter.socket_mode import SocketModeHandler
+        SocketModeHandler(app, args.slack_app_token).connect()
+        timer.step("connect")
+        timer.report("Started")
+        threading.Event().wait()
 
-    bot.top_k_callback(channel, thread, message)
 
+async def serve_async(args, app, timer):
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+    await AsyncSocketModeHandler(app, args.slack_app_token).connect_async()
+    timer.step("connect")
+    timer.report("Started")
+    await asyncio.sleep(float("inf"))
 
 if __name__ == "__main__":
-    SocketModeHandler(app, SLACK_APP_TOKEN).start()
\ No newline at end of file
+    main()
@@ -0,0 +1,389 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import contextvars
+from collections import deque
+
+from slack_bolt.request import BoltRequest
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_bolt.middleware.authorization.async_single_team_authorization import AsyncSingleTeamAuthorization
+
+import app as slack_app
+from bot import SlackBot, AsyncSlackBot
+from events import parse_message_event
+from metrics import Metrics
+from fake_interfaces import LatencyModel, FakeClientInterface, FakeOpenaiInterface, FakeAsyncClientInterface, FakeAsyncOpenaiInterface
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay Slack events through the app handlers against fake Slack and OpenAI APIs, and report throughput, latency and memory. Other options are passed to app.py (e.g. --async_mode, --workers, --max_in_flight).')
+    parser.add_argument('--events', type=str, default=None, help='JSONL file of events to replay, Slack event bodies or lines with a text (or body) field, an optional channel, thread and at (seconds from the start)')
+    parser.add_argument('--count', type=int, default=200, help='Number of synthetic events when no events file is given')
+    parser.add_argument('--channels', type=int, default=10, help='Number of channels of the synthetic events')
+    parser.add_argument('--thread_reuse', type=float, default=0.5, help='Probability that a synthetic event continues an existing thread')
+    parser.add_argument('--modes', type=str, default='prompt=8,ping=1,history=1', help='Weights of the modes of the synthetic events')
+    parser.add_argument('--rate', type=float, default=20.0, help='Events per second, Poisson arrivals (0 sends them all at once, ignored for events with an at field)')
+    parser.add_argument('--openai_latency', type=float, default=1.0, help='Mean OpenAI latency in seconds')
+    parser.add_argument('--openai_stddev', type=float, default=0.5, help='Standard deviation of the OpenAI latency')
+    parser.add_argument('--openai_error_rate', type=float, default=0.0, help='Fraction of OpenAI requests failing')
+    parser.add_argument('--slack_latency', type=float, default=0.05, help='Mean Slack Web API latency in seconds')
+    parser.add_argument('--slack_stddev', type=float, default=0.02, help='Standard deviation of the Slack latency')
+    parser.add_argument('--slack_rate_limit', type=float, default=0, help='Slack calls per minute and method before answering 429 (0 for no limit)')
+    parser.add_argument('--distribution', type=str, default='lognormal', choices=['fixed', 'normal', 'lognormal', 'exponential'], help='Latency distribution of the fake APIs')
+    parser.add_argument('--sample_interval', type=float, default=1.0, help='Seconds between two memory samples')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Seconds to wait for the replies after the last event')
+    parser.add_argument('--output', type=str, default=None, help='JSON file receiving the full report')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic events and latencies')
+    parser.add_argument('--verbose', action='store_true', help='Keep the bot output')
+    args, app_argv = parser.parse_known_args(argv)
+    app_args = slack_app.parse_args(["--slack_app_token", "xapp-fake", "--slack_bot_token", "xoxb-fake", "--openai_api_key", "sk-fake"] + app_argv)
+    return args, app_args
+
+
+def _mention_body(channel, thread, text, user="U0"):
+    return {"type": "event_callback", "team_id": "T0", "api_app_id": "A0",
+            "event": {"type": "app_mention", "channel": channel, "ts": thread, "thread_ts": thread, "user": user, "text": text}}
+
+def load_events(path, bot_id, channels):
+    """
+    Events of a JSONL file as (at, body), at is None for events without a timestamp
+    """
+    events = []
+    with open(path, "r") as f:
+        for i, line in enumerate(f):
+            if len(line.strip()) == 0:
+                continue
+            record = json.loads(line)
+            at = record.get("at")
+            if "type" in record: # Full Slack request body
+                body = record
+            elif "event" in record:
+                body = {"type": "event_callback", "team_id": "T0", "api_app_id": "A0", "event": record["event"]}
+            else:
+                text = record.get("text") or record.get("body") or record.get("title") or ""
+                body = _mention_body(record.get("channel", f"C{i % channels}"), record.get("thread", f"{i}.0"), f"<@{bot_id}> {text}", record.get("user", "U0"))
+            events.append((at, body))
+    return events
+
+def synthetic_events(count, channels, thread_reuse, modes, bot_id):
+    weights = {name: float(weight) for name, weight in (mode.split("=") for mode in modes.split(","))}
+    threads = []
+    events = []
+    for i in range(count):
+        if len(threads) > 0 and random.random() < thread_reuse:
+            channel, thread = random.choice(threads)
+        else:
+            channel, thread = f"C{random.randrange(channels)}", f"{i}.0"
+            threads.append((channel, thread))
+        mode = random.choices(list(weights.keys()), list(weights.values()))[0]
+        words = " ".join(random.choice(["what", "is", "the", "best", "way", "to", "cache", "a", "slack", "reply"]) for _ in range(random.randint(5, 30)))
+        text = f"<@{bot_id}> {words}" if mode == "prompt" else f"<@{bot_id}> /{mode} {words}"
+        events.append((None, _mention_body(channel, thread, text)))
+    return events
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Peak only, in KB on Linux
+
+
+def _percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _summary(latencies):
+    return {name: round(value, 3) if value is not None else None for name, value in
+            {"p50": _percentile(latencies, 0.50), "p95": _percentile(latencies, 0.95), "p99": _percentile(latencies, 0.99), "max": max(latencies) if latencies else None}.items()}
+
+
+class Recorder():
+    """
+    Times each event from its dispatch to the end of the bot's handling, and to the end of the Slack calls it queued.
+    Samples memory over time.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.starts = {} # parsed event -> dispatch times, the bot receives the same arguments
+        self.sends = contextvars.ContextVar("sends", default=None) # Futures of the Slack calls queued by the event being handled
+        self.handler_latencies = []
+        self.latencies = [] # Up to the last Slack call of the event
+        self.completed = 0
+        self.delivered = 0
+        self.failed = 0
+        self.busy = 0
+        self.dispatched = 0
+        self.samples = []
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.last_completion = self.start_time
+
+    def dispatch(self, body):
+        if body.get("type") == "event_callback":
+            with self.lock:
+                self.starts.setdefault(parse_message_event(body), deque()).append(time.monotonic())
+        with self.lock:
+            self.dispatched += 1
+
+    def _finish(self, key, failed, sends):
+        now = time.monotonic()
+        with self.lock:
+            starts = self.starts.get(key)
+            start = starts.popleft() if starts else None
+            if start is not None:
+                self.handler_latencies.append(now - start)
+            self.completed += 1
+            self.failed += failed
+        self._deliver(start, sends)
+
+    def _deliver(self, start, sends):
+        # The event is answered once the last Slack call it queued is done, replies may wait for the rate limits after the handler returns
+        remaining = [len(sends)]
+
+        def sent(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+                now = time.monotonic()
+                if start is not None:
+                    self.latencies.append(now - start)
+                self.delivered += 1
+                self.last_completion = now
+
+        if len(sends) == 0:
+            remaining[0] = 1
+            sent(None)
+        for future in sends:
+            future.add_done_callback(sent)
+
+    def _track(self, function):
+        # Future of the call is kept in the context of the event, the async bot's tasks inherit it
+        def tracked(*args, **kwargs):
+            future = function(*args, **kwargs)
+            sends = self.sends.get()
+            if sends is not None:
+                sends.append(future)
+            return future
+        return tracked
+
+    def instrument(self):
+        receive_message = self.bot.receive_message
+        busy = self.bot.busy
+
+        if asyncio.iscoroutinefunction(receive_message):
+            async def timed_receive_message(channel, thread, message, user, mode=None):
+                failed = True
+                sends = []
+                token = self.sends.set(sends)
+                try:
+                    result = await receive_message(channel, thread, message, user, mode)
+                    failed = False
+                    return result
+                finally:
+                    self.sends.reset(token)
+                    self._finish((channel, thread, message, user, mode), failed, list(sends))
+        else:
+            def timed_receive_message(channel, thread, message, user, mode=None):
+                failed = True
+                sends = []
+                token = self.sends.set(sends)
+                try:
+                    result = receive_message(channel, thread, message, user, mode)
+                    failed = False
+                    return result
+                finally:
+                    self.sends.reset(token)
+                    self._finish((channel, thread, message, user, mode), failed, list(sends))
+
+        def counted_busy(channel, thread, *args):
+            with self.lock:
+                self.busy += 1
+            return busy(channel, thread, *args)
+
+        self.bot.receive_message = timed_receive_message
+        self.bot.busy = counted_busy
+        self.bot.client.dispatcher.submit = self._track(self.bot.client.dispatcher.submit)
+
+    def done(self):
+        with self.lock:
+            return self.completed + self.busy >= self.dispatched and self.delivered >= self.completed
+
+    def sample(self):
+        with self.lock:
+            self.samples.append({"t": round(time.monotonic() - self.start_time, 2), "rss_mb": round(_rss_mb(), 1), "completed": self.completed, "busy": self.busy, "in_flight": self.dispatched - self.completed - self.busy})
+
+    def report(self, bot, extra):
+        elapsed = self.last_completion - self.start_time
+        return {
+            "events": self.dispatched,
+            "completed": self.completed,
+            "failed": self.failed,
+            "busy": self.busy,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_s": round(self.completed / elapsed, 2) if elapsed > 0 else None,
+            "latency_s": _summary(self.latencies),
+            "handler_latency_s": _summary(self.handler_latencies),
+            "rss_mb": {"start": self.samples[0]["rss_mb"] if self.samples else None, "peak": max(sample["rss_mb"] for sample in self.samples) if self.samples else None, "end": self.samples[-1]["rss_mb"] if self.samples else None},
+            "history": bot.history.stats(),
+            "reply_cache": bot.openai_client.cache.stats(),
+            "stage_ms": {stage: round(mean, 3) for stage, mean in bot.metrics.stage_means().items()},
+            **extra,
+            "samples": self.samples,
+        }
+
+
+def _arrivals(events, rate):
+    """
+    Seconds from the start at which each event is sent
+    """
+    t = 0.0
+    for at, body in events:
+        if at is not None:
+            yield at, body
+        else:
+            if rate > 0:
+                t += random.expovariate(rate)
+            yield t, body
+
+
+def _sampler(recorder, interval, stop):
+    while not stop.wait(interval):
+        recorder.sample()
+
+def _build(args, app_args, history_dir):
+    latency = lambda mean, stddev: LatencyModel(mean, stddev, args.distribution)
+    metrics = Metrics()
+    resilience = {"request_timeout": app_args.request_timeout, "max_retries": app_args.max_retries, "hedge": app_args.hedge, "fallback_engine": app_args.fallback_engine, "router": app_args.engine_router, "router_log": app_args.router_log}
+    if app_args.async_mode:
+        client = FakeAsyncClientInterface(latency(args.slack_latency, args.slack_stddev), args.slack_rate_limit, metrics=metrics)
+        openai_client = FakeAsyncOpenaiInterface(latency(args.openai_latency, args.openai_stddev), args.openai_error_rate, metrics=metrics, **resilience)
+        bot_class = AsyncSlackBot
+    else:
+        client = FakeClientInterface(latency(args.slack_latency, args.slack_stddev), args.slack_rate_limit, metrics=metrics)
+        openai_client = FakeOpenaiInterface(latency(args.openai_latency, args.openai_stddev), args.openai_error_rate, metrics=metrics, **resilience)
+        bot_class = SlackBot
+
+    history_path = os.path.join(history_dir, "history" if app_args.history_backend == "sqlite" else "history.json")
+    index = None
+    if app_args.semantic_index:
+        from semantic_index import SemanticIndex
+        index = SemanticIndex(openai_client, path=os.path.join(history_dir, "index.db"))
+    bot = bot_class(client, openai_client, history_backend=app_args.history_backend, history_path=history_path, history_max_bytes=app_args.history_cache_mb * 1024 * 1024, metrics=metrics, index=index)
+    recorder = Recorder(bot)
+    recorder.instrument()
+    dispatcher = slack_app.create_dispatcher(app_args, bot)
+    app = slack_app.create_app(app_args, dispatcher, client=client.client)
+    return bot, dispatcher, app, recorder
+
+def _extra(bot, dispatcher, flushed):
+    slack = bot.client.slack
+    extra = {"slack_flushed_s": round(flushed, 2), "slack_writes": len(slack.messages), "slack_rate_limited": slack.rate_limited, "openai_requests": bot.openai_client.fake.requests, "openai_errors": bot.openai_client.fake.errors, "admission": dispatcher.admission.stats()}
+    if hasattr(bot.client, "dispatcher"):
+        extra["slack_dispatcher"] = bot.client.dispatcher.stats()
+    return extra
+
+def run(args, app_args, events, history_dir):
+    bot, dispatcher, app, recorder = _build(args, app_args, history_dir)
+    stop = threading.Event()
+    threading.Thread(target=_sampler, args=(recorder, args.sample_interval, stop), daemon=True).start()
+
+    recorder.sample()
+    start = time.monotonic()
+    for at, body in _arrivals(events, args.rate):
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        recorder.dispatch(body)
+        app.dispatch(BoltRequest(body=body, mode="socket_mode"))
+
+    deadline = time.monotonic() + args.timeout
+    while not recorder.done() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    while bot.client.dispatcher.stats()["queued"] > 0 and time.monotonic() < deadline: # Replies still waiting for their rate limit
+        time.sleep(0.05)
+    stop.set()
+    recorder.sample()
+    return recorder.report(bot, _extra(bot, dispatcher, time.monotonic() - recorder.start_time))
+
+async def run_async(args, app_args, events, history_dir):
+    bot, dispatcher, app, recorder = _build(args, app_args, history_dir)
+    # AsyncApp calls auth.test on a client of its own on the first event, answer it from the fake instead
+    for middleware in app._async_middleware_list:
+        if isinstance(middleware, AsyncSingleTeamAuthorization):
+            middleware.auth_test_result = await bot.client.client.auth_test()
+    stop = threading.Event()
+    threading.Thread(target=_sampler, args=(recorder, args.sample_interval, stop), daemon=True).start()
+
+    recorder.sample()
+    start = time.monotonic()
+    for at, body in _arrivals(events, args.rate):
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        recorder.dispatch(body)
+        await app.async_dispatch(AsyncBoltRequest(body=body, mode="socket_mode"))
+
+    deadline = time.monotonic() + args.timeout
+    while not recorder.done() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    while bot.client.dispatcher.stats()["queued"] > 0 and time.monotonic() < deadline: # Replies still waiting for their rate limit
+        await asyncio.sleep(0.05)
+    stop.set()
+    recorder.sample()
+    return recorder.report(bot, _extra(bot, dispatcher, time.monotonic() - recorder.start_time))
+
+
+def print_report(report, out):
+    latency = report["latency_s"]
+    handler_latency = report["handler_latency_s"]
+    rss = report["rss_mb"]
+    print(f"events: {report['events']}, completed: {report['completed']}, failed: {report['failed']}, busy: {report['busy']}", file=out)
+    print(f"throughput: {report['throughput_per_s']} events/s over {report['elapsed_s']}s", file=out)
+    print(f"latency to the reply (s): p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}", file=out)
+    print(f"latency of the handler (s): p50={handler_latency['p50']} p95={handler_latency['p95']} p99={handler_latency['p99']} max={handler_latency['max']}", file=out)
+    print(f"memory (MB): start={rss['start']} peak={rss['peak']} end={rss['end']}", file=out)
+    print("mean stage time (ms): " + ", ".join(f"{stage}={mean}" for stage, mean in report["stage_ms"].items()), file=out)
+    print(f"slack: writes={report['slack_writes']} flushed after {report['slack_flushed_s']}s rate_limited={report['slack_rate_limited']}, openai: requests={report['openai_requests']} errors={report['openai_errors']}", file=out)
+    print("memory over time:", file=out)
+    for sample in report["samples"]:
+        print(f"  t={sample['t']}s rss={sample['rss_mb']}MB completed={sample['completed']} in_flight={sample['in_flight']}", file=out)
+
+
+def main(argv=None):
+    args, app_args = parse_args(argv)
+    random.seed(args.seed)
+    bot_id = "B0" # User id of the fake Slack API
+
+    events = load_events(args.events, bot_id, args.channels) if args.events is not None else synthetic_events(args.count, args.channels, args.thread_reuse, args.modes, bot_id)
+
+    out = sys.stdout
+    with tempfile.TemporaryDirectory() as history_dir, open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(out if args.verbose else devnull): # The bot prints a line per message
+            if app_args.async_mode:
+                report = asyncio.run(run_async(args, app_args, events, history_dir))
+            else:
+                report = run(args, app_args, events, history_dir)
+
+    print_report(report, out)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    os._exit(0) # Worker threads of the bot are not daemons
+
+
+if __name__ == "__main__":
+    main()
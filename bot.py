@@ -1,31 +1,77 @@
 
+import os
 import re
-import json
+import time
+import asyncio
+import functools
 from typing import Optional
 
 from client_interface import ClientInterface, OpenaiInterface
+from history_log import HistoryLog
+from history_entry import HistoryEntry
+from history_store import ShardedHistoryCT
+from context_builder import ContextBuilder
+from summarizer import ThreadSummarizer
+from metrics import Metrics
+from profiler import SamplingProfiler
+from engine_router import Route
+from commands import CommandTable, ArgumentError, boolean, plugin_modes
 
 class HistoryCT():
     """
     History class for channels and threads
     """
 
-    def __init__(self, history_save_path : str = "history.json", default_options : dict = {}):
+    def __init__(self, history_save_path : str = "history.json", default_options : dict = {}, compaction_threshold : int = 1000, assistant_id : str = None, import_path : str = None, import_channels=None):
         self.history = {}
         self.history_save_path = history_save_path
         self.default_options = default_options
-    
-    def init_history(self, channel, thread):
-        if channel not in self.history:
-            self.history[channel] = {
+        self.assistant_id = assistant_id # Entries of this user are the assistant turns
+        self.import_path = import_path # History imported while this one is empty, e.g. the history.json of a single process in a worker
+        self.import_channels = import_channels # import_channels(channel) is True for the channels to import, None for all
+        self.log = HistoryLog(history_save_path, self._apply_record, compaction_threshold=compaction_threshold)
+
+    def _init_history(self, history, channel, thread):
+        created = False
+        # Options are only stored where they are set, get_option falls back to the channel and then the default
+        if channel not in history:
+            history[channel] = {
                 "threads" : {},
-                **self.default_options
             }
-        if thread not in self.history[channel]["threads"]:
-            self.history[channel]["threads"][thread] = {
+            created = True
+        if thread is not None and thread not in history[channel]["threads"]:
+            history[channel]["threads"][thread] = {
                 "history" : [],
-                **{opt_name: self.history[channel][opt_name] for opt_name in self.default_options.keys()},
             }
+            created = True
+        return created
+
+    def _entry(self, user, message):
+        return HistoryEntry(user, message, user is not None and user == self.assistant_id)
+
+    def _decode(self, history):
+        # Snapshots hold plain dicts, the log records replayed on top are already entries
+        for channel_history in history.values():
+            for thread_history in channel_history["threads"].values():
+                thread_history["history"] = [self._entry(entry["user"], entry["message"]) if type(entry) is dict else entry for entry in thread_history["history"]]
+        return history
+
+    def _apply_record(self, history, record):
+        channel, thread = record["channel"], record.get("thread")
+        self._init_history(history, channel, thread)
+        if record["op"] == "add":
+            history[channel]["threads"][thread]["history"].append(self._entry(record["user"], record["message"]))
+        elif record["op"] == "replace_last":
+            history[channel]["threads"][thread]["history"][-1] = self._entry(record["user"], record["message"])
+        elif record["op"] == "summary":
+            history[channel]["threads"][thread]["summary"] = {"message" : record["message"], "upto" : record["upto"]}
+        elif record["op"] == "set":
+            target = history[channel] if thread is None else history[channel]["threads"][thread]
+            target[record["option"]] = record["value"]
+
+    def init_history(self, channel, thread):
+        if self._init_history(self.history, channel, thread):
+            self.log.append("init", channel=channel, thread=thread)
 
     def get_history(self, channel, thread):
         if channel not in self.history:
@@ -36,103 +82,223 @@ class HistoryCT():
     
     def add_to_history(self, channel, thread, message, user=None):
         self.init_history(channel, thread)
-        self.history[channel]["threads"][thread]["history"].append({"user" : user, "message" : message})
+        entry = self._entry(user, message)
+        self.history[channel]["threads"][thread]["history"].append(entry)
+        self.log.append("add", channel=channel, thread=thread, user=user, message=message)
+        return entry
+
+    def replace_last_in_history(self, channel, thread, message, user=None):
+        self.init_history(channel, thread)
+        self.history[channel]["threads"][thread]["history"][-1] = self._entry(user, message)
+        self.log.append("replace_last", channel=channel, thread=thread, user=user, message=message)
+    
+    def get_summary(self, channel, thread):
+        if channel not in self.history or thread not in self.history[channel]["threads"]:
+            return None
+        return self.history[channel]["threads"][thread].get("summary")
+
+    def set_summary(self, channel, thread, message, upto):
+        self.init_history(channel, thread)
+        self.history[channel]["threads"][thread]["summary"] = {"message" : message, "upto" : upto}
+        self.log.append("summary", channel=channel, thread=thread, message=message, upto=upto)
     
     def get_option(self, channel : Optional[str] = None, thread : Optional[str] = None, option_name : str = ""):
         if channel is None or channel not in self.history:
             return self.default_options[option_name]
         if thread is None or thread not in self.history[channel]["threads"]:
-            return self.history[channel][option_name]
-        return self.history[channel]["threads"][thread][option_name]
+            return self.history[channel].get(option_name, self.default_options[option_name])
+        return self.history[channel]["threads"][thread].get(option_name, self.history[channel].get(option_name, self.default_options[option_name]))
+
+    def stats(self):
+        return {"channels": len(self.history), "threads": sum(len(channel["threads"]) for channel in self.history.values())}
+
+    def thread_sizes(self):
+        """
+        (channel, thread, number of messages) of every stored thread
+        """
+        return [(channel, thread, len(thread_history["history"])) for channel, channel_history in list(self.history.items()) for thread, thread_history in list(channel_history["threads"].items())]
+
+    def read_history(self, channel, thread, start, end):
+        # (user, message) of the entries from start to end
+        return [(entry.user, entry.message) for entry in self.get_history(channel, thread)[start:end]]
     
     def set_option(self, channel : Optional[str] = None, thread : Optional[str] = None, option_name : str = "", option_value = None):
         if channel is None:
             self.default_options[option_name] = option_value
+            return
+        self.init_history(channel, thread)
         if thread is None:
             self.history[channel][option_name] = option_value
-        self.history[channel]["threads"][thread][option_name] = option_value
+        else:
+            self.history[channel]["threads"][thread][option_name] = option_value
+        self.log.append("set", channel=channel, thread=thread, option=option_name, value=option_value)
 
     
     def save_history(self, path: str = None):
-        path = path if path is not None else self.history_save_path
         try:
             print("Saving history...")
-            with open(self.history_save_path, "w") as f:
-                json.dump(self.history, f, indent=4)
+            if path is not None and path != self.history_save_path:
+                self.log.dump(self.history, path)
+            self.log.close() # Every mutation is already in the log, only flush it
         except Exception as e:
             print("Failed saving history:", e)
         
     def load_history(self, path: str = None):
-        path = path if path is not None else self.history_save_path
         try: 
             print("Loading history...")
-            with open(path, "r") as f:
-                self.history = json.load(f)
+            if path is not None and path != self.history_save_path:
+                self.log.close()
+                self.history_save_path = path
+                self.log = HistoryLog(path, self._apply_record, compaction_threshold=self.log.compaction_threshold)
+            self.history = self._decode(self.log.load())
+            if self.import_path is not None and len(self.history) == 0 and (os.path.exists(self.import_path) or os.path.exists(self.import_path + ".log")):
+                self._import()
         except Exception as e:
             print("Failed loading history:", e)
+
+    def read_history(self):
+        """
+        Load the history from its files without writing to them, to import the history of another process
+        """
+        self.history = self._decode(self.log.read())
+
+    def _import(self):
+        legacy = HistoryCT(self.import_path, {}, assistant_id=self.assistant_id)
+        legacy.read_history()
+        self.history = {channel: channel_history for channel, channel_history in legacy.history.items() if self.import_channels is None or self.import_channels(channel)}
+        self.log.dump(self.history, self.history_save_path) # Snapshot of the imported channels, later records go to the log
+        print(f"Imported {sum(len(channel['threads']) for channel in self.history.values())} threads from {self.import_path}.")
     
 
 class SlackBot():
 
-    def __init__(self, client: ClientInterface, openai_client: OpenaiInterface):
+    def __init__(self, client: ClientInterface, openai_client: OpenaiInterface, history_backend : str = "json", history_path : str = None, history_max_bytes : int = 64 * 1024 * 1024, metrics : Metrics = None, index=None,
+                 history_import_path : str = None, history_import_channels=None):
         self.client = client
         self.openai_client = openai_client
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.profiler = SamplingProfiler()
+        self.profile_path = "profile_{}.folded" # Folded stacks of each profile, for flame graph tools
+        self.index = index # SemanticIndex of the channel messages, None if disabled
         self.id = self.client.get_id()
-        self.openai_client.assistant_name = self._tag_user(self.id)
-
-        self.modes = {
-            "ping": self.ping,
-            "help": self.help,
-            "admin": self.admin,
-            "prompt": self.prompt_chat_gpt,
-            "topK": self.top_k,
-            "dalle2": self.prompt_dalle2,
-            "history": self.prompt_history
-        }
+
+        self.modes = CommandTable()
+        self.modes.register("ping", self.ping, help="I'm here! :robot_face:", fast=True)
+        self.modes.register("help", self.help, help="This message.", fast=True)
+        self.modes.register("admin", self.admin, help="Admin commands. Type /admin help for more details.")
+        self.modes.register("prompt", self.prompt_chat_gpt, help="Create a prompt for ChatGPT.")
+        self.modes.register("topK", self.top_k, help="Display the top-K replies of ChatGPT for the last prompt.")
+        self.modes.register("dalle2", self.prompt_dalle2, help="Create a prompt for DALLE2.")
+        self.modes.register("history", self.prompt_history, help="View history of conversations.")
+        self.modes.register("search", self.search, help="Find the messages of this channel closest to a topic.")
+        for command in plugin_modes: # Plugin functions take the bot first
+            self.modes.register(command.name, functools.partial(command.function, self), command.arg_types, command.help, command.fast)
         self.default_mode = "prompt"
 
-        self.valid_engines = self.openai_client.get_engines()
+        self.valid_engines = self.openai_client.get_engines() + (["auto"] if self.openai_client.router is not None else [])
+        self.default_engine = "gpt-3.5-turbo" # Also used for auto while the router is disabled
         self.min_temperature = 0.0
         self.max_temperature = 1.0
 
-        self.history = HistoryCT(
-            history_save_path="history.json", 
-            default_options={
-                "history_enabled" : True,
-                "save_users_enabled" : False,
-                "engine" : "gpt-3.5-turbo",
-                "temperature" : 0.5,
-            })
-        self.history.load_history()
-
-        self.admin_commands = {
-            "help" : self.admin_help,
-            "history_channel_enabled" : self.admin_enable_history_channel,
-            "history_thread_enabled" : self.admin_enable_history_thread,
-            "save_usernames_channel_enabled" : self.admin_enable_save_usernames_channel,
-            "save_usernames_thread_enabled" : self.admin_enable_save_usernames_thread,
-            "engine_channel" : self.admin_set_engine_channel,
-            "engine_thread" : self.admin_set_engine_thread,
-            "temperature_channel" : self.admin_set_temperature_channel,
-            "temperature_thread" : self.admin_set_temperature_thread,
+        default_options = {
+            "history_enabled" : True,
+            "save_users_enabled" : False,
+            "engine" : "auto" if self.openai_client.router is not None else self.default_engine, # auto lets the router pick per request
+            "cost_budget" : None, # USD per day for the routed requests of a channel, None for no limit
+            "temperature" : 0.5,
+            "stream_enabled" : False,
+            "token_budget" : None, # None uses the whole context window of the engine
+            "summary_enabled" : False,
+            "cache_enabled" : False,
+            "image_size" : "256x256",
+            "image_count" : 1,
+            "retrieval_enabled" : False, # Related messages of other threads added to the context, with the semantic index
+            "retrieval_budget" : 256, # Tokens of the context they may take
         }
+        if history_backend == "sqlite":
+            self.history = ShardedHistoryCT(history_dir=history_path or "history", default_options=default_options, max_bytes=history_max_bytes, import_path=history_import_path or "history.json", import_channels=history_import_channels, assistant_id=self.id)
+        else:
+            self.history = HistoryCT(history_save_path=history_path or "history.json", default_options=default_options, assistant_id=self.id, import_path=history_import_path, import_channels=history_import_channels)
+        self.history.load_history()
+        if self.index is not None:
+            self.index.backfill(self.history) # Messages stored before the index was enabled
+
+        self.context_builder = ContextBuilder()
+        self.valid_image_sizes = self.openai_client.image_sizes
+        self.min_image_count = 1
+        self.min_profile_interval = 1.0 # ms, shorter intervals busy-spin the sampling thread
+        self.max_image_count = 4
+        self.min_token_budget = 1
+        self.max_token_budget = max(self.openai_client.context_sizes.values())
+        self.retrieval_k = 5
+        self.retrieval_min_score = 0.8 # Cosine similarity, unrelated messages still score around 0.7 with ada-002
+        self.search_results = 5
+
+        self.summarizer = ThreadSummarizer(self.history, self.openai_client)
+
+        self.reply_start = {"role": "assistant", "content": f"{self._tag_user(self.id)}: "} # Start of the reply for the assistant when users are saved
+        self.stream_placeholder = "..."
+        self.stream_update_interval = 1.0 # Seconds between two edits of a streamed reply, chat.update is rate limited
+
+        # Arguments are converted to their types before the command is called
+        self.admin_commands = CommandTable()
+        self.admin_commands.register("help", self.admin_help, help="This message.")
+        self.admin_commands.register("history_channel_enabled", self.admin_enable_history_channel, (boolean,), help="Enable or disable history for the current channel.")
+        self.admin_commands.register("history_thread_enabled", self.admin_enable_history_thread, (boolean,), help="Enable or disable history for the current thread.")
+        self.admin_commands.register("save_usernames_channel_enabled", self.admin_enable_save_usernames_channel, (boolean,), help="Enable or disable the save of usernames for the current channel.")
+        self.admin_commands.register("save_usernames_thread_enabled", self.admin_enable_save_usernames_thread, (boolean,), help="Enable or disable the save of usernames for the current thread.")
+        self.admin_commands.register("engine_channel", self.admin_set_engine_channel, help="Set the engine for the current channel.")
+        self.admin_commands.register("engine_thread", self.admin_set_engine_thread, help="Set the engine for the current thread.")
+        self.admin_commands.register("temperature_channel", self.admin_set_temperature_channel, (float,), help="Set the temperature for the current channel.")
+        self.admin_commands.register("temperature_thread", self.admin_set_temperature_thread, (float,), help="Set the temperature for the current thread.")
+        self.admin_commands.register("stream_channel_enabled", self.admin_enable_stream_channel, (boolean,), help="Enable or disable streamed replies for the current channel.")
+        self.admin_commands.register("stream_thread_enabled", self.admin_enable_stream_thread, (boolean,), help="Enable or disable streamed replies for the current thread.")
+        self.admin_commands.register("token_budget_channel", self.admin_set_token_budget_channel, (int,), help="Set the maximum number of context tokens for the current channel.")
+        self.admin_commands.register("token_budget_thread", self.admin_set_token_budget_thread, (int,), help="Set the maximum number of context tokens for the current thread.")
+        self.admin_commands.register("summary_channel_enabled", self.admin_enable_summary_channel, (boolean,), help="Enable or disable the summary of long threads for the current channel.")
+        self.admin_commands.register("summary_thread_enabled", self.admin_enable_summary_thread, (boolean,), help="Enable or disable the summary of long threads for the current thread.")
+        self.admin_commands.register("cache_channel_enabled", self.admin_enable_cache_channel, (boolean,), help="Enable or disable the reuse of cached replies for the current channel.")
+        self.admin_commands.register("cache_thread_enabled", self.admin_enable_cache_thread, (boolean,), help="Enable or disable the reuse of cached replies for the current thread.")
+        self.admin_commands.register("image_size_channel", self.admin_set_image_size_channel, help="Set the size of DALLE2 images for the current channel.")
+        self.admin_commands.register("image_size_thread", self.admin_set_image_size_thread, help="Set the size of DALLE2 images for the current thread.")
+        self.admin_commands.register("image_count_channel", self.admin_set_image_count_channel, (int,), help="Set the number of DALLE2 images per prompt for the current channel.")
+        self.admin_commands.register("image_count_thread", self.admin_set_image_count_thread, (int,), help="Set the number of DALLE2 images per prompt for the current thread.")
+        self.admin_commands.register("retrieval_channel_enabled", self.admin_enable_retrieval_channel, (boolean,), help="Enable or disable the related messages of other threads in the context for the current channel.")
+        self.admin_commands.register("retrieval_thread_enabled", self.admin_enable_retrieval_thread, (boolean,), help="Enable or disable the related messages of other threads in the context for the current thread.")
+        self.admin_commands.register("retrieval_budget_channel", self.admin_set_retrieval_budget_channel, (int,), help="Set the maximum number of context tokens of the related messages for the current channel.")
+        self.admin_commands.register("cost_budget_channel", self.admin_set_cost_budget_channel, (float,), help="Set the daily budget in USD of the requests routed with engine auto for the current channel.")
+        self.admin_commands.register("stats", self.admin_stats, help="Show the reply cache, request coalescing, history, engine health, connection pool and stage timing statistics.")
+        self.admin_commands.register("profile", self.admin_profile, (str, float), help="Start (profile start [interval in ms]) or stop (profile stop) the sampling profiler, the stop replies with the busiest functions.")
 
     def save_history(self):
         self.history.save_history()
 
 
-    def receive_message(self, channel, thread, message, user, mode=None):
+    def _resolve_mode(self, channel, thread, mode):
         if mode is not None:
             if mode in self.modes:
                 print("mode: ", mode)
-                self.modes[mode](channel, thread, message, user)
             else:
                 print("mode: ", mode, "(unrecognised mode).")
+                self.metrics.inc("requests_total", mode="unknown")
                 self.client.send_message(channel, thread, "Command not found. Type /help for a list of commands.")
+                return None
             
         else:
             print("No mode, using default: ", self.default_mode)
-            self.modes[self.default_mode](channel, thread, message, user)
+            mode = self.default_mode
+        self.metrics.inc("requests_total", mode=mode)
+        return mode
+
+    def receive_message(self, channel, thread, message, user, mode=None):
+        mode = self._resolve_mode(channel, thread, mode)
+        if mode is not None:
+            with self.metrics.span("request", mode=mode):
+                return self.modes[mode](channel, thread, message, user)
+
+    def busy(self, channel, thread, *args):
+        self.metrics.inc("busy_total")
+        self.client.send_message(channel, thread, "I'm busy with earlier messages, please retry in a little while. :hourglass_flowing_sand:")
 
     def _tag_user(self, user):
         return f"<@{user}>"
@@ -141,81 +307,232 @@ class SlackBot():
         self.client.send_message(channel, thread, f"Hi {self._tag_user(user)}, I'm here! :robot_face:")
 
     def help(self, channel, thread, *args):
-        message = "The help command provides you with a list of available commands and their functions. Commands: \n"\
-                    + "ping: I'm here! :robot_face: \n"\
-                    + "help: This message. \n"\
-                    + "admin: Admin commands. Type /admin help for more details. \n"\
-                    + "prompt: Create a prompt for ChatGPT. \n"\
-                    + "topK: Display the top-K replies of ChatGPT for the last prompt. \n"\
-                    + "dalle2: Create a prompt for DALLE2. \n"\
-                    + "history: View history of conversations."
-        
+        message = "The help command provides you with a list of available commands and their functions. Commands: \n" + self.modes.help()
         self.client.send_message(channel, thread, message)
 
 
-    def prompt_chat_gpt(self, channel, thread, prompt, user):
-        users_enabled = self.history.get_option(channel, thread, "save_users_enabled")
-        history_enabled = self.history.get_option(channel, thread, "history_enabled")
+    def _token_budget(self, channel, thread, engine):
+        budget = self.openai_client.get_context_size(engine) - self.openai_client.max_tokens
+        channel_budget = self.history.get_option(channel, thread, "token_budget")
+        if channel_budget is not None:
+            budget = min(budget, channel_budget)
+        return budget
+
+    def _fit_context(self, channel, thread, history, prompt, end=None, retrieved=None):
+        """
+        Most recent part of the history that fits in the token budget along with the prompt.
+        When the thread has a summary, it replaces the entries it covers. The retrieved entry comes first.
+        """
+        engine = self._context_engine(channel, thread)
+        users_overhead = 8 if self.history.get_option(channel, thread, "save_users_enabled") else 0 # "<@user>: " prefixes
+        budget = self._token_budget(channel, thread, engine) - self.context_builder.count_tokens(prompt, engine) - 2 * (self.context_builder.message_overhead + users_overhead)
+
+        prefix = []
+        if retrieved is not None:
+            budget -= self.context_builder.entry_tokens(retrieved, engine) + self.context_builder.message_overhead # A system message, without user tag
+            prefix.append(retrieved)
+
+        summary = self.history.get_summary(channel, thread) if self.history.get_option(channel, thread, "summary_enabled") else None
+        if summary is None:
+            return prefix + self.context_builder.build(history, engine, budget, end=end, extra_overhead=users_overhead)
+
+        summary_entry = HistoryEntry(self.id, f"Summary of the earlier conversation: {summary['message']}", True)
+        budget -= self.context_builder.entry_tokens(summary_entry, engine) + self.context_builder.message_overhead + users_overhead
+        context = self.context_builder.build(history, engine, budget, start=summary["upto"], end=end, extra_overhead=users_overhead)
+        return prefix + [summary_entry] + context
+
+    def _retrieval_enabled(self, channel, thread):
+        return self.index is not None and self.history.get_option(channel, thread, "history_enabled") and self.history.get_option(channel, thread, "retrieval_enabled")
+
+    def _retrieve(self, channel, thread, prompt):
+        """
+        Messages of other threads of the channel related to the prompt, as (score, thread, user, message)
+        """
+        if not self._retrieval_enabled(channel, thread):
+            return []
+        with self.metrics.span("retrieval"):
+            try:
+                return self.index.search(channel, prompt, k=self.retrieval_k, exclude_thread=thread, min_score=self.retrieval_min_score)
+            except Exception as e:
+                print("Retrieval failed:", e) # The prompt is answered without them
+                return []
+
+    def _retrieved_entry(self, channel, thread, hits):
+        # As many of the related messages as the retrieval budget holds, best first
+        engine = self._context_engine(channel, thread)
+        budget = self.history.get_option(channel, thread, "retrieval_budget")
+        header = "Related messages from other threads of this channel:"
+        text = header
+        for _, _, _, message in hits:
+            line = "\n- " + " ".join(message.split())
+            if self.context_builder.count_tokens(text + line, engine) > budget:
+                break
+            text += line
+        return HistoryEntry(self.id, text, is_system=True) if text != header else None
+
+    def _index_entry(self, channel, thread, entry):
+        if self.index is not None:
+            self.index.add(channel, thread, entry.user, entry.message)
+
+    def _engine(self, channel, thread):
+        # auto set while the router was enabled, e.g. before a restart without --engine_router
+        engine = self.history.get_option(channel, thread, "engine")
+        return self.default_engine if engine == "auto" and self.openai_client.router is None else engine
+
+    def _context_engine(self, channel, thread):
+        # Routed requests build their context for the router's reference engine, the engine is picked afterwards
+        engine = self._engine(channel, thread)
+        return self.openai_client.router.context_engine if engine == "auto" else engine
+
+    def _route(self, channel, thread, prompt, context):
+        engine = self._engine(channel, thread)
+        if engine != "auto":
+            return Route(engine)
+        context_engine = self.openai_client.router.context_engine
+        prompt_tokens = self.context_builder.entry_tokens(prompt, context_engine)
+        context_tokens = sum(self.context_builder.entry_tokens(entry, context_engine) for entry in context)
+        return self.openai_client.router.route(channel, prompt_tokens, context_tokens, budget=self.history.get_option(channel, None, "cost_budget"))
+
+    def _record_route(self, route, reply=None, error=None):
+        if route.routed:
+            reply_tokens = self.context_builder.count_tokens(reply, route.engine) if reply is not None else 0
+            self.openai_client.router.record(route, reply_tokens, error)
+
+    def _chat_messages(self, context, prompt, users_enabled):
+        # Entries keep their API message, so only the new turn is formatted
+        context = [entry.chat_message(users_enabled) for entry in context]
+        prompt = [prompt.chat_message(users_enabled)]
+        if users_enabled:
+            prompt.append(self.reply_start)
+        return prompt, context
+
+    def _build_chat_prompt(self, channel, thread, prompt, user):
+        with self.metrics.span("history_lookup"):
+            users_enabled = self.history.get_option(channel, thread, "save_users_enabled")
+            history_enabled = self.history.get_option(channel, thread, "history_enabled")
+            history = self.history.get_history(channel, thread) if history_enabled else []
 
         context = []
         if history_enabled:
-            context = self.history.get_history(channel, thread)
-            self.history.add_to_history(channel, thread, prompt, user)
-        
-        context = [{"user": self._tag_user(entry["user"]), "message": entry['message']} for entry in context]
-        prompt = {"user": self._tag_user(user), "message": prompt}
-        if users_enabled:
-            context = [{"user": entry["user"], "message": f"{entry['user']}: {entry['message']}"} for entry in context]
-            prompt = [
-                        {"user": prompt["user"], "message": f"{prompt['user']}: {prompt['message']}"},
-                        {"user": self._tag_user(self.id), "message": f"{self._tag_user(self.id)}: "} # This is the start of the reply for the assistant
-                    ]
+            hits = self._retrieve(channel, thread, prompt)
+            with self.metrics.span("preprocess"):
+                context = self._fit_context(channel, thread, history, prompt, retrieved=self._retrieved_entry(channel, thread, hits)) # Copy before the prompt is appended to the thread
+            with self.metrics.span("history_save"):
+                prompt = self.history.add_to_history(channel, thread, prompt, user)
+            self._index_entry(channel, thread, prompt)
+        else:
+            prompt = HistoryEntry(user, prompt)
 
-        reply = self.openai_client.prompt_chat_gpt(prompt, context, engine=self.history.get_option(channel, thread, "engine"), temperature=self.history.get_option(channel, thread, "temperature"))
-        reply = re.sub(r"^\n+", "", reply)
-        
-        self.client.send_message(channel, thread, reply)
+        route = self._route(channel, thread, prompt, context)
+        prompt, context = self._chat_messages(context, prompt, users_enabled)
+        return prompt, context, history_enabled, route
 
+    def _finish_chat_prompt(self, channel, thread, reply, history_enabled, ts=None):
+        reply = re.sub(r"^\n+", "", reply)
+        sent = self._send_reply(channel, thread, reply, ts)
         if history_enabled:
-            self.history.add_to_history(channel, thread, reply, self.id)
+            self._save_reply(channel, thread, reply)
+        return sent
+
+    def _send_reply(self, channel, thread, reply, ts=None):
+        if ts is None:
+            return self.client.send_message(channel, thread, reply)
+        return self.client.update_message(channel, ts, reply) # Replace the streamed message with the final reply
+
+    def _save_reply(self, channel, thread, reply):
+        with self.metrics.span("history_save"):
+            entry = self.history.add_to_history(channel, thread, reply, self.id)
+        self._index_entry(channel, thread, entry)
+        if self.history.get_option(channel, thread, "summary_enabled"):
+            self.summarizer.maybe_summarize(channel, thread)
+
+    def _openai_failed(self, channel, thread, error, ts=None):
+        print("OpenAI request failed:", error)
+        message = "Sorry, I could not get a reply from OpenAI, please retry in a little while. :warning:"
+        if ts is None:
+            self.client.send_message(channel, thread, message)
+        else:
+            self.client.update_message(channel, ts, message) # Replace the placeholder
 
+    def _stream_text(self, chunks):
+        return re.sub(r"^\n+", "", "".join(chunks))
 
-    def top_k(self, channel, thread, k, user):
+    def prompt_chat_gpt(self, channel, thread, prompt, user):
+        if self.history.get_option(channel, thread, "stream_enabled"):
+            return self.prompt_chat_gpt_stream(channel, thread, prompt, user)
+
+        prompt, context, history_enabled, route = self._build_chat_prompt(channel, thread, prompt, user)
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            try:
+                reply = self.openai_client.prompt_chat_gpt(prompt, context, engine=engine, temperature=self.history.get_option(channel, thread, "temperature"), use_cache=self.history.get_option(channel, thread, "cache_enabled"))
+            except Exception as e:
+                self._record_route(route, error=e)
+                self._openai_failed(channel, thread, e)
+                raise
+        self._record_route(route, reply)
+        self._finish_chat_prompt(channel, thread, reply, history_enabled)
+
+    def prompt_chat_gpt_stream(self, channel, thread, prompt, user):
+        prompt, context, history_enabled, route = self._build_chat_prompt(channel, thread, prompt, user)
+        ts = self.client.post_message(channel, thread, self.stream_placeholder)
+
+        chunks = []
+        last_update = time.monotonic()
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            try:
+                for chunk in self.openai_client.prompt_chat_gpt_stream(prompt, context, engine=engine, temperature=self.history.get_option(channel, thread, "temperature"), use_cache=self.history.get_option(channel, thread, "cache_enabled")):
+                    chunks.append(chunk)
+                    if ts is not None and time.monotonic() - last_update >= self.stream_update_interval:
+                        text = self._stream_text(chunks)
+                        if len(text) > 0:
+                            self.client.update_message(channel, ts, text + " " + self.stream_placeholder)
+                            last_update = time.monotonic()
+            except Exception as e:
+                self._record_route(route, error=e)
+                self._openai_failed(channel, thread, e, ts)
+                raise
+
+        reply = self.openai_client._postprocess("".join(chunks))
+        self._record_route(route, reply)
+        self._finish_chat_prompt(channel, thread, reply, history_enabled, ts)
+
+
+    def _parse_top_k(self, channel, thread, k):
         if type(k) is not int:
             try:
                 k = int(k)
             except ValueError:
                 self.client.send_message(channel, thread, "Please enter a valid integer for k.")
-                return
+                return None
         
         if k < 1 or k > 10:
             self.client.send_message(channel, thread, "Please enter a valid integer for k (1-10).")
-            return
+            return None
 
         if len(self.history.get_history(channel, thread)) < 2:
             self.client.send_message(channel, thread, "No history found for this thread.")
-            return
+            return None
         
         if not self.history.get_option(channel, thread, "history_enabled"):
             self.client.send_message(channel, thread, "History is not enabled for this thread.")
-            return
-        
+            return None
+
+        return k
+
+    def _build_top_k_prompt(self, channel, thread):
         history = self.history.get_history(channel, thread)
-        context = [{"user": self._tag_user(entry["user"]), "message": entry['message']} for entry in history[:-2]]
-        prompt = {"user": self._tag_user(history[-2]['user']), "message": history[-2]['message']}
-        
-        if self.history.get_option(channel, thread, "save_users_enabled"):
-            context = [{"user": entry["user"], "message": f"{entry['user']}: {entry['message']}"} for entry in context]
-            prompt = [
-                        {"user": prompt["user"], "message": f"{prompt['user']}: {prompt['message']}"},
-                        {"user": self._tag_user(self.id), "message": f"{self._tag_user(self.id)}: "} # This is the start of the reply for the assistant
-                    ]
-
-        replies = self.openai_client.prompt_chat_gpt_top_k(prompt, top_k=k, engine=self.history.get_option(channel, thread, "engine"), temperature=self.history.get_option(channel, thread, "temperature"))
-        replies = [re.sub(r"^\n+", "", reply) for reply in replies]
+        context = self._fit_context(channel, thread, history, history[-2].message, end=len(history) - 2)
+        route = self._route(channel, thread, history[-2], context)
+        return (*self._chat_messages(context, history[-2], self.history.get_option(channel, thread, "save_users_enabled")), route)
+
+    def _top_k_text(self, k, replies, done=True):
         replies_text = "\n".join([f"{i+1}. {reply}" for i, reply in enumerate(replies)])
+        return f"Top-{k} answers from ChatGPT for the last prompt:\n{replies_text}" + ("" if done else "\n" + self.stream_placeholder)
 
-        self.client.send_message(channel, thread, f"Top-{k} answers from ChatGPT for the last prompt:\n{replies_text}", attachments= [
+    def _top_k_attachments(self, replies):
+        return [
         {
             "text": "Select one answer to replace the previous reply. Please, do not prompt another query in the meantime.",
             "callback_id": "top_k_callback",
@@ -227,16 +544,52 @@ class SlackBot():
                     "value": reply
                 } for i, reply in enumerate(replies)]
         }
-    ])
+    ]
+
+    def _send_top_k(self, channel, thread, k, replies, ts=None):
+        if len(replies) == 0:
+            text = "No answer from ChatGPT in time, please try again."
+            if ts is None:
+                return self.client.send_message(channel, thread, text)
+            return self.client.update_message(channel, ts, text)
+
+        if ts is None:
+            return self.client.send_message(channel, thread, self._top_k_text(k, replies), attachments=self._top_k_attachments(replies))
+        return self.client.update_message(channel, ts, self._top_k_text(k, replies), attachments=self._top_k_attachments(replies))
+
+    def top_k(self, channel, thread, k, user):
+        k = self._parse_top_k(channel, thread, k)
+        if k is None:
+            return
+
+        prompt, context, route = self._build_top_k_prompt(channel, thread)
+        ts = self.client.post_message(channel, thread, self._top_k_text(k, [], done=False))
+
+        # Candidates are shown as they come in, the buttons once all of them are in or dropped
+        replies = []
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            for reply in self.openai_client.prompt_chat_gpt_top_k_iter(prompt, context, top_k=k, engine=engine, temperature=self.history.get_option(channel, thread, "temperature")):
+                replies.append(re.sub(r"^\n+", "", reply))
+                if ts is not None and len(replies) < k:
+                    self.client.update_message(channel, ts, self._top_k_text(k, replies, done=False))
+        self._record_route(route, "".join(replies))
+        self._send_top_k(channel, thread, k, replies, ts)
     
     def top_k_callback(self, channel, thread, message):
         self.client.send_message(channel, thread, message)
-        self.history.get_history(channel, thread)[-1] = {"user" : self.id, "message" : message} # replace last message in history with new selected one
+        with self.metrics.span("history_save"):
+            self.history.replace_last_in_history(channel, thread, message, self.id) # replace last message in history with new selected one
 
 
     def prompt_dalle2(self, channel, thread, prompt, user):
-        image_url = self.openai_client.prompt_dalle2(prompt)
-        self.client.send_image(channel, thread, image_url)
+        with self.metrics.span("openai", engine="dalle2"):
+            try:
+                image_urls = self.openai_client.prompt_dalle2(prompt, n=self.history.get_option(channel, thread, "image_count"), size=self.history.get_option(channel, thread, "image_size"))
+            except Exception as e:
+                self._openai_failed(channel, thread, e)
+                raise
+        self.client.send_images(channel, thread, image_urls)
 
 
     def prompt_history(self, channel, thread, *args):
@@ -245,33 +598,54 @@ class SlackBot():
             self.client.send_message(channel, thread, "No history found for this thread.")
         else:
             if self.history.get_option(channel, thread, "save_users_enabled"):
-                history = [f"{self._tag_user(entry['user'])}: {entry['message']}" for entry in history]
+                history = [f"{self._tag_user(entry.user)}: {entry.message}" for entry in history]
             else:
-                history = [entry["message"] for entry in history]
+                history = [entry.message for entry in history]
             self.client.send_message(channel, thread, "Here is my current available history:\n" + "".join(history))
 
+    def _search_results(self, channel, query):
+        if self.index is None:
+            return "Search is not enabled, the bot must be started with --semantic_index."
+        if len(query.strip()) == 0:
+            return "Please enter what to search for, e.g. /search release schedule."
+
+        with self.metrics.span("search"):
+            hits = self.index.search(channel, query.strip(), k=self.search_results)
+        if len(hits) == 0:
+            return "No messages indexed yet for this channel."
+
+        lines = ["Closest messages in this channel:"]
+        for score, thread, user, message in hits:
+            link = f"https://slack.com/archives/{channel}/p{thread.replace('.', '')}" # Opens the thread in the workspace of the user
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(float(thread)))
+            snippet = " ".join(message.split())
+            snippet = snippet[:150] + "..." if len(snippet) > 150 else snippet
+            lines.append(f"{score:.2f} <{link}|{date}> {self._tag_user(user)}: {snippet}")
+        return "\n".join(lines)
+
+    def search(self, channel, thread, query, user):
+        try:
+            message = self._search_results(channel, query)
+        except Exception as e:
+            self._openai_failed(channel, thread, e)
+            raise
+        self.client.send_message(channel, thread, message)
+
     
     def admin(self, channel, thread, prompt, user):
-        prompt = re.sub(r"^\s*", "", prompt)
-        command, *params = re.split(r"\s+", prompt)
+        try:
+            command, params = self.admin_commands.parse(prompt)
+        except ArgumentError as e:
+            self.client.send_message(channel, thread, f"{e} Or do not provide a value to see the current status.")
+            return
 
-        if command in self.admin_commands:
-            self.admin_commands[command](channel, thread, *params)
+        if command is not None:
+            command.function(channel, thread, *params)
         else:
             self.admin_help(channel, thread, *params)
 
     def admin_help(self, channel, thread, *args):
-        message = "The admin help command provides you with a list of available admin commands and their functions. Commands: \n"\
-                + "help: This message. \n"\
-                + "history_channel_enabled: Enable or disable history for the current channel. \n"\
-                + "history_thread_enabled: Enable or disable history for the current thread. \n"\
-                + "save_usernames_channel_enabled: Enable or disable the save of usernames for the current channel. \n"\
-                + "save_usernames_thread_enabled: Enable or disable the save of usernames for the current thread. \n"\
-                + "engine_channel: Set the engine for the current channel. \n"\
-                + "engine_thread: Set the engine for the current thread. \n"\
-                + "temperature_channel: Set the temperature for the current channel. \n"\
-                + "temperature_thread: Set the temperature for the current thread."
-        
+        message = "The admin help command provides you with a list of available admin commands and their functions. Commands: \n" + self.admin_commands.help()
         self.client.send_message(channel, thread, message)
     
     def _admin_enable_option_channel(self, channel, thread, option, option_name, value):
@@ -280,14 +654,8 @@ class SlackBot():
         if value is None:
             self.client.send_message(channel, thread, f"{option_name} is currently " + ("enabled" if self.history.get_option(channel, thread=None, option_name=option) else "disabled") + f" for this channel.")
         else:
-            if value.lower() in ["true", "yes", "on", "1"]:
-                self.history.set_option(channel, thread=None, option_name=option, option_value=True)
-                self.client.send_message(channel, thread, f"{option_name} is now enabled for this channel.")
-            elif value.lower() in ["false", "no", "off", "0"]:
-                self.history.set_option(channel, thread=None, option_name=option, option_value=False)
-                self.client.send_message(channel, thread, f"{option_name} is now disabled for this channel.")
-            else:
-                self.client.send_message(channel, thread, "Invalid value. Please use true, yes, on, 1, false, no, off, 0. Or do not provide a value to see the current status.")
+            self.history.set_option(channel, thread=None, option_name=option, option_value=value) # Already a bool, parsed with the command
+            self.client.send_message(channel, thread, f"{option_name} is now " + ("enabled" if value else "disabled") + f" for this channel.")
     
     def _admin_enable_option_thread(self, channel, thread, option, option_name, value):
         self.history.init_history(channel, thread) # Ensure that the history is initialized for this channel and thread
@@ -295,14 +663,8 @@ class SlackBot():
         if value is None:
             self.client.send_message(channel, thread, f"{option_name} is currently " + ("enabled" if self.history.get_option(channel, thread, option) else "disabled") + f" for this thread.")
         else:
-            if value.lower() in ["true", "yes", "on", "1"]:
-                self.history.set_option(channel, thread, option, True)
-                self.client.send_message(channel, thread, f"{option_name} is now enabled for this thread.")
-            elif value.lower() in ["false", "no", "off", "0"]:
-                self.history.set_option(channel, thread, option, False)
-                self.client.send_message(channel, thread, f"{option_name} is now disabled for this thread.")
-            else:
-                self.client.send_message(channel, thread, "Invalid value. Please use true, yes, on, 1, false, no, off, 0. Or do not provide a value to see the current status.")
+            self.history.set_option(channel, thread, option, value) # Already a bool, parsed with the command
+            self.client.send_message(channel, thread, f"{option_name} is now " + ("enabled" if value else "disabled") + f" for this thread.")
 
     def _admin_set_option_channel(self, channel, thread, option, option_name, value, valid_values=None, min_value=None, max_value=None):
         self.history.init_history(channel, thread) # Ensure that the history is initialized for this channel and thread
@@ -316,7 +678,7 @@ class SlackBot():
                 
                 self.history.set_option(channel, thread=None, option_name=option, option_value=value)
                 self.client.send_message(channel, thread, f"{option_name} is now {value} for this channel.")
-            except:
+            except ValueError:
                 valid_values_text = ""
                 if valid_values is not None:
                     valid_values_text = " The set of valid values is:\n " + "\n".join(valid_values) + "."
@@ -337,7 +699,7 @@ class SlackBot():
 
                 self.history.set_option(channel, thread, option, value)
                 self.client.send_message(channel, thread, f"{option_name} is now {value} for this thread.")
-            except:
+            except ValueError:
                 valid_values_text = ""
                 if valid_values is not None:
                     valid_values_text = " The set of valid values is:\n " + "\n".join(valid_values) + "."
@@ -369,5 +731,211 @@ class SlackBot():
     def admin_set_temperature_thread(self, channel, thread, value=None, *args):
         self._admin_set_option_thread(channel, thread, "temperature", "Temperature", value, min_value=self.min_temperature, max_value=self.max_temperature)
 
-    
+    def admin_set_token_budget_channel(self, channel, thread, value=None, *args):
+        self._admin_set_option_channel(channel, thread, "token_budget", "Token budget", value, min_value=self.min_token_budget, max_value=self.max_token_budget)
+
+    def admin_set_token_budget_thread(self, channel, thread, value=None, *args):
+        self._admin_set_option_thread(channel, thread, "token_budget", "Token budget", value, min_value=self.min_token_budget, max_value=self.max_token_budget)
+
+    def admin_enable_summary_channel(self, channel, thread, value=None, *args):
+        self._admin_enable_option_channel(channel, thread, "summary_enabled", "Thread summary", value)
+
+    def admin_enable_summary_thread(self, channel, thread, value=None, *args):
+        self._admin_enable_option_thread(channel, thread, "summary_enabled", "Thread summary", value)
+
+    def admin_enable_cache_channel(self, channel, thread, value=None, *args):
+        self._admin_enable_option_channel(channel, thread, "cache_enabled", "Reply cache", value)
+
+    def admin_enable_cache_thread(self, channel, thread, value=None, *args):
+        self._admin_enable_option_thread(channel, thread, "cache_enabled", "Reply cache", value)
+
+    def _format_stats(self, stats):
+        return ", ".join([f"{name}={value:.2f}" if type(value) is float else f"{name}={value}" for name, value in stats.items()])
+
+    def admin_stats(self, channel, thread, *args):
+        message = "Reply cache: " + self._format_stats(self.openai_client.cache.stats()) + "\n"\
+                + "Coalesced requests: " + self._format_stats(self.openai_client.single_flight.stats()) + "\n"\
+                + "History: " + self._format_stats(self.history.stats()) + "\n"\
+                + "Mean stage time (ms): " + self._format_stats(self.metrics.stage_means())
+        if self.index is not None:
+            message += "\nSemantic index: " + self._format_stats(self.index.stats())
+        if self.openai_client.router is not None:
+            message += "\nEngine routing: " + self._format_stats(self.openai_client.router.stats())
+        breakers = {engine: breaker.state for engine, breaker in self.openai_client.breakers.items()}
+        if len(breakers) > 0:
+            message += "\nEngine circuit breakers: " + self._format_stats(breakers)
+        for host, host_stats in self.client.transport.stats().items():
+            message += f"\nConnections to {host}: " + self._format_stats(host_stats)
+        self.client.send_message(channel, thread, message)
+
+    def admin_profile(self, channel, thread, action=None, interval=None, *args):
+        if action == "start":
+            if interval is not None and interval < self.min_profile_interval:
+                self.client.send_message(channel, thread, f"Invalid value. Please use a valid value for the option. Or do not provide a value to see the current status. The interval must be at least {self.min_profile_interval:g}ms.")
+                return
+            if self.profiler.start(interval / 1000 if interval is not None else None):
+                self.client.send_message(channel, thread, f"Profiler started, sampling every {1000 * self.profiler.interval:g}ms. Type /admin profile stop to see the results.")
+            else:
+                self.client.send_message(channel, thread, "The profiler is already running.")
+
+        elif action == "stop":
+            result = self.profiler.stop()
+            if result is None:
+                self.client.send_message(channel, thread, "The profiler is not running.")
+                return
+            stacks, duration = result
+            path = self.profile_path.format(int(time.time()))
+            self.profiler.write_folded(stacks, path)
+            message = f"Profiled {duration:.1f}s, {sum(stacks.values())} busy samples, {self.profiler.idle} idle. Folded stacks saved to {path}. Busiest functions:"
+            for function, share in self.profiler.top(stacks):
+                message += f"\n{100 * share:.1f}% {function}"
+            self.client.send_message(channel, thread, message)
+
+        else:
+            self.client.send_message(channel, thread, "The profiler is currently " + ("running" if self.profiler.running else "stopped") + ". Please use start [interval in ms] or stop.")
+
+    def admin_set_image_size_channel(self, channel, thread, value=None, *args):
+        self._admin_set_option_channel(channel, thread, "image_size", "Image size", value, valid_values=self.valid_image_sizes)
 
+    def admin_set_image_size_thread(self, channel, thread, value=None, *args):
+        self._admin_set_option_thread(channel, thread, "image_size", "Image size", value, valid_values=self.valid_image_sizes)
+
+    def admin_set_image_count_channel(self, channel, thread, value=None, *args):
+        self._admin_set_option_channel(channel, thread, "image_count", "Image count", value, min_value=self.min_image_count, max_value=self.max_image_count)
+
+    def admin_set_image_count_thread(self, channel, thread, value=None, *args):
+        self._admin_set_option_thread(channel, thread, "image_count", "Image count", value, min_value=self.min_image_count, max_value=self.max_image_count)
+
+    def admin_enable_retrieval_channel(self, channel, thread, value=None, *args):
+        self._admin_enable_option_channel(channel, thread, "retrieval_enabled", "Related messages", value)
+
+    def admin_enable_retrieval_thread(self, channel, thread, value=None, *args):
+        self._admin_enable_option_thread(channel, thread, "retrieval_enabled", "Related messages", value)
+
+    def admin_set_retrieval_budget_channel(self, channel, thread, value=None, *args):
+        self._admin_set_option_channel(channel, thread, "retrieval_budget", "Related messages budget", value, min_value=self.min_token_budget, max_value=self.max_token_budget)
+
+    def admin_set_cost_budget_channel(self, channel, thread, value=None, *args):
+        self._admin_set_option_channel(channel, thread, "cost_budget", "Daily cost budget", value, min_value=0.0)
+
+    def admin_enable_stream_channel(self, channel, thread, value=None, *args):
+        self._admin_enable_option_channel(channel, thread, "stream_enabled", "Streaming", value)
+
+    def admin_enable_stream_thread(self, channel, thread, value=None, *args):
+        self._admin_enable_option_thread(channel, thread, "stream_enabled", "Streaming", value)
+
+
+class AsyncSlackBot(SlackBot):
+    """
+    SlackBot running on an asyncio event loop, with AsyncClientInterface and AsyncOpenaiInterface
+    """
+
+    async def receive_message(self, channel, thread, message, user, mode=None):
+        mode = self._resolve_mode(channel, thread, mode)
+        if mode is not None:
+            with self.metrics.span("request", mode=mode): # Held until the coroutine of the mode is done
+                result = self.modes[mode](channel, thread, message, user)
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def _blocking(self, function, *args):
+        # History files, sqlite and the query embedding are blocking, they run off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _finish_chat_prompt_async(self, channel, thread, reply, history_enabled, ts=None):
+        reply = re.sub(r"^\n+", "", reply)
+        sent = self._send_reply(channel, thread, reply, ts)
+        if history_enabled:
+            await self._blocking(self._save_reply, channel, thread, reply)
+        await sent # A failed send is reported as a failure of the request
+
+    async def search(self, channel, thread, query, user):
+        try:
+            message = await self._blocking(self._search_results, channel, query)
+        except Exception as e:
+            self._openai_failed(channel, thread, e)
+            raise
+        await self.client.send_message(channel, thread, message)
+
+    async def prompt_chat_gpt(self, channel, thread, prompt, user):
+        if self.history.get_option(channel, thread, "stream_enabled"):
+            return await self.prompt_chat_gpt_stream(channel, thread, prompt, user)
+
+        prompt, context, history_enabled, route = await self._blocking(self._build_chat_prompt, channel, thread, prompt, user)
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            try:
+                reply = await self.openai_client.prompt_chat_gpt(prompt, context, engine=engine, temperature=self.history.get_option(channel, thread, "temperature"), use_cache=self.history.get_option(channel, thread, "cache_enabled"))
+            except Exception as e:
+                self._record_route(route, error=e)
+                self._openai_failed(channel, thread, e)
+                raise
+        self._record_route(route, reply)
+        await self._finish_chat_prompt_async(channel, thread, reply, history_enabled)
+
+    async def prompt_chat_gpt_stream(self, channel, thread, prompt, user):
+        prompt, context, history_enabled, route = await self._blocking(self._build_chat_prompt, channel, thread, prompt, user)
+        ts = await self.client.post_message(channel, thread, self.stream_placeholder)
+
+        chunks = []
+        update = None
+        last_update = time.monotonic()
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            try:
+                async for chunk in self.openai_client.prompt_chat_gpt_stream(prompt, context, engine=engine, temperature=self.history.get_option(channel, thread, "temperature"), use_cache=self.history.get_option(channel, thread, "cache_enabled")):
+                    chunks.append(chunk)
+                    if ts is not None and time.monotonic() - last_update >= self.stream_update_interval and (update is None or update.done()):
+                        text = self._stream_text(chunks)
+                        if len(text) > 0:
+                            update = self.client.update_message(channel, ts, text + " " + self.stream_placeholder)
+                            last_update = time.monotonic()
+            except Exception as e:
+                if update is not None:
+                    await update
+                self._record_route(route, error=e)
+                self._openai_failed(channel, thread, e, ts)
+                raise
+
+        if update is not None:
+            await update # The final edit must not be overtaken by an intermediate one
+        reply = self.openai_client._postprocess("".join(chunks))
+        self._record_route(route, reply)
+        await self._finish_chat_prompt_async(channel, thread, reply, history_enabled, ts)
+
+    async def top_k(self, channel, thread, k, user):
+        k = self._parse_top_k(channel, thread, k)
+        if k is None:
+            return
+
+        prompt, context, route = self._build_top_k_prompt(channel, thread)
+        ts = await self.client.post_message(channel, thread, self._top_k_text(k, [], done=False))
+
+        replies = []
+        update = None
+        engine = route.engine
+        with self.metrics.span("openai", engine=engine):
+            async for reply in self.openai_client.prompt_chat_gpt_top_k_iter(prompt, context, top_k=k, engine=engine, temperature=self.history.get_option(channel, thread, "temperature")):
+                replies.append(re.sub(r"^\n+", "", reply))
+                if ts is not None and len(replies) < k and (update is None or update.done()):
+                    update = self.client.update_message(channel, ts, self._top_k_text(k, replies, done=False))
+
+        if update is not None:
+            await update # The buttons must not be overwritten by an intermediate edit
+        self._record_route(route, "".join(replies))
+        await self._send_top_k(channel, thread, k, replies, ts)
+
+    async def top_k_callback(self, channel, thread, message):
+        sent = self.client.send_message(channel, thread, message)
+        with self.metrics.span("history_save"):
+            await self._blocking(self.history.replace_last_in_history, channel, thread, message, self.id)
+        await sent
+
+    async def prompt_dalle2(self, channel, thread, prompt, user):
+        with self.metrics.span("openai", engine="dalle2"):
+            try:
+                image_urls = await self.openai_client.prompt_dalle2(prompt, n=self.history.get_option(channel, thread, "image_count"), size=self.history.get_option(channel, thread, "image_size"))
+            except Exception as e:
+                self._openai_failed(channel, thread, e)
+                raise
+        await self.client.send_images(channel, thread, image_urls)
@@ -1,36 +1,258 @@
 
-import requests
-from io import BytesIO
-from typing import Union
+import time
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import openai
 from slack.web import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.errors import SlackApiError
+
+from response_cache import ResponseCache
+from history_entry import message_digest
+from single_flight import SingleFlight, AsyncSingleFlight
+from slack_dispatcher import SlackDispatcher, AsyncSlackDispatcher
+from transport import HttpTransport, AsyncHttpTransport, PooledWebClient
+from metrics import Metrics
+from resilience import CircuitBreaker, CircuitOpenError, LatencyTracker, backoff, retryable_errors
+from engine_router import EngineRouter
+
+
+class _StreamBody():
+    """
+    Request body read from a streamed download, the declared length avoids a chunked upload
+    """
+
+    def __init__(self, raw, length, chunk_size):
+        self.raw = raw
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.raw.read(self.chunk_size if size is None or size < 0 else min(size, self.chunk_size))
+
+    def __iter__(self):
+        chunk = self.read()
+        while chunk:
+            yield chunk
+            chunk = self.read()
 
 
 class ClientInterface():
 
-    def __init__(self, slack_token):
-        self.client = WebClient(slack_token)
+    def __init__(self, slack_token, transport : HttpTransport = None, upload_workers : int = 4, upload_chunk_size : int = 64 * 1024, metrics : Metrics = None):
+        self.transport = transport if transport is not None else HttpTransport()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.client = PooledWebClient(slack_token, self.transport)
+        self.dispatcher = SlackDispatcher()
+        self.session = self.transport.session # Reused connections for image downloads and uploads
+        self.upload_executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="upload")
+        self.upload_chunk_size = upload_chunk_size
 
     def get_id(self):
         return self.client.auth_test()["user_id"]
 
     def send_message(self, channel, thread, text, attachments=None):
-        response = self.client.chat_postMessage(channel=channel, 
-                                       thread_ts=thread,
-                                       text=text,
-                                       attachments=attachments)
+        """
+        Queue a message for the channel, returns a future of the send status
+        """
+        return self.dispatcher.submit("chat.postMessage", channel, self._send_message, channel=channel, thread=thread, text=text, attachments=attachments)
+
+    def post_message(self, channel, thread, text):
+        return self.dispatcher.submit("chat.postMessage", channel, self._post_message, channel=channel, thread=thread, text=text).result() # The caller needs the timestamp to edit the message
+
+    def update_message(self, channel, ts, text, attachments=None):
+        # Only the latest queued edit of a message is sent
+        return self.dispatcher.submit("chat.update", channel, self._update_message, coalesce_key=("chat.update", ts), channel=channel, ts=ts, text=text, attachments=attachments)
+
+    def send_image(self, channel, thread, image_url):
+        return self.send_images(channel, thread, [image_url])
+
+    def send_images(self, channel, thread, image_urls):
+        """
+        Upload the images in the background and queue the message holding them, returns a future of the send status
+        """
+        uploads = [self.upload_executor.submit(self._upload_external, channel, image_url, f"image_{i+1}.png") for i, image_url in enumerate(image_urls)]
+        return self.dispatcher.submit("files.completeUploadExternal", channel, self._complete_upload, after=uploads, channel=channel, thread=thread, uploads=uploads)
+
+    def _timed(self, method, function, **kwargs):
+        with self.metrics.span("slack_post", method=method):
+            response = function(**kwargs)
+        self.metrics.inc("slack_calls_total", method=method, status="ok" if response["ok"] else "ko")
+        return response
+
+    def _send_message(self, channel, thread, text, attachments=None):
+        response = self._timed("chat.postMessage", self.client.chat_postMessage,
+                               channel=channel, 
+                               thread_ts=thread,
+                               text=text,
+                               attachments=attachments)
         
         status = response["ok"]
         print("status: ", "OK" if status else "KO")
         return status
     
-    def send_image(self, channel, thread, image_url):
-        response = requests.get(image_url)
-        image_data = BytesIO(response.content)
-        response = self.client.files_upload(channels=channel, 
-                                            thread_ts=thread,
-                                            file=image_data)
+    def _post_message(self, channel, thread, text):
+        response = self._timed("chat.postMessage", self.client.chat_postMessage,
+                               channel=channel, 
+                               thread_ts=thread,
+                               text=text)
+        
+        status = response["ok"]
+        print("status: ", "OK" if status else "KO")
+        return response["ts"] if status else None
+
+    def _update_message(self, channel, ts, text, attachments=None):
+        response = self._timed("chat.update", self.client.chat_update,
+                               channel=channel,
+                               ts=ts,
+                               text=text,
+                               attachments=attachments)
+        return response["ok"]
+    
+    def _upload_url(self, channel, filename, length):
+        # Queued apart from the messages of the channel, the upload message waits in that queue for this call
+        return self.dispatcher.submit("files.getUploadURLExternal", (channel, "uploads"), self._get_upload_url, filename=filename, length=length).result()
+
+    def _get_upload_url(self, filename, length):
+        return self._timed("files.getUploadURLExternal", self.client.files_getUploadURLExternal, filename=filename, length=length)
+
+    def _upload_external(self, channel, image_url, filename):
+        # The image goes from the download to the upload a chunk at a time, without being held in memory.
+        # Runs on the upload threads, only the Slack API calls go through the dispatcher.
+        with self.session.get(image_url, stream=True) as download:
+            download.raise_for_status()
+            if "Content-Length" in download.headers:
+                length = int(download.headers["Content-Length"])
+                body = _StreamBody(download.raw, length, self.upload_chunk_size)
+            else:
+                body = download.content
+                length = len(body)
+
+            upload = self._upload_url(channel, filename, length)
+            response = self.session.post(upload["upload_url"], data=body)
+            response.raise_for_status()
+        return {"id": upload["file_id"], "title": filename}
+
+    def _complete_upload(self, channel, thread, uploads):
+        files = [upload.result() for upload in uploads] # Raises if an image could not be uploaded
+        response = self._timed("files.completeUploadExternal", self.client.files_completeUploadExternal,
+                               files=files, 
+                               channel_id=channel,
+                               thread_ts=thread)
+        
+        status = response["ok"]
+        print("status: ", "OK" if status else "KO")
+        return status
+
+
+class AsyncClientInterface(ClientInterface):
+    """
+    Slack client for the asyncio event loop. Sends are queued per channel and return a future, so synchronous
+    bot code can call them and coroutines can await the result.
+    """
+
+    def __init__(self, slack_token, transport : AsyncHttpTransport = None, max_retries : int = 3, upload_chunk_size : int = 64 * 1024, metrics : Metrics = None):
+        self.slack_token = slack_token
+        self.transport = transport if transport is not None else AsyncHttpTransport()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.client = AsyncWebClient(slack_token)
+        self.dispatcher = AsyncSlackDispatcher(max_retries=max_retries)
+        self.upload_chunk_size = upload_chunk_size
+
+    def get_id(self):
+        # Blocking, called once when the bot is created, which must happen off the event loop
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return WebClient(self.slack_token).auth_test()["user_id"]
+        raise RuntimeError("Create the bot before starting the event loop, or in an executor, its Slack id is fetched with a blocking call.")
+
+    def send_message(self, channel, thread, text, attachments=None):
+        return self.dispatcher.submit("chat.postMessage", channel, self._send_message, channel=channel, thread=thread, text=text, attachments=attachments)
+
+    def send_images(self, channel, thread, image_urls):
+        uploads = [asyncio.ensure_future(self._upload_external(channel, image_url, f"image_{i+1}.png")) for i, image_url in enumerate(image_urls)]
+        return self.dispatcher.submit("files.completeUploadExternal", channel, self._complete_upload, after=uploads, channel=channel, thread=thread, uploads=uploads)
+
+    async def post_message(self, channel, thread, text):
+        return await self.dispatcher.submit("chat.postMessage", channel, self._post_message, channel=channel, thread=thread, text=text)
+
+    def update_message(self, channel, ts, text, attachments=None):
+        return self.dispatcher.submit("chat.update", channel, self._update_message, coalesce_key=("chat.update", ts), channel=channel, ts=ts, text=text, attachments=attachments)
+
+    async def _call(self, method, function, **kwargs):
+        """
+        Await function(**kwargs), the dispatcher takes care of the rate limits and of the retries on 429
+        """
+        if self.client.session is None:
+            self.client.session = self.transport.get_session() # Created on the running event loop
+        with self.metrics.span("slack_post", method=method):
+            response = await function(**kwargs)
+        self.metrics.inc("slack_calls_total", method=method, status="ok" if response["ok"] else "ko")
+        return response
+
+    async def _post_message(self, channel, thread, text):
+        response = await self._call("chat.postMessage", self.client.chat_postMessage,
+                                    channel=channel, 
+                                    thread_ts=thread,
+                                    text=text)
+        
+        status = response["ok"]
+        print("status: ", "OK" if status else "KO")
+        return response["ts"] if status else None
+
+    async def _send_message(self, channel, thread, text, attachments=None):
+        response = await self._call("chat.postMessage", self.client.chat_postMessage,
+                                    channel=channel, 
+                                    thread_ts=thread,
+                                    text=text,
+                                    attachments=attachments)
+        
+        status = response["ok"]
+        print("status: ", "OK" if status else "KO")
+        return status
+
+    async def _update_message(self, channel, ts, text, attachments=None):
+        response = await self._call("chat.update", self.client.chat_update,
+                                    channel=channel,
+                                    ts=ts,
+                                    text=text,
+                                    attachments=attachments)
+        return response["ok"]
+
+    async def _upload_url(self, channel, filename, length):
+        return await self.dispatcher.submit("files.getUploadURLExternal", (channel, "uploads"), self._get_upload_url, filename=filename, length=length)
+
+    async def _get_upload_url(self, filename, length):
+        return await self._call("files.getUploadURLExternal", self.client.files_getUploadURLExternal, filename=filename, length=length)
+
+    async def _upload_external(self, channel, image_url, filename):
+        session = self.transport.get_session()
+        async with session.get(image_url) as download:
+            download.raise_for_status()
+            if download.content_length is not None:
+                length = download.content_length
+                body = download.content.iter_chunked(self.upload_chunk_size)
+            else:
+                body = await download.read()
+                length = len(body)
+
+            upload = await self._upload_url(channel, filename, length)
+            async with session.post(upload["upload_url"], data=body, headers={"Content-Length": str(length)}) as response:
+                response.raise_for_status()
+        return {"id": upload["file_id"], "title": filename}
+
+    async def _complete_upload(self, channel, thread, uploads):
+        files = await asyncio.gather(*uploads)
+        response = await self._call("files.completeUploadExternal", self.client.files_completeUploadExternal,
+                                    files=list(files),
+                                    channel_id=channel,
+                                    thread_ts=thread)
         
         status = response["ok"]
         print("status: ", "OK" if status else "KO")
@@ -38,10 +260,13 @@ class ClientInterface():
 
 
 class OpenaiInterface():
-    def __init__(self, openai_api_key):
+    def __init__(self, openai_api_key, cache_path : str = None, transport : HttpTransport = None, metrics : Metrics = None,
+                 request_timeout : float = 60.0, max_retries : int = 2, hedge : bool = False, fallback_engine : str = None, router : bool = False, router_log : str = None):
         self.openai_api_key = openai_api_key
+        self.metrics = metrics if metrics is not None else Metrics()
         openai.api_key = self.openai_api_key
-        self.assistant_name = ""
+        self.transport = transport if transport is not None else HttpTransport()
+        self.transport.use_for_openai()
 
         self.completion_engines = {
             "engines" : [
@@ -58,53 +283,87 @@ class OpenaiInterface():
                 "code-davinci-002",
                 "code-cushman-001",
             ],
-            "function": self._prompt_completion
+            "function": self._prompt_completion,
+            "stream_function": self._prompt_completion_stream
         }
         self.chat_engines = {
             "engines" : [
                 "gpt-3.5-turbo",
                 "gpt-3.5-turbo-0301"
             ],
-            "function": self._prompt_chat
+            "function": self._prompt_chat,
+            "stream_function": self._prompt_chat_stream
         }
         # self.code_engines = [
         #     "code-davinci-002",
         #     "code-cushman-001",
         # ]
 
+        self.image_sizes = ["256x256", "512x512", "1024x1024"]
+        self.max_tokens = 1024 # Tokens reserved for the reply
+        self.summary_engine = "gpt-3.5-turbo"
+        self.summary_max_tokens = 256
+        self.embedding_engine = "text-embedding-ada-002"
+        self.embedding_batch_size = 256 # Texts per embeddings call
+        self.default_context_size = 2049
+        self.context_sizes = {
+            "text-davinci-003": 4097,
+            "text-davinci-002": 4097,
+            "code-davinci-002": 8001,
+            "gpt-3.5-turbo": 4096,
+            "gpt-3.5-turbo-0301": 4096,
+        }
+
+        self.cache = ResponseCache(disk_path=cache_path)
+        self.single_flight = SingleFlight()
+
+        self.top_k_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="top_k")
+        self.top_k_timeout = 60.0 # Seconds a candidate may take
+        self.top_k_straggler_factor = 2.0 # Once a candidate is in, the others get this many times its latency to finish
+
+        # Every call has a deadline and is retried on API errors, an engine that keeps failing is skipped for a while
+        self.request_timeout = request_timeout # Seconds an attempt may take before it is abandoned
+        self.max_retries = max_retries
+        self.retry_base_delay = 0.5
+        self.retry_max_delay = 8.0
+        self.hedge = hedge # Send a duplicate request when the first one is slower than most
+        self.hedge_quantile = 0.95
+        if fallback_engine is not None and fallback_engine not in self.get_engines():
+            raise ValueError(f"Unknown fallback engine: {fallback_engine}")
+        self.fallback_engine = fallback_engine # Used while the breaker of the requested engine is open
+        self.breakers = {}
+        self.latencies = {}
+        self.call_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="openai")
+
+        # Optional per-request choice of engine, for the channels whose engine is auto
+        self.router = EngineRouter(self, log_path=router_log) if router else None
+
     def get_engines(self):
         return self.completion_engines["engines"] + self.chat_engines["engines"] # + self.code_engines
+
+    def get_context_size(self, engine):
+        return self.context_sizes.get(engine, self.default_context_size)
     
 
     def _text_preprocess(self, context, prompt):
-        str_context = [entry["message"] for entry in context]
-        
-        if type(prompt) is list and len(prompt) == 1:
-            str_prompt = [prompt[0]["message"]]
-        elif type(prompt) is list and len(prompt) == 2:
-            str_prompt = [prompt[0]["message"], prompt[1]["message"]]
-        else:
-            str_prompt = [prompt["message"]]
-
-        return "\n".join(str_context + str_prompt)
+        return "\n".join([message["content"] for message in context] + [message["content"] for message in prompt])
     
+    def _record_usage(self, response):
+        usage = response.get("usage")
+        if usage is not None:
+            self.metrics.inc("openai_tokens_total", usage.get("prompt_tokens", 0), engine=response.get("model"), type="prompt")
+            self.metrics.inc("openai_tokens_total", usage.get("completion_tokens", 0), engine=response.get("model"), type="completion")
+
     def _text_postprocess(self, response):
+        self._record_usage(response)
         return [resp.text for resp in response.choices]
     
     def _chat_preprocess(self, context, prompt):
-        messages = [{"role": ("user" if entry["user"] != self.assistant_name else "assistant"), "content": entry["message"]} for entry in context]
-        
-        if type(prompt) is list and len(prompt) == 1:
-            messages.append({"role": "user", "content": prompt[0]["message"]})
-        elif type(prompt) is list and len(prompt) == 2:
-            messages.append({"role": "user", "content": prompt[0]["message"]})
-            messages.append({"role": "assistant", "content": prompt[1]["message"]})
-        else:
-            messages.append({"role": "user", "content": prompt["message"]})
-
-        return messages
+        # context and prompt are lists of chat messages, built once per history entry by the bot
+        return context + prompt
     
     def _chat_postprocess(self, response):
+        self._record_usage(response)
         return [resp.message.content for resp in response.choices]
 
     def _postprocess(self, text):
@@ -112,25 +371,205 @@ class OpenaiInterface():
             return "<|endoftext|>"
         else:
             return text
+
+    def _request_key(self, prompt, context, engine, temperature):
+        # What is sent to the API, from the digests the history entries keep for their messages
+        return self.cache.make_key(engine, temperature, [message_digest(message) for message in itertools.chain(context, prompt)])
+
+    def _cache_stream(self, key, chunks, engine, answered):
+        # answered gets the engine that streamed the reply, a fallback reply is not what the engine would have said
+        reply = []
+        for chunk in chunks:
+            reply.append(chunk)
+            yield chunk
+        if answered == [engine]:
+            self.cache.put(key, self._postprocess("".join(reply)))
+
+    def _single_chunk(self, reply):
+        yield reply
+
+    def _cache_get(self, key, engine):
+        reply = self.cache.get(key)
+        self.metrics.inc("cache_hits_total" if reply is not None else "cache_misses_total", engine=engine)
+        return reply
         
 
-    def prompt_chat_gpt(self, prompt : Union[list, str], context : list = [], engine : str = "text-davinci-003", temperature : int = 0.5):
-        responses = None
-        if engine in self.chat_engines["engines"]:
-            responses = self.chat_engines["function"](prompt, context, engine, temperature)
-        else:
-            responses = self.completion_engines["function"](prompt, context, engine, temperature)
+    def prompt_chat_gpt(self, prompt : list, context : list = [], engine : str = "text-davinci-003", temperature : int = 0.5, use_cache : bool = False):
+        key = self._request_key(prompt, context, engine, temperature)
+        if use_cache:
+            reply = self._cache_get(key, engine)
+            if reply is not None:
+                return reply
+
+        # Identical concurrent requests share one API call
+        responses, used_engine = self.single_flight.do(key, self._call, prompt, context, engine, temperature)
         
-        return self._postprocess(responses[0])
+        reply = self._postprocess(responses[0])
+        if use_cache and used_engine == engine: # A fallback reply is not what the engine would have said
+            self.cache.put(key, reply)
+        return reply
 
-    def prompt_chat_gpt_top_k(self, prompt : Union[list, str], context : list = [], top_k : int = 1, engine : str = "text-davinci-003", temperature : int = 0.5):
-        responses = None
-        if engine in self.chat_engines["engines"]:
-            responses = self.chat_engines["function"](prompt, context, engine, temperature, n=top_k)
-        else:
-            responses = self.completion_engines["function"](prompt, context, engine, temperature, n=top_k)
+    def prompt_chat_gpt_top_k(self, prompt : list, context : list = [], top_k : int = 1, engine : str = "text-davinci-003", temperature : int = 0.5):
+        return list(self.prompt_chat_gpt_top_k_iter(prompt, context, top_k, engine, temperature))
+
+    def _top_k_deadline(self, start, deadline, first_done):
+        # The slowest candidates are dropped rather than holding back the ones already in
+        return min(deadline, first_done + self.top_k_straggler_factor * (first_done - start))
+
+    def _engine_function(self, engine, stream=False):
+        engines = self.chat_engines if engine in self.chat_engines["engines"] else self.completion_engines
+        return engines["stream_function" if stream else "function"]
+
+    def prompt_chat_gpt_top_k_iter(self, prompt : list, context : list = [], top_k : int = 1, engine : str = "text-davinci-003", temperature : int = 0.5):
+        """
+        Yield top_k candidate replies as they complete, each one is a separate concurrent request
+        """
+        start = time.monotonic()
+        deadline = start + self.top_k_timeout
+        pending = {self.top_k_executor.submit(self._call, prompt, context, engine, temperature, False) for _ in range(top_k)} # Stragglers are dropped, not hedged
+        first_done = None
+        try:
+            while len(pending) > 0:
+                done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    print("Dropping", len(pending), "top-K candidates past their deadline.")
+                    break
+                for future in done:
+                    try:
+                        responses, _ = future.result()
+                    except Exception as e:
+                        print("Top-K candidate failed:", e)
+                        continue
+                    if first_done is None:
+                        first_done = time.monotonic()
+                        deadline = self._top_k_deadline(start, deadline, first_done)
+                    yield self._postprocess(responses[0])
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def prompt_chat_gpt_stream(self, prompt : list, context : list = [], engine : str = "text-davinci-003", temperature : int = 0.5, use_cache : bool = False):
+        """
+        Yield the reply text chunk by chunk as the API streams it, a cached reply comes as one chunk
+        """
+        if use_cache:
+            key = self._request_key(prompt, context, engine, temperature)
+            reply = self._cache_get(key, engine)
+            if reply is not None:
+                return self._single_chunk(reply)
+
+        answered = []
+        chunks = self._stream(prompt, context, engine, temperature, answered)
+        return self._cache_stream(key, chunks, engine, answered) if use_cache else chunks
+
+
+    def _breaker(self, engine):
+        if engine not in self.breakers:
+            self.breakers[engine] = CircuitBreaker()
+        return self.breakers[engine]
+
+    def _latency(self, engine):
+        if engine not in self.latencies:
+            self.latencies[engine] = LatencyTracker()
+        return self.latencies[engine]
+
+    def _route(self, engine):
+        # The requested engine, or the fallback while the requested one is failing
+        if self._breaker(engine).allow():
+            return engine
+        if self.fallback_engine is not None and self.fallback_engine != engine and self._breaker(self.fallback_engine).allow():
+            self.metrics.inc("openai_fallbacks_total", engine=engine)
+            return self.fallback_engine
+        raise CircuitOpenError(f"{engine} is failing, calls are suspended for a while.")
 
-        return [self._postprocess(choice) for choice in responses]
+    def _record(self, engine, error=None, latency=None):
+        if error is not None and isinstance(error, retryable_errors):
+            self._breaker(engine).record_failure()
+            return
+        self._breaker(engine).record_success() # Rejected requests still show the API is up
+        if latency is not None:
+            self._latency(engine).add(latency)
+
+    def _hedge_delay(self, engine, hedge):
+        return self._latency(engine).percentile(self.hedge_quantile) if hedge else None
+
+    def _retry_delay(self, engine, attempt, error):
+        delay = backoff(attempt, self.retry_base_delay, self.retry_max_delay)
+        print(f"OpenAI call to {engine} failed ({type(error).__name__}: {error}), retrying in {delay:.1f}s.")
+        self.metrics.inc("openai_retries_total", engine=engine)
+        return delay
+
+    def _attempt(self, engine, hedge, prompt, context, temperature):
+        """
+        One call within the request timeout, with a duplicate sent if it is slower than the hedging delay
+        """
+        function = self._engine_function(engine)
+        start = time.monotonic()
+        deadline = start + self.request_timeout
+        hedge_at = self._hedge_delay(engine, hedge)
+        hedge_at = start + hedge_at if hedge_at is not None else None
+        pending = {self.call_executor.submit(function, prompt, context, engine, temperature)}
+        error = None
+        try:
+            while len(pending) > 0:
+                until = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, pending = wait(pending, timeout=max(0.0, until - time.monotonic()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        responses = future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self._record(engine, latency=time.monotonic() - start)
+                    return responses
+                if len(done) == 0:
+                    if hedge_at is None or time.monotonic() >= deadline:
+                        error = TimeoutError(f"No reply from {engine} after {self.request_timeout}s")
+                        break
+                    self.metrics.inc("openai_hedges_total", engine=engine)
+                    pending.add(self.call_executor.submit(function, prompt, context, engine, temperature))
+                    hedge_at = None
+        finally:
+            for future in pending:
+                future.cancel() # The calls already running are abandoned, their connection times out on its own
+        self._record(engine, error)
+        raise error
+
+    def _call(self, prompt, context, engine, temperature, hedge=None):
+        """
+        Call engine with retries on API errors, through its circuit breaker.
+        Returns the responses and the engine that answered, which is the fallback engine while the requested one is failing.
+        """
+        hedge = self.hedge if hedge is None else hedge
+        for attempt in range(self.max_retries + 1):
+            used_engine = self._route(engine)
+            try:
+                return self._attempt(used_engine, hedge, prompt, context, temperature), used_engine
+            except retryable_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(used_engine, attempt, e))
+
+    def _stream(self, prompt, context, engine, temperature, answered=None):
+        # Retried only until the first chunk, a reply cannot be taken back once it is shown.
+        # The engine that streams the reply is appended to answered.
+        for attempt in range(self.max_retries + 1):
+            used_engine = self._route(engine)
+            started = False
+            try:
+                for chunk in self._engine_function(used_engine, stream=True)(prompt, context, used_engine, temperature):
+                    if not started:
+                        started = True
+                        self._record(used_engine)
+                        if answered is not None:
+                            answered.append(used_engine)
+                    yield chunk
+                return
+            except retryable_errors as e:
+                self._record(used_engine, e)
+                if started or attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(used_engine, attempt, e))
     
     
     def _prompt_completion(self, prompt, context, engine, temperature, n=1):
@@ -138,10 +577,11 @@ class OpenaiInterface():
         responses = openai.Completion.create(
             engine=engine,
             prompt=prompt,
-            max_tokens=1024,
+            max_tokens=self.max_tokens,
             n=n,
             stop=None,
-            temperature=temperature)
+            temperature=temperature,
+            request_timeout=self.request_timeout)
         return self._text_postprocess(responses)
     
     def _prompt_chat(self, prompt, context, engine, temperature, n=1):
@@ -149,18 +589,275 @@ class OpenaiInterface():
         responses = openai.ChatCompletion.create(
             model=engine,
             messages=messages,
-            max_tokens=1024,
+            max_tokens=self.max_tokens,
             n=n,
             stop=None,
-            temperature=temperature)
+            temperature=temperature,
+            request_timeout=self.request_timeout)
         return self._chat_postprocess(responses)
+
+    def _prompt_completion_stream(self, prompt, context, engine, temperature):
+        prompt = self._text_preprocess(context, prompt)
+        responses = openai.Completion.create(
+            engine=engine,
+            prompt=prompt,
+            max_tokens=self.max_tokens,
+            stop=None,
+            temperature=temperature,
+            stream=True,
+            request_timeout=self.request_timeout)
+        for chunk in responses:
+            self.metrics.inc("openai_tokens_total", engine=engine, type="completion") # Streamed responses carry no usage, a chunk is about a token
+            yield chunk.choices[0].text
+
+    def _prompt_chat_stream(self, prompt, context, engine, temperature):
+        messages = self._chat_preprocess(context, prompt)
+        responses = openai.ChatCompletion.create(
+            model=engine,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            stop=None,
+            temperature=temperature,
+            stream=True,
+            request_timeout=self.request_timeout)
+        for chunk in responses:
+            self.metrics.inc("openai_tokens_total", engine=engine, type="completion")
+            yield chunk.choices[0].delta.get("content", "")
     
 
-    def prompt_dalle2(self, prompt):
+    def summarize(self, messages : list, previous_summary : str = None):
+        """
+        Condense messages, and the summary of what came before them, into a short summary.
+        Always blocking, it is meant to run in a background thread.
+        """
+        text = "\n".join(([f"Previous summary: {previous_summary}"] if previous_summary is not None else []) + messages)
+        responses = openai.ChatCompletion.create(
+            model=self.summary_engine,
+            messages=[
+                {"role": "system", "content": "Summarize the following conversation in a few sentences. Keep the facts, decisions and open questions, and merge in the previous summary if there is one."},
+                {"role": "user", "content": text}
+            ],
+            max_tokens=self.summary_max_tokens,
+            temperature=0,
+            request_timeout=self.request_timeout)
+        return self._chat_postprocess(responses)[0]
+
+    def embed(self, texts : list):
+        """
+        Embedding of each text, in as few calls as the batch size allows, with retries on API errors.
+        Always blocking, it is meant to run in a background thread.
+        """
+        vectors = []
+        for start in range(0, len(texts), self.embedding_batch_size):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = openai.Embedding.create(model=self.embedding_engine, input=texts[start:start + self.embedding_batch_size], request_timeout=self.request_timeout)
+                    break
+                except retryable_errors as e:
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self._retry_delay(self.embedding_engine, attempt, e))
+            self._record_usage(response)
+            vectors.extend(item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"]))
+        return vectors
+
+    def prompt_dalle2(self, prompt, n : int = 1, size : str = "256x256"):
         response = openai.Image.create(
             prompt=prompt,
-            n=1,
-            size="256x256"
+            n=n,
+            size=size
+        )
+        image_urls = [image['url'] for image in response['data']]
+        return image_urls
+
+
+class AsyncOpenaiInterface(OpenaiInterface):
+    """
+    OpenAI client for the asyncio event loop, every API call is awaitable
+    """
+
+    def __init__(self, openai_api_key, cache_path : str = None, transport : AsyncHttpTransport = None, metrics : Metrics = None,
+                 request_timeout : float = 60.0, max_retries : int = 2, hedge : bool = False, fallback_engine : str = None, router : bool = False, router_log : str = None):
+        super().__init__(openai_api_key, cache_path, metrics=metrics, request_timeout=request_timeout, max_retries=max_retries, hedge=hedge, fallback_engine=fallback_engine, router=router, router_log=router_log) # Keeps a pooled blocking transport for the background summaries
+        self.transport = transport if transport is not None else AsyncHttpTransport()
+        self.single_flight = AsyncSingleFlight()
+
+    async def prompt_chat_gpt(self, prompt : list, context : list = [], engine : str = "text-davinci-003", temperature : int = 0.5, use_cache : bool = False):
+        key = self._request_key(prompt, context, engine, temperature)
+        if use_cache:
+            reply = self._cache_get(key, engine)
+            if reply is not None:
+                return reply
+
+        # Identical concurrent requests share one API call
+        responses, used_engine = await self.single_flight.do(key, self._call, prompt, context, engine, temperature)
+        
+        reply = self._postprocess(responses[0])
+        if use_cache and used_engine == engine:
+            self.cache.put(key, reply)
+        return reply
+
+    async def prompt_chat_gpt_top_k(self, prompt : list, context : list = [], top_k : int = 1, engine : str = "text-davinci-003", temperature : int = 0.5):
+        return [reply async for reply in self.prompt_chat_gpt_top_k_iter(prompt, context, top_k, engine, temperature)]
+
+    async def prompt_chat_gpt_top_k_iter(self, prompt : list, context : list = [], top_k : int = 1, engine : str = "text-davinci-003", temperature : int = 0.5):
+        start = time.monotonic()
+        deadline = start + self.top_k_timeout
+        pending = {asyncio.ensure_future(self._call(prompt, context, engine, temperature, False)) for _ in range(top_k)}
+        first_done = None
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    print("Dropping", len(pending), "top-K candidates past their deadline.")
+                    break
+                for task in done:
+                    if task.exception() is not None:
+                        print("Top-K candidate failed:", task.exception())
+                        continue
+                    if first_done is None:
+                        first_done = time.monotonic()
+                        deadline = self._top_k_deadline(start, deadline, first_done)
+                    responses, _ = task.result()
+                    yield self._postprocess(responses[0])
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _cache_stream(self, key, chunks, engine, answered):
+        reply = []
+        async for chunk in chunks:
+            reply.append(chunk)
+            yield chunk
+        if answered == [engine]:
+            self.cache.put(key, self._postprocess("".join(reply)))
+
+    async def _single_chunk(self, reply):
+        yield reply
+
+    async def _attempt(self, engine, hedge, prompt, context, temperature):
+        function = self._engine_function(engine)
+        start = time.monotonic()
+        deadline = start + self.request_timeout
+        hedge_at = self._hedge_delay(engine, hedge)
+        hedge_at = start + hedge_at if hedge_at is not None else None
+        pending = {asyncio.ensure_future(function(prompt, context, engine, temperature))}
+        error = None
+        try:
+            while len(pending) > 0:
+                until = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    self._record(engine, latency=time.monotonic() - start)
+                    return task.result()
+                if len(done) == 0:
+                    if hedge_at is None or time.monotonic() >= deadline:
+                        error = asyncio.TimeoutError(f"No reply from {engine} after {self.request_timeout}s")
+                        break
+                    self.metrics.inc("openai_hedges_total", engine=engine)
+                    pending.add(asyncio.ensure_future(function(prompt, context, engine, temperature)))
+                    hedge_at = None
+        finally:
+            for task in pending:
+                task.cancel()
+        self._record(engine, error)
+        raise error
+
+    async def _call(self, prompt, context, engine, temperature, hedge=None):
+        hedge = self.hedge if hedge is None else hedge
+        for attempt in range(self.max_retries + 1):
+            used_engine = self._route(engine)
+            try:
+                return await self._attempt(used_engine, hedge, prompt, context, temperature), used_engine
+            except retryable_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(used_engine, attempt, e))
+
+    async def _stream(self, prompt, context, engine, temperature, answered=None):
+        for attempt in range(self.max_retries + 1):
+            used_engine = self._route(engine)
+            started = False
+            try:
+                async for chunk in self._engine_function(used_engine, stream=True)(prompt, context, used_engine, temperature):
+                    if not started:
+                        started = True
+                        self._record(used_engine)
+                        if answered is not None:
+                            answered.append(used_engine)
+                    yield chunk
+                return
+            except retryable_errors as e:
+                self._record(used_engine, e)
+                if started or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(used_engine, attempt, e))
+
+    async def _prompt_completion_stream(self, prompt, context, engine, temperature):
+        self.transport.use_for_openai()
+        prompt = self._text_preprocess(context, prompt)
+        responses = await openai.Completion.acreate(
+            engine=engine,
+            prompt=prompt,
+            max_tokens=self.max_tokens,
+            stop=None,
+            temperature=temperature,
+            stream=True,
+            request_timeout=self.request_timeout)
+        async for chunk in responses:
+            self.metrics.inc("openai_tokens_total", engine=engine, type="completion") # Streamed responses carry no usage, a chunk is about a token
+            yield chunk.choices[0].text
+
+    async def _prompt_chat_stream(self, prompt, context, engine, temperature):
+        self.transport.use_for_openai()
+        messages = self._chat_preprocess(context, prompt)
+        responses = await openai.ChatCompletion.acreate(
+            model=engine,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            stop=None,
+            temperature=temperature,
+            stream=True,
+            request_timeout=self.request_timeout)
+        async for chunk in responses:
+            self.metrics.inc("openai_tokens_total", engine=engine, type="completion")
+            yield chunk.choices[0].delta.get("content", "")
+
+    async def _prompt_completion(self, prompt, context, engine, temperature, n=1):
+        self.transport.use_for_openai()
+        prompt = self._text_preprocess(context, prompt)
+        responses = await openai.Completion.acreate(
+            engine=engine,
+            prompt=prompt,
+            max_tokens=self.max_tokens,
+            n=n,
+            stop=None,
+            temperature=temperature,
+            request_timeout=self.request_timeout)
+        return self._text_postprocess(responses)
+    
+    async def _prompt_chat(self, prompt, context, engine, temperature, n=1):
+        self.transport.use_for_openai()
+        messages = self._chat_preprocess(context, prompt)
+        responses = await openai.ChatCompletion.acreate(
+            model=engine,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            n=n,
+            stop=None,
+            temperature=temperature,
+            request_timeout=self.request_timeout)
+        return self._chat_postprocess(responses)
+
+    async def prompt_dalle2(self, prompt, n : int = 1, size : str = "256x256"):
+        self.transport.use_for_openai()
+        response = await openai.Image.acreate(
+            prompt=prompt,
+            n=n,
+            size=size
         )
-        image_url = response['data'][0]['url']
-        return image_url
\ No newline at end of file
+        image_urls = [image['url'] for image in response['data']]
+        return image_urls
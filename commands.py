@@ -0,0 +1,133 @@
+import re
+import math
+
+
+# Optional mention and slash command, in any order, then the message. Any text matches, without prefix the whole text is the message
+command_regex = re.compile(r"^\s*(?:<@(?P<mention>[^>]*)>(?:\s*/(?P<mode>\w+))?|/(?P<mode_first>\w+)(?:\s*<@(?P<mention_last>[^>]*)>)?)?(?P<message>.*)$", re.DOTALL)
+
+
+def parse_command(text : str):
+    """
+    Mode and message of the text of a mention, in a single match. The mode is None if the text has no slash command.
+    """
+    match = command_regex.match(text)
+    return match.group("mode") or match.group("mode_first"), match.group("message")
+
+
+def boolean(value : str):
+    value = value.lower()
+    if value in ["true", "yes", "on", "1"]:
+        return True
+    if value in ["false", "no", "off", "0"]:
+        return False
+    raise ValueError(value)
+
+
+class ArgumentError(ValueError):
+    """
+    Raised when an argument of a command cannot be converted to its type
+    """
+
+    expected = {
+        int: "an integer",
+        float: "a finite number",
+        boolean: "true, yes, on, 1, false, no, off or 0",
+    }
+
+    def __init__(self, command : str, value : str, value_type):
+        self.command = command
+        self.value = value
+        self.value_type = value_type
+        super().__init__(f"Invalid value {value} for {command}, expected {self.expected.get(value_type, 'a valid value')}.")
+
+
+class Command():
+    """
+    Entry of a command table: the function called, the types its arguments are converted to, and its help line
+    """
+
+    __slots__ = ("name", "function", "arg_types", "help", "fast")
+
+    def __init__(self, name : str, function, arg_types : tuple = (), help : str = "", fast : bool = False):
+        self.name = name
+        self.function = function
+        self.arg_types = arg_types # Arguments past these are passed as strings
+        self.help = help
+        self.fast = fast # Cheap enough to skip the per-thread queue
+
+    def convert(self, params : list):
+        args = []
+        for i, param in enumerate(params):
+            value_type = self.arg_types[i] if i < len(self.arg_types) else str
+            try:
+                value = value_type(param)
+            except ValueError:
+                raise ArgumentError(self.name, param, value_type)
+            if isinstance(value, float) and not math.isfinite(value): # float() accepts nan and inf, which pass every range check
+                raise ArgumentError(self.name, param, value_type)
+            args.append(value)
+        return args
+
+
+class CommandTable():
+    """
+    Commands by name, for the modes of the bot and the admin subcommands.
+    Plugins add their modes with register_mode(), the bot registers them along with its own.
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name : str, function, arg_types : tuple = (), help : str = "", fast : bool = False):
+        self.commands[name] = Command(name, function, arg_types, help, fast)
+
+    def unregister(self, name : str):
+        self.commands.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def __getitem__(self, name):
+        return self.commands[name].function
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def get(self, name : str):
+        return self.commands.get(name)
+
+    def fast_modes(self):
+        return [command.name for command in self if command.fast]
+
+    def help(self):
+        return "".join(f"{command.name}: {command.help} \n" for command in self).rstrip(" \n")
+
+    def parse(self, text : str):
+        """
+        Command named by the first word of the text and its arguments converted to their types,
+        the command is None if the name is not in the table. Raises ArgumentError on an invalid argument.
+        """
+        name, *params = text.split() or [None]
+        command = self.commands.get(name)
+        if command is None:
+            return None, params
+        return command, command.convert(params)
+
+
+# Modes added by plugins, registered in each bot when it is created
+plugin_modes = CommandTable()
+
+def register_mode(name : str, help : str = "", fast : bool = False):
+    """
+    Decorator adding a mode to the bots created from now on, e.g. in a module given to --plugins:
+
+        @register_mode("echo", help="Repeat the message.", fast=True)
+        def echo(bot, channel, thread, message, user):
+            bot.client.send_message(channel, thread, message)
+
+    The function may be a coroutine function for the async bot.
+    """
+    def decorator(function):
+        plugin_modes.register(name, function, help=help, fast=fast)
+        return function
+    return decorator
@@ -0,0 +1,64 @@
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from history_entry import HistoryEntry
+
+
+class ContextBuilder():
+    """
+    Trims a thread history to a token budget, token counts are cached on the history entries
+    """
+
+    def __init__(self, message_overhead : int = 4):
+        self.message_overhead = message_overhead # Tokens added by the chat format around each message
+        self.encodings = {}
+
+    def _get_encoding(self, engine):
+        if engine not in self.encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    encoding = tiktoken.encoding_for_model(engine)
+                except Exception as e: # Unknown engine, or the encoding files cannot be downloaded
+                    print("Using approximate token counts for", engine, ":", e)
+            self.encodings[engine] = encoding
+        return self.encodings[engine]
+
+    def _encoding_name(self, engine):
+        encoding = self._get_encoding(engine)
+        return encoding.name if encoding is not None else "approximate"
+
+    def count_tokens(self, text : str, engine : str):
+        encoding = self._get_encoding(engine)
+        if encoding is None:
+            return len(text) // 4 + 1
+        return len(encoding.encode(text))
+
+    def entry_tokens(self, entry : HistoryEntry, engine : str):
+        """
+        Token count of a history entry, computed once per encoding
+        """
+        if entry.tokens is None:
+            entry.tokens = {}
+        encoding_name = self._encoding_name(engine)
+        if encoding_name not in entry.tokens:
+            entry.tokens[encoding_name] = self.count_tokens(entry.message, engine)
+        return entry.tokens[encoding_name]
+
+    def build(self, history : list, engine : str, budget : int, start : int = 0, end : int = None, extra_overhead : int = 0):
+        """
+        Return the most recent entries of history[start:end] that fit in the budget
+        """
+        first = start
+        end = len(history) if end is None else end
+        start = end
+        used = 0
+        while start > first:
+            tokens = self.entry_tokens(history[start - 1], engine) + self.message_overhead + extra_overhead
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        return history[start:end]
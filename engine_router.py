@@ -0,0 +1,162 @@
+import json
+import time
+import threading
+
+
+class Route():
+    """
+    Engine picked for one request, with what the choice was based on
+    """
+
+    def __init__(self, engine : str, channel : str = None, weight : str = None, prompt_tokens : int = 0, context_tokens : int = 0, reason : str = "fixed", estimated_cost : float = 0.0):
+        self.engine = engine
+        self.channel = channel
+        self.weight = weight
+        self.prompt_tokens = prompt_tokens
+        self.context_tokens = context_tokens
+        self.reason = reason
+        self.estimated_cost = estimated_cost
+        self.start = time.monotonic()
+
+    @property
+    def routed(self):
+        return self.weight is not None
+
+
+class EngineRouter():
+    """
+    Picks the engine of each request from the size of its prompt and context, the latency observed for
+    each engine and the daily budget of the channel. Light requests go to fast cheap engines, heavy ones
+    to the big model. Every decision is logged with its measured latency, for tuning the thresholds.
+    """
+
+    # USD per 1K tokens, prompt and reply alike
+    prices = {
+        "gpt-3.5-turbo": 0.002,
+        "gpt-3.5-turbo-0301": 0.002,
+        "text-davinci-003": 0.02,
+        "text-davinci-002": 0.02,
+        "text-curie-001": 0.002,
+        "text-babbage-001": 0.0005,
+        "text-ada-001": 0.0004,
+    }
+
+    # Median latency in seconds assumed until enough calls were observed
+    expected_latency = {
+        "gpt-3.5-turbo": 3.0,
+        "gpt-3.5-turbo-0301": 3.0,
+        "text-davinci-003": 8.0,
+        "text-davinci-002": 8.0,
+        "text-curie-001": 1.5,
+        "text-babbage-001": 1.0,
+        "text-ada-001": 0.8,
+    }
+
+    # Engines of each weight class in order of preference, and the median latency each class accepts
+    classes = {
+        "light": (["text-curie-001", "gpt-3.5-turbo", "text-babbage-001"], 2.0),
+        "standard": (["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "text-davinci-003"], 10.0),
+        "heavy": (["text-davinci-003", "gpt-3.5-turbo"], 30.0),
+    }
+
+    def __init__(self, openai_client, log_path : str = None, light_tokens : int = 64, heavy_tokens : int = 1500, expected_reply_tokens : int = 256):
+        self.openai_client = openai_client
+        self.log_path = log_path # JSON line per decision, printed only if not set
+        self.light_tokens = light_tokens # Prompt and context up to this size are light
+        self.heavy_tokens = heavy_tokens # From this size on they are heavy
+        self.expected_reply_tokens = expected_reply_tokens
+        self.context_engine = "gpt-3.5-turbo" # Sets the context window and token counts before an engine is picked
+
+        self.spent = {} # channel -> (day, USD)
+        self.decisions = {} # engine -> count
+        self.lock = threading.Lock()
+
+    def _weight(self, prompt_tokens, context_tokens):
+        tokens = prompt_tokens + context_tokens
+        if tokens <= self.light_tokens:
+            return "light"
+        if tokens >= self.heavy_tokens or prompt_tokens >= self.heavy_tokens // 2:
+            return "heavy"
+        return "standard"
+
+    def _latency(self, engine):
+        tracker = self.openai_client.latencies.get(engine)
+        observed = tracker.percentile(0.5) if tracker is not None else None
+        return observed if observed is not None else self.expected_latency.get(engine, 5.0)
+
+    def _healthy(self, engine):
+        breaker = self.openai_client.breakers.get(engine)
+        return breaker is None or breaker.state != "open"
+
+    def _fits(self, engine, tokens):
+        return tokens + self.openai_client.max_tokens <= self.openai_client.get_context_size(engine)
+
+    def _cost(self, engine, tokens):
+        return (tokens + self.expected_reply_tokens) / 1000 * self.prices[engine]
+
+    def remaining(self, channel, budget):
+        if budget is None:
+            return None
+        with self.lock:
+            day, spent = self.spent.get(channel, (None, 0.0))
+        return budget - (spent if day == time.strftime("%Y-%m-%d") else 0.0)
+
+    def route(self, channel : str, prompt_tokens : int, context_tokens : int, budget : float = None):
+        """
+        Route of a request, budget is in USD per day for the channel (None for no limit)
+        """
+        tokens = prompt_tokens + context_tokens
+        weight = self._weight(prompt_tokens, context_tokens)
+        remaining = self.remaining(channel, budget)
+
+        engines = [engine for engine in self.openai_client.get_engines() if engine in self.prices and self._fits(engine, tokens) and self._healthy(engine)]
+        affordable = [engine for engine in engines if remaining is None or self._cost(engine, tokens) <= remaining]
+        preferred, max_latency = self.classes[weight]
+        candidates = [engine for engine in preferred if engine in affordable]
+
+        if len(candidates) > 0:
+            fast = [engine for engine in candidates if self._latency(engine) <= max_latency]
+            if len(fast) > 0:
+                engine, reason = fast[0], "preferred"
+            else:
+                engine, reason = min(candidates, key=self._latency), "fastest of its class"
+        elif len(affordable) > 0:
+            engine, reason = min(affordable, key=lambda engine: (self._cost(engine, tokens), self._latency(engine))), "cheapest within budget"
+        elif len(engines) > 0:
+            engine, reason = min(engines, key=lambda engine: self._cost(engine, tokens)), "cheapest, budget spent"
+        else:
+            engine, reason = self.context_engine, "no engine fits, default"
+
+        with self.lock:
+            self.decisions[engine] = self.decisions.get(engine, 0) + 1
+        return Route(engine, channel, weight, prompt_tokens, context_tokens, reason, self._cost(engine, tokens) if engine in self.prices else 0.0)
+
+    def record(self, route : Route, reply_tokens : int = 0, error : Exception = None):
+        """
+        Log a routed request once it is done, and charge its cost to the channel
+        """
+        if not route.routed:
+            return
+        latency = time.monotonic() - route.start
+        cost = (route.prompt_tokens + route.context_tokens + reply_tokens) / 1000 * self.prices.get(route.engine, 0.0)
+        day = time.strftime("%Y-%m-%d")
+        with self.lock:
+            spent_day, spent = self.spent.get(route.channel, (day, 0.0))
+            self.spent[route.channel] = (day, (spent if spent_day == day else 0.0) + cost)
+
+        decision = {
+            "time": time.time(), "channel": route.channel, "weight": route.weight, "engine": route.engine, "reason": route.reason,
+            "prompt_tokens": route.prompt_tokens, "context_tokens": route.context_tokens, "reply_tokens": reply_tokens,
+            "latency": round(latency, 3), "cost": round(cost, 6), "error": None if error is None else type(error).__name__,
+        }
+        if self.log_path is None:
+            print("Routed {weight} request to {engine} ({reason}): {latency}s, ${cost}".format(**decision))
+            return
+        with self.lock, open(self.log_path, "a") as f:
+            f.write(json.dumps(decision) + "\n")
+
+    def stats(self):
+        with self.lock:
+            day = time.strftime("%Y-%m-%d")
+            spent = sum(value for spent_day, value in self.spent.values() if spent_day == day)
+            return {**self.decisions, "spent_today": spent}
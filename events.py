@@ -0,0 +1,148 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import KeyedScheduler, AsyncKeyedScheduler
+from admission import AdmissionController
+from commands import parse_command
+
+
+def parse_message_event(body):
+    channel = body["event"]["channel"]
+    thread = body["event"]["ts"] if "thread_ts" not in body["event"] else body["event"]["thread_ts"]
+    user = body["event"]["user"]
+
+    mode, message = parse_command(body["event"]["text"])
+
+    return channel, thread, message, user, mode
+
+def parse_top_k_callback(body):
+    channel = body["channel"]["id"]
+    thread = body["original_message"]["thread_ts"]
+    message = body["actions"][0]["value"]
+
+    return channel, thread, message
+
+def event_channel(kind, body):
+    """
+    Channel an app_mention or top_k_callback event belongs to
+    """
+    return body["event"]["channel"] if kind == "app_mention" else body["channel"]["id"]
+
+
+class EventDispatcher():
+    """
+    Hands Slack events to the bot, through the admission controller and the per-thread scheduler
+    """
+
+    def __init__(self, bot, async_mode : bool = False, workers : int = None, max_pending_per_thread : int = 5, max_in_flight : int = 64, max_in_flight_per_channel : int = 16, max_queue_wait : float = 30.0):
+        self.bot = bot
+        self.async_mode = async_mode
+
+        # Messages of one thread are handled in order, different threads in parallel
+        if async_mode:
+            self.scheduler = AsyncKeyedScheduler(max_workers=workers or 64, max_pending_per_key=max_pending_per_thread)
+        else:
+            self.scheduler = KeyedScheduler(max_workers=workers or 8, max_pending_per_key=max_pending_per_thread)
+
+        # Requests past the global or per-channel limits, or that waited too long, get a busy reply instead of piling up
+        self.admission = AdmissionController(max_in_flight=max_in_flight, max_in_flight_per_channel=max_in_flight_per_channel, max_queue_wait=max_queue_wait, fast_modes=bot.modes.fast_modes())
+        self.fast_lane = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fast_lane")
+        self.fast_tasks = set() # Fast modes running on the event loop, in async mode
+
+        self.bot.metrics.gauge("in_flight", lambda: self.admission.stats()["in_flight"], "Requests admitted and not finished yet")
+        self.bot.metrics.gauge("scheduled", self.scheduler.pending, "Jobs waiting in the per-thread queues")
+
+    def schedule(self, function, channel, thread, *args):
+        if not self.scheduler.submit((channel, thread), function, channel, thread, *args):
+            self.bot.busy(channel, thread)
+
+    def dispatch_message(self, channel, thread, message, user, mode):
+        if self.admission.is_fast(mode): # Cheap modes never wait behind prompts
+            if self.async_mode:
+                task = asyncio.ensure_future(self.bot.receive_message(channel, thread, message, user, mode))
+                self.fast_tasks.add(task)
+                task.add_done_callback(self.fast_tasks.discard)
+            else:
+                self.fast_lane.submit(self.bot.receive_message, channel, thread, message, user, mode)
+            return
+
+        ticket = self.admission.try_admit(channel)
+        if ticket is None:
+            self.bot.busy(channel, thread)
+            return
+
+        run = self.admission.run_async if self.async_mode else self.admission.run
+        on_expired = lambda: self.bot.busy(channel, thread)
+        self.admission.watch(ticket, on_expired, self.async_mode) # The busy reply goes out at the deadline, not when the job reaches the head of its queue
+        if not self.scheduler.submit((channel, thread), run, ticket, on_expired, self.bot.receive_message, channel, thread, message, user, mode):
+            self.admission.release(ticket)
+            self.bot.busy(channel, thread)
+
+    def handle(self, kind, body):
+        self.bot.metrics.inc("events_total", kind=kind)
+        if kind == "app_mention":
+            with self.bot.metrics.span("parse"):
+                event = parse_message_event(body)
+            self.dispatch_message(*event)
+        elif kind == "top_k_callback":
+            self.schedule(self.bot.top_k_callback, *parse_top_k_callback(body))
+
+    def idle(self):
+        # Replies queued in the Slack dispatcher count too, its workers do not outlive the process
+        return (self.admission.stats()["in_flight"] == 0 and self.scheduler.pending() == 0 and len(self.fast_tasks) == 0
+                and self.bot.client.dispatcher.stats()["queued"] == 0)
+
+    def drain(self, timeout : float = 60.0):
+        """
+        Wait for the admitted requests to finish and their replies to be sent, returns False if some are still pending after timeout
+        """
+        deadline = time.monotonic() + timeout
+        while not self.idle() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.fast_lane.shutdown(wait=True)
+        while not self.idle() and time.monotonic() < deadline: # Replies of the fast modes that were still running
+            time.sleep(0.1)
+        return self.idle()
+
+    async def drain_async(self, timeout : float = 60.0):
+        deadline = time.monotonic() + timeout
+        while not self.idle() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return self.idle()
+
+
+class BootDispatcher():
+    """
+    Takes the events received while the bot is still starting in the background, and hands them
+    over in order to the EventDispatcher once it is attached
+    """
+
+    def __init__(self):
+        self.dispatcher = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.dispatcher is not None
+
+    def handle(self, kind, body):
+        with self.lock:
+            if self.dispatcher is None:
+                self.pending.append((kind, body))
+                return
+        self.dispatcher.handle(kind, body)
+
+    def attach(self, dispatcher : EventDispatcher):
+        """
+        Start handing events to dispatcher, call it on the event loop in async mode
+        """
+        with self.lock: # Events arriving meanwhile wait, so none overtakes the queued ones
+            for kind, body in self.pending:
+                dispatcher.handle(kind, body)
+            if len(self.pending) > 0:
+                print(f"Handled {len(self.pending)} events received during startup.")
+            self.pending = []
+            self.dispatcher = dispatcher
@@ -0,0 +1,308 @@
+import math
+import time
+import zlib
+import random
+import asyncio
+import threading
+
+import openai
+from slack_sdk import WebClient
+from slack_sdk.web import SlackResponse
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.errors import SlackApiError
+
+from client_interface import ClientInterface, OpenaiInterface, AsyncClientInterface, AsyncOpenaiInterface
+from slack_dispatcher import RateLimit
+from metrics import Metrics
+
+
+class LatencyModel():
+    """
+    Random latency in seconds, distribution is one of fixed, normal, lognormal or exponential
+    """
+
+    def __init__(self, mean : float, stddev : float = 0.0, distribution : str = "lognormal"):
+        self.mean = mean
+        self.stddev = stddev
+        self.distribution = distribution
+
+    def sample(self):
+        if self.mean <= 0:
+            return 0.0
+        if self.distribution == "fixed" or self.stddev <= 0:
+            return self.mean
+        if self.distribution == "normal":
+            return max(0.0, random.gauss(self.mean, self.stddev))
+        if self.distribution == "exponential":
+            return random.expovariate(1 / self.mean)
+        # Lognormal with the requested mean and standard deviation, long tail like real API latencies
+        sigma2 = math.log(1 + (self.stddev / self.mean) ** 2)
+        return random.lognormvariate(math.log(self.mean) - sigma2 / 2, math.sqrt(sigma2))
+
+
+class _FakeSlack():
+    """
+    State shared by the sync and async fake Web API clients: latency, rate limits and a record of every write
+    """
+
+    def __init__(self, latency : LatencyModel, rate_limit : float = 0, user_id : str = "B0"):
+        self.latency = latency
+        self.rate_limit = rate_limit # Calls per minute and method before answering 429, 0 for no limit
+        self.user_id = user_id
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.messages = [] # (time, method, channel, thread, text)
+        self.rate_limited = 0
+        self.next_ts = 0
+
+    def _check_limit(self, client, method):
+        if self.rate_limit <= 0:
+            return
+        with self.lock:
+            limit = self.limits.setdefault(method, RateLimit(self.rate_limit / 60, max(1, int(self.rate_limit / 60))))
+            delay = limit.delay()
+            if delay <= 0:
+                limit.take()
+                return
+            self.rate_limited += 1
+        response = SlackResponse(client=client, http_verb="POST", api_url=method, req_args={}, data={"ok": False, "error": "ratelimited"}, headers={"Retry-After": str(max(1, round(delay)))}, status_code=429)
+        raise SlackApiError("ratelimited", response)
+
+    def _respond(self, client, method, channel=None, thread=None, text=None, **data):
+        self._check_limit(client, method)
+        with self.lock:
+            self.next_ts += 1
+            ts = f"{int(time.time())}.{self.next_ts:06d}"
+            if channel is not None:
+                self.messages.append((time.monotonic(), method, channel, thread, text))
+        return SlackResponse(client=client, http_verb="POST", api_url=method, req_args={}, data={"ok": True, "ts": ts, "channel": channel, **data}, headers={}, status_code=200)
+
+
+class FakeWebClient(WebClient):
+    """
+    WebClient answering locally after a simulated latency, with Slack's 429 behaviour past the rate limit
+    """
+
+    def __init__(self, slack : _FakeSlack):
+        super().__init__(token="xoxb-fake")
+        self.slack = slack
+
+    def _call(self, method, **kwargs):
+        time.sleep(self.slack.latency.sample())
+        return self.slack._respond(self, method, **kwargs)
+
+    def auth_test(self, **kwargs):
+        return self._call("auth.test", user_id=self.slack.user_id, bot_id=self.slack.user_id, team_id="T0")
+
+    def chat_postMessage(self, *, channel, thread_ts=None, text=None, **kwargs):
+        return self._call("chat.postMessage", channel=channel, thread=thread_ts, text=text)
+
+    def chat_update(self, *, channel, ts, text=None, **kwargs):
+        return self._call("chat.update", channel=channel, thread=ts, text=text)
+
+    def files_getUploadURLExternal(self, *, filename, length, **kwargs):
+        return self._call("files.getUploadURLExternal", upload_url="http://localhost/upload", file_id=f"F{filename}")
+
+    def files_completeUploadExternal(self, *, files, channel_id=None, thread_ts=None, **kwargs):
+        return self._call("files.completeUploadExternal", channel=channel_id, thread=thread_ts, text=f"{len(files)} files")
+
+
+class FakeAsyncWebClient(AsyncWebClient):
+
+    def __init__(self, slack : _FakeSlack):
+        super().__init__(token="xoxb-fake")
+        self.slack = slack
+
+    async def _call(self, method, **kwargs):
+        await asyncio.sleep(self.slack.latency.sample())
+        return self.slack._respond(self, method, **kwargs)
+
+    async def auth_test(self, **kwargs):
+        return await self._call("auth.test", user_id=self.slack.user_id, bot_id=self.slack.user_id, team_id="T0")
+
+    async def chat_postMessage(self, *, channel, thread_ts=None, text=None, **kwargs):
+        return await self._call("chat.postMessage", channel=channel, thread=thread_ts, text=text)
+
+    async def chat_update(self, *, channel, ts, text=None, **kwargs):
+        return await self._call("chat.update", channel=channel, thread=ts, text=text)
+
+    async def files_getUploadURLExternal(self, *, filename, length, **kwargs):
+        return await self._call("files.getUploadURLExternal", upload_url="http://localhost/upload", file_id=f"F{filename}")
+
+    async def files_completeUploadExternal(self, *, files, channel_id=None, thread_ts=None, **kwargs):
+        return await self._call("files.completeUploadExternal", channel=channel_id, thread=thread_ts, text=f"{len(files)} files")
+
+
+class FakeClientInterface(ClientInterface):
+    """
+    ClientInterface on a FakeWebClient, messages still go through the real dispatcher
+    """
+
+    def __init__(self, latency : LatencyModel = LatencyModel(0.05, 0.02), rate_limit : float = 0, upload_workers : int = 4, metrics : Metrics = None):
+        super().__init__("xoxb-fake", upload_workers=upload_workers, metrics=metrics)
+        self.slack = _FakeSlack(latency, rate_limit)
+        self.client = FakeWebClient(self.slack)
+
+    def _upload_external(self, channel, image_url, filename):
+        upload = self._upload_url(channel, filename, 0)
+        time.sleep(self.slack.latency.sample()) # Download and upload of the image
+        return {"id": upload["file_id"], "title": filename}
+
+
+class FakeAsyncClientInterface(AsyncClientInterface):
+
+    def __init__(self, latency : LatencyModel = LatencyModel(0.05, 0.02), rate_limit : float = 0, metrics : Metrics = None):
+        super().__init__("xoxb-fake", metrics=metrics)
+        self.slack = _FakeSlack(latency, rate_limit)
+        self.client = FakeAsyncWebClient(self.slack)
+
+    def get_id(self):
+        return self.slack.user_id
+
+    async def _upload_external(self, channel, image_url, filename):
+        upload = await self._upload_url(channel, filename, 0)
+        await asyncio.sleep(self.slack.latency.sample())
+        return {"id": upload["file_id"], "title": filename}
+
+
+class _FakeOpenai():
+    """
+    Replies of the fake OpenAI interfaces: a latency per request, streamed in chunks, and an optional error rate
+    """
+
+    def __init__(self, latency : LatencyModel, error_rate : float = 0.0, reply_words : int = 40, chunks : int = 10):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.chunks = chunks
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.requests += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return None
+        return self.latency.sample()
+
+    def reply(self, messages):
+        last = messages[-1]["content"] if type(messages) is list else messages.split("\n")[-1]
+        return " ".join(["reply"] + last.split()[:5] + ["lorem"] * max(0, self.reply_words - 6))
+
+    def embedding(self, text, dimensions : int = 64):
+        # Hashed bag of words, texts sharing words end up close to each other
+        vector = [0.0] * dimensions
+        for word in text.lower().split():
+            vector[zlib.crc32(word.strip(".,;:!?").encode("utf-8")) % dimensions] += 1.0
+        return vector
+
+    def split(self, reply):
+        words = reply.split(" ")
+        size = max(1, len(words) // self.chunks)
+        return [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+
+
+class FakeOpenaiInterface(OpenaiInterface):
+    """
+    OpenaiInterface answering locally after a simulated latency, the cache and request coalescing stay real
+    """
+
+    def __init__(self, latency : LatencyModel = LatencyModel(1.0, 0.5), error_rate : float = 0.0, cache_path : str = None, metrics : Metrics = None, **options):
+        super().__init__("sk-fake", cache_path=cache_path, metrics=metrics, **options) # options of the resilience layer
+        self.fake = _FakeOpenai(latency, error_rate)
+
+    def _wait(self):
+        delay = self.fake.start()
+        if delay is None:
+            time.sleep(self.fake.latency.sample() / 2)
+            raise openai.error.APIError("Simulated API error")
+        time.sleep(delay)
+
+    def _prompt_completion(self, prompt, context, engine, temperature, n=1):
+        self._wait()
+        return [self.fake.reply(self._text_preprocess(context, prompt))] * n
+
+    def _prompt_chat(self, prompt, context, engine, temperature, n=1):
+        self._wait()
+        return [self.fake.reply(self._chat_preprocess(context, prompt))] * n
+
+    def _prompt_completion_stream(self, prompt, context, engine, temperature):
+        return self._prompt_chat_stream(prompt, context, engine, temperature)
+
+    def _prompt_chat_stream(self, prompt, context, engine, temperature):
+        delay = self.fake.start()
+        if delay is None:
+            raise openai.error.APIError("Simulated API error")
+        chunks = self.fake.split(self.fake.reply(self._chat_preprocess(context, prompt)))
+        for chunk in chunks:
+            time.sleep(delay / len(chunks))
+            yield chunk
+
+    def summarize(self, messages : list, previous_summary : str = None):
+        self._wait()
+        return "summary " + " ".join(messages)[:200]
+
+    def embed(self, texts : list):
+        self._wait() # One call per batch, like the API
+        return [self.fake.embedding(text) for text in texts]
+
+    def prompt_dalle2(self, prompt, n : int = 1, size : str = "256x256"):
+        self._wait()
+        return [f"http://localhost/image_{i}.png" for i in range(n)]
+
+
+class FakeAsyncOpenaiInterface(AsyncOpenaiInterface):
+
+    def __init__(self, latency : LatencyModel = LatencyModel(1.0, 0.5), error_rate : float = 0.0, cache_path : str = None, metrics : Metrics = None, **options):
+        super().__init__("sk-fake", cache_path=cache_path, metrics=metrics, **options) # options of the resilience layer
+        self.fake = _FakeOpenai(latency, error_rate)
+
+    async def _wait(self):
+        delay = self.fake.start()
+        if delay is None:
+            await asyncio.sleep(self.fake.latency.sample() / 2)
+            raise openai.error.APIError("Simulated API error")
+        await asyncio.sleep(delay)
+
+    async def _prompt_completion(self, prompt, context, engine, temperature, n=1):
+        await self._wait()
+        return [self.fake.reply(self._text_preprocess(context, prompt))] * n
+
+    async def _prompt_chat(self, prompt, context, engine, temperature, n=1):
+        await self._wait()
+        return [self.fake.reply(self._chat_preprocess(context, prompt))] * n
+
+    async def _prompt_completion_stream(self, prompt, context, engine, temperature):
+        async for chunk in self._prompt_chat_stream(prompt, context, engine, temperature):
+            yield chunk
+
+    async def _prompt_chat_stream(self, prompt, context, engine, temperature):
+        delay = self.fake.start()
+        if delay is None:
+            raise openai.error.APIError("Simulated API error")
+        chunks = self.fake.split(self.fake.reply(self._chat_preprocess(context, prompt)))
+        for chunk in chunks:
+            await asyncio.sleep(delay / len(chunks))
+            yield chunk
+
+    def _wait_blocking(self):
+        # For the calls that are blocking like the real ones, made from background threads
+        delay = self.fake.start()
+        if delay is None:
+            time.sleep(self.fake.latency.sample() / 2)
+            raise openai.error.APIError("Simulated API error")
+        time.sleep(delay)
+
+    def summarize(self, messages : list, previous_summary : str = None):
+        self._wait_blocking()
+        return "summary " + " ".join(messages)[:200]
+
+    def embed(self, texts : list):
+        self._wait_blocking() # The index calls it from its own thread
+        return [self.fake.embedding(text) for text in texts]
+
+    async def prompt_dalle2(self, prompt, n : int = 1, size : str = "256x256"):
+        await self._wait()
+        return [f"http://localhost/image_{i}.png" for i in range(n)]
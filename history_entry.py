@@ -0,0 +1,63 @@
+import sys
+import hashlib
+
+
+def message_digest(message : dict):
+    """
+    Digest of a chat message with whitespace normalised, request cache keys are built from those of their messages
+    """
+    digest = getattr(message, "digest", None)
+    if digest is not None:
+        return digest
+    return hashlib.sha256(f"{message['role']}\n{' '.join(message['content'].split())}".encode("utf-8")).hexdigest()
+
+
+class ChatMessage(dict):
+    """
+    OpenAI chat message that keeps its digest, a history entry hashes its message once instead of on every prompt of the thread
+    """
+
+    __slots__ = ("digest",)
+
+    def __init__(self, role : str, content : str):
+        super().__init__(role=role, content=content)
+        self.digest = None
+        self.digest = message_digest(self)
+
+
+class HistoryEntry():
+    """
+    One message of a thread. The API message built from it is kept, so a thread is only formatted once.
+    """
+
+    __slots__ = ("user", "message", "is_assistant", "is_system", "tokens", "_chat", "_chat_users")
+
+    def __init__(self, user : str, message : str, is_assistant : bool = False, is_system : bool = False):
+        self.user = sys.intern(user) if user is not None else None # The same few user ids repeat across every thread
+        self.message = message
+        self.is_assistant = is_assistant
+        self.is_system = is_system # Context added by the bot, e.g. retrieved messages, never stored in a thread
+        self.tokens = None # Token counts per encoding, filled by the ContextBuilder
+        self._chat = None
+        self._chat_users = None
+
+    @property
+    def role(self):
+        if self.is_system:
+            return "system"
+        return "assistant" if self.is_assistant else "user"
+
+    def chat_message(self, users_enabled : bool = False):
+        """
+        The entry as an OpenAI chat message, prefixed with the user tag if users_enabled
+        """
+        if users_enabled and not self.is_system:
+            if self._chat_users is None:
+                self._chat_users = ChatMessage(self.role, f"<@{self.user}>: {self.message}")
+            return self._chat_users
+        if self._chat is None:
+            self._chat = ChatMessage(self.role, self.message)
+        return self._chat
+
+    def to_json(self):
+        return {"user": self.user, "message": self.message}
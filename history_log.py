@@ -0,0 +1,154 @@
+import os
+import json
+import threading
+from typing import Callable
+
+
+class HistoryLog():
+    """
+    Append-only write-ahead log with background compaction into a snapshot file
+    """
+
+    def __init__(self, snapshot_path : str, apply : Callable[[dict, dict], None], compaction_threshold : int = 1000, fsync : bool = False):
+        self.snapshot_path = snapshot_path
+        self.log_path = snapshot_path + ".log"
+        self.segment_path = snapshot_path + ".log.compacting"
+        self.apply = apply # apply(state, record) replays one record onto a history state
+        self.compaction_threshold = compaction_threshold
+        self.fsync = fsync
+
+        self.seq = 0
+        self.records_since_compaction = 0
+        self.log_file = None
+        self.compaction_thread = None
+        self.lock = threading.Lock()
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return 0, {}
+        with open(self.snapshot_path, "r") as f:
+            data = json.load(f)
+        if "version" not in data: # Legacy history.json, a plain dump of the history dict
+            return 0, data
+        return data["seq"], data["history"]
+
+    def _encode(self, value):
+        # History entries are objects that know their JSON form
+        return value.to_json()
+
+    def _read_records(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print("Skipping truncated history log record in", path)
+                    return
+
+    def _replay(self, seq, state, path):
+        count = 0
+        for record in self._read_records(path):
+            if record["seq"] <= seq:
+                continue # Already part of the snapshot
+            self.apply(state, record)
+            seq = record["seq"]
+            count += 1
+        return seq, count
+
+    def load(self):
+        """
+        Rebuild the history state from the snapshot and the log tail, then open the log for appending
+        """
+        with self.lock:
+            seq, state = self._read_snapshot()
+            seq, segment_count = self._replay(seq, state, self.segment_path)
+            seq, log_count = self._replay(seq, state, self.log_path)
+            print(f"Replayed {segment_count + log_count} history log records.")
+
+            self.seq = seq
+            self.records_since_compaction = log_count
+            self._open_log()
+
+            if os.path.exists(self.segment_path): # A previous compaction did not finish
+                self._start_compaction()
+        return state
+
+    def read(self):
+        """
+        Rebuild the history state from the snapshot and the logs without opening them for writing
+        """
+        with self.lock:
+            seq, state = self._read_snapshot()
+            seq, _ = self._replay(seq, state, self.segment_path)
+            self._replay(seq, state, self.log_path)
+        return state
+
+    def _open_log(self):
+        if self.log_file is None:
+            self.log_file = open(self.log_path, "a")
+
+    def append(self, op : str, **fields):
+        with self.lock:
+            self._open_log()
+            self.seq += 1
+            self.log_file.write(json.dumps({"seq": self.seq, "op": op, **fields}) + "\n")
+            self.log_file.flush()
+            if self.fsync:
+                os.fsync(self.log_file.fileno())
+
+            self.records_since_compaction += 1
+            if self.records_since_compaction >= self.compaction_threshold and not self._compacting():
+                if not os.path.exists(self.segment_path):
+                    self._rotate()
+                self._start_compaction() # Also retries a segment left over by a failed compaction
+
+    def _rotate(self):
+        # Freeze the current log as a segment, new records go to a fresh log
+        self.log_file.close()
+        self.log_file = None
+        os.replace(self.log_path, self.segment_path)
+        self.records_since_compaction = 0
+        self._open_log()
+
+    def _compacting(self):
+        return self.compaction_thread is not None and self.compaction_thread.is_alive()
+
+    def _start_compaction(self):
+        if self._compacting():
+            return
+        self.compaction_thread = threading.Thread(target=self._compact, daemon=True)
+        self.compaction_thread.start()
+
+    def _compact(self):
+        # Only reads files that are no longer written to, so it never blocks appends
+        try:
+            seq, state = self._read_snapshot()
+            seq, _ = self._replay(seq, state, self.segment_path)
+
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": 1, "seq": seq, "history": state}, f, default=self._encode)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.segment_path)
+        except Exception as e:
+            print("Failed compacting history log:", e)
+
+    def dump(self, state : dict, path : str):
+        """
+        Write a full snapshot of the given state to path
+        """
+        with self.lock:
+            with open(path, "w") as f:
+                json.dump({"version": 1, "seq": self.seq, "history": state}, f, default=self._encode)
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.flush()
+                os.fsync(self.log_file.fileno())
+                self.log_file.close()
+                self.log_file = None
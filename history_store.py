@@ -0,0 +1,277 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+from typing import Optional
+from collections import OrderedDict
+
+from history_entry import HistoryEntry
+
+
+class _CachedThread():
+
+    def __init__(self, history, summary, options):
+        self.history = history
+        self.summary = summary
+        self.options = options # Only the values overriding the channel or the defaults
+        self.size = 0
+
+
+class ShardedHistoryCT():
+    """
+    HistoryCT backed by SQLite files sharded by channel.
+    Only recently used threads stay in memory, within max_bytes, the others are loaded on demand.
+    """
+
+    entry_overhead = 200 # Approximate bytes of a history entry besides its text
+
+    def __init__(self, history_dir : str = "history", default_options : dict = {}, shards : int = 8, max_bytes : int = 64 * 1024 * 1024, import_path : str = "history.json", assistant_id : str = None, import_channels=None):
+        self.history_dir = history_dir
+        self.default_options = default_options
+        self.shards = shards
+        self.max_bytes = max_bytes
+        self.import_path = import_path # JSON history imported into an empty store
+        self.import_channels = import_channels # import_channels(channel) is True for the channels to import, None for all
+        self.assistant_id = assistant_id
+
+        self.connections = []
+        self.shard_locks = [threading.Lock() for _ in range(shards)]
+
+        self.threads = OrderedDict() # (channel, thread) -> _CachedThread, least recently used first, thread None holds channel options
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _shard(self, channel):
+        return zlib.crc32(channel.encode("utf-8")) % self.shards
+
+    def _open(self):
+        os.makedirs(self.history_dir, exist_ok=True)
+        for shard in range(self.shards):
+            connection = sqlite3.connect(os.path.join(self.history_dir, f"shard_{shard:02d}.sqlite"), check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS messages (channel TEXT, thread TEXT, idx INTEGER, user TEXT, message TEXT, PRIMARY KEY (channel, thread, idx)) WITHOUT ROWID")
+            connection.execute("CREATE TABLE IF NOT EXISTS summaries (channel TEXT, thread TEXT, message TEXT, upto INTEGER, PRIMARY KEY (channel, thread)) WITHOUT ROWID")
+            # Channel options are stored with an empty thread
+            connection.execute("CREATE TABLE IF NOT EXISTS options (channel TEXT, thread TEXT, name TEXT, value TEXT, PRIMARY KEY (channel, thread, name)) WITHOUT ROWID")
+            connection.commit()
+            self.connections.append(connection)
+
+    def _write(self, channel, statement, parameters):
+        shard = self._shard(channel)
+        with self.shard_locks[shard]:
+            self.connections[shard].execute(statement, parameters)
+            self.connections[shard].commit()
+
+    def _load(self, channel, thread):
+        shard = self._shard(channel)
+        key = "" if thread is None else thread
+        with self.shard_locks[shard]:
+            connection = self.connections[shard]
+            options = {name: json.loads(value) for name, value in connection.execute("SELECT name, value FROM options WHERE channel = ? AND thread = ?", (channel, key))}
+            if thread is None:
+                return _CachedThread([], None, options)
+            history = [self._entry(user, message) for user, message in connection.execute("SELECT user, message FROM messages WHERE channel = ? AND thread = ? ORDER BY idx", (channel, key))]
+            row = connection.execute("SELECT message, upto FROM summaries WHERE channel = ? AND thread = ?", (channel, key)).fetchone()
+        return _CachedThread(history, {"message": row[0], "upto": row[1]} if row is not None else None, options)
+
+    def _entry(self, user, message):
+        return HistoryEntry(user, message, user is not None and user == self.assistant_id)
+
+    def _entry_size(self, entry):
+        return self.entry_overhead + len(entry.message or "")
+
+    def _resize(self, cached, size):
+        # Called with self.lock held
+        self.size += size - cached.size
+        cached.size = size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.threads) > 1:
+            _, cached = self.threads.popitem(last=False)
+            self.size -= cached.size
+            self.evictions += 1
+
+    def _get(self, channel, thread):
+        """
+        Cached state of a thread, or of the channel if thread is None, loaded from its shard on a miss
+        """
+        with self.lock:
+            cached = self.threads.get((channel, thread))
+            if cached is not None:
+                self.threads.move_to_end((channel, thread))
+                self.hits += 1
+                return cached
+
+        cached = self._load(channel, thread)
+        with self.lock:
+            if (channel, thread) in self.threads: # Loaded concurrently, keep the copy that may already be modified
+                return self.threads[(channel, thread)]
+            self.threads[(channel, thread)] = cached
+            self._resize(cached, self.entry_overhead + sum(self._entry_size(entry) for entry in cached.history))
+            self.loads += 1
+            self._evict()
+        return cached
+
+    def thread_sizes(self):
+        """
+        (channel, thread, number of messages) of every stored thread
+        """
+        sizes = []
+        for shard, connection in enumerate(self.connections):
+            with self.shard_locks[shard]:
+                sizes.extend(connection.execute("SELECT channel, thread, COUNT(*) FROM messages GROUP BY channel, thread").fetchall())
+        return sizes
+
+    def read_history(self, channel, thread, start, end):
+        # (user, message) of the entries from start to end, read from the shard so old threads do not evict the cached ones
+        shard = self._shard(channel)
+        with self.shard_locks[shard]:
+            return self.connections[shard].execute("SELECT user, message FROM messages WHERE channel = ? AND thread = ? AND idx >= ? AND idx < ? ORDER BY idx", (channel, thread, start, end)).fetchall()
+
+    def init_history(self, channel, thread):
+        pass # Nothing is stored until a thread gets a message, a summary or an option
+
+    def get_history(self, channel, thread):
+        return self._get(channel, thread).history
+
+    def _last_idx(self, connection, channel, thread):
+        # Called with the shard lock held, -1 for an empty thread
+        return connection.execute("SELECT COALESCE(MAX(idx), -1) FROM messages WHERE channel = ? AND thread = ?", (channel, thread)).fetchone()[0]
+
+    def add_to_history(self, channel, thread, message, user=None):
+        entry = self._entry(user, message)
+        shard = self._shard(channel)
+        # The index comes from the shard, and the cached copy is updated before the thread can be loaded again,
+        # so an eviction in between neither loses the message nor lets two messages share an index
+        with self.shard_locks[shard]:
+            connection = self.connections[shard]
+            idx = self._last_idx(connection, channel, thread) + 1
+            connection.execute("INSERT INTO messages (channel, thread, idx, user, message) VALUES (?, ?, ?, ?, ?)", (channel, thread, idx, user, message))
+            connection.commit()
+            with self.lock:
+                cached = self.threads.get((channel, thread))
+                if cached is not None and len(cached.history) == idx:
+                    cached.history.append(entry)
+                    self._resize(cached, cached.size + self._entry_size(entry))
+                    self._evict()
+        return entry
+
+    def replace_last_in_history(self, channel, thread, message, user=None):
+        entry = self._entry(user, message)
+        shard = self._shard(channel)
+        with self.shard_locks[shard]:
+            connection = self.connections[shard]
+            idx = self._last_idx(connection, channel, thread)
+            connection.execute("UPDATE messages SET user = ?, message = ? WHERE channel = ? AND thread = ? AND idx = ?", (user, message, channel, thread, idx))
+            connection.commit()
+            with self.lock:
+                cached = self.threads.get((channel, thread))
+                if cached is not None and len(cached.history) == idx + 1:
+                    self._resize(cached, cached.size - self._entry_size(cached.history[-1]) + self._entry_size(entry))
+                    cached.history[-1] = entry
+
+    def get_summary(self, channel, thread):
+        return self._get(channel, thread).summary
+
+    def set_summary(self, channel, thread, message, upto):
+        self._get(channel, thread).summary = {"message" : message, "upto" : upto}
+        self._write(channel, "INSERT OR REPLACE INTO summaries (channel, thread, message, upto) VALUES (?, ?, ?, ?)", (channel, thread, message, upto))
+
+    def get_option(self, channel : Optional[str] = None, thread : Optional[str] = None, option_name : str = ""):
+        if channel is None:
+            return self.default_options[option_name]
+        if thread is not None:
+            options = self._get(channel, thread).options
+            if option_name in options:
+                return options[option_name]
+        return self._get(channel, None).options.get(option_name, self.default_options[option_name])
+
+    def set_option(self, channel : Optional[str] = None, thread : Optional[str] = None, option_name : str = "", option_value = None):
+        if channel is None:
+            self.default_options[option_name] = option_value
+            return
+        self._get(channel, thread).options[option_name] = option_value
+        self._write(channel, "INSERT OR REPLACE INTO options (channel, thread, name, value) VALUES (?, ?, ?, ?)", (channel, "" if thread is None else thread, option_name, json.dumps(option_value)))
+
+    def stats(self):
+        with self.lock:
+            return {"cached_threads": len(self.threads), "bytes": self.size, "hits": self.hits, "loads": self.loads, "evictions": self.evictions}
+
+    def _import(self, history):
+        # Channel and thread options of the JSON format are imported as overrides, except the ones equal to the defaults
+        threads = 0
+        for channel, channel_history in history.items():
+            if self.import_channels is not None and not self.import_channels(channel):
+                continue
+            for name, value in channel_history.items():
+                if name != "threads" and value != self.default_options.get(name):
+                    self.set_option(channel, None, name, value)
+            for thread, thread_history in channel_history["threads"].items():
+                for name, value in thread_history.items():
+                    if name in self.default_options and value != channel_history.get(name, self.default_options[name]):
+                        self.set_option(channel, thread, name, value)
+                for entry in thread_history["history"]:
+                    self.add_to_history(channel, thread, entry.message, entry.user)
+                if "summary" in thread_history:
+                    self.set_summary(channel, thread, thread_history["summary"]["message"], thread_history["summary"]["upto"])
+            threads += len(channel_history["threads"])
+        return threads
+
+    def _is_empty(self):
+        for shard, connection in enumerate(self.connections):
+            with self.shard_locks[shard]:
+                if connection.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None or connection.execute("SELECT 1 FROM options LIMIT 1").fetchone() is not None:
+                    return False
+        return True
+
+    def _export(self):
+        history = {}
+        for shard, connection in enumerate(self.connections):
+            with self.shard_locks[shard]:
+                for channel, thread, name, value in connection.execute("SELECT channel, thread, name, value FROM options"):
+                    channel_history = history.setdefault(channel, {"threads" : {}})
+                    target = channel_history if thread == "" else channel_history["threads"].setdefault(thread, {"history" : []})
+                    target[name] = json.loads(value)
+                for channel, thread, user, message in connection.execute("SELECT channel, thread, user, message FROM messages ORDER BY channel, thread, idx"):
+                    history.setdefault(channel, {"threads" : {}})["threads"].setdefault(thread, {"history" : []})["history"].append({"user" : user, "message" : message})
+                for channel, thread, message, upto in connection.execute("SELECT channel, thread, message, upto FROM summaries"):
+                    history.setdefault(channel, {"threads" : {}})["threads"].setdefault(thread, {"history" : []})["summary"] = {"message" : message, "upto" : upto}
+        return history
+
+    def save_history(self, path: str = None):
+        try:
+            print("Saving history...")
+            if path is not None:
+                with open(path, "w") as f:
+                    json.dump({"version": 1, "seq": 0, "history": self._export()}, f)
+            for shard, connection in enumerate(self.connections):
+                with self.shard_locks[shard]:
+                    connection.commit()
+        except Exception as e:
+            print("Failed saving history:", e)
+
+    def load_history(self, path: str = None):
+        try:
+            print("Loading history...")
+            if path is not None and path != self.history_dir:
+                for connection in self.connections:
+                    connection.close()
+                self.connections = []
+                self.threads.clear()
+                self.size = 0
+                self.history_dir = path
+            if len(self.connections) == 0:
+                self._open()
+            if self.import_path is not None and self._is_empty() and (os.path.exists(self.import_path) or os.path.exists(self.import_path + ".log")):
+                from bot import HistoryCT # Imported here, bot imports this module
+                legacy = HistoryCT(self.import_path, {})
+                legacy.read_history()
+                print(f"Imported {self._import(legacy.history)} threads from {self.import_path}.")
+        except Exception as e:
+            print("Failed loading history:", e)
@@ -0,0 +1,174 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Metrics():
+    """
+    Counters, gauges and latency histograms with labels, rendered in the Prometheus text format.
+    Stage timings of the request path are recorded with span().
+    """
+
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Seconds, from the regex parse to a long completion
+
+    descriptions = {
+        "stage_seconds": ("histogram", "Time spent in each stage of the request path"),
+        "stage_errors_total": ("counter", "Stages that ended with an exception"),
+        "events_total": ("counter", "Slack events received, by kind"),
+        "requests_total": ("counter", "Messages handled, by mode"),
+        "busy_total": ("counter", "Messages turned down with a busy reply"),
+        "cache_hits_total": ("counter", "Replies served from the reply cache, by engine"),
+        "cache_misses_total": ("counter", "Cacheable requests sent to the API, by engine"),
+        "openai_tokens_total": ("counter", "Tokens reported by the OpenAI API, by engine and type (streamed completions count a token per chunk)"),
+        "slack_calls_total": ("counter", "Slack Web API calls, by method and status"),
+    }
+
+    def __init__(self, prefix : str = "slackgpt"):
+        self.prefix = prefix
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [count per bucket..., count above the last bucket]
+        self.sums = {} # (name, labels) -> [sum, count]
+        self.gauges = {} # name -> (help, function)
+        self.lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = [0.0, 0]
+            self.histograms[key][bisect_left(self.buckets, value)] += 1
+            self.sums[key][0] += value
+            self.sums[key][1] += 1
+
+    def gauge(self, name, function, help : str = ""):
+        """
+        Register a gauge read from function() each time the metrics are rendered
+        """
+        self.gauges[name] = (help, function)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Time the enclosed block as one stage of the request path, exceptions are counted and raised again
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def stage_means(self):
+        """
+        Mean duration of each stage in milliseconds, over all labels
+        """
+        totals = {}
+        with self.lock:
+            for (name, labels), (total, count) in self.sums.items():
+                if name == "stage_seconds":
+                    stage = dict(labels)["stage"]
+                    stage_total, stage_count = totals.get(stage, (0.0, 0))
+                    totals[stage] = (stage_total + total, stage_count + count)
+        return {stage: 1000 * total / count for stage, (total, count) in totals.items()}
+
+    def _format_labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if len(labels) == 0:
+            return ""
+        escape = lambda value: value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return "{" + ",".join(f"{label}=\"{escape(value)}\"" for label, value in labels) + "}"
+
+    def _header(self, lines, name, kind, help):
+        lines.append(f"# HELP {self.prefix}_{name} {help}")
+        lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+            sums = {key: list(value) for key, value in self.sums.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            kind, help = self.descriptions.get(name, ("counter", ""))
+            self._header(lines, name, kind, help)
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{self.prefix}_{name}{self._format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            kind, help = self.descriptions.get(name, ("histogram", ""))
+            self._header(lines, name, kind, help)
+            for (histogram, labels), counts in sorted(histograms.items()):
+                if histogram != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{self.prefix}_{name}_bucket{self._format_labels(labels, [('le', str(bound))])} {cumulative}")
+                total, count = sums[(histogram, labels)]
+                lines.append(f"{self.prefix}_{name}_sum{self._format_labels(labels)} {total}")
+                lines.append(f"{self.prefix}_{name}_count{self._format_labels(labels)} {count}")
+
+        for name, (help, function) in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            self._header(lines, name, "gauge", help)
+            lines.append(f"{self.prefix}_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer():
+    """
+    Serves the metrics on http://host:port/metrics from a background thread
+    """
+
+    def __init__(self, metrics : Metrics, host : str = "127.0.0.1", port : int = 9100):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # One line per scrape would drown the bot's output
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="metrics_server").start()
+        print(f"Serving metrics on http://{self.host}:{self.server.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
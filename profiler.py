@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class SamplingProfiler():
+    """
+    Samples the stack of every thread at a fixed interval. The cost stays low enough to turn it on
+    in production for a while, and the folded stacks can be rendered as a flame graph.
+    """
+
+    # Leaf frames of threads waiting for work, they are counted apart from the busy samples
+    idle_frames = {("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"), ("socketserver.py", "serve_forever")}
+
+    def __init__(self, interval : float = 0.005, max_depth : int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter() # "frame;frame;..." from the root -> samples
+        self.idle = 0
+        self.started = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval : float = None):
+        """
+        Start sampling, returns False if the profiler is already running
+        """
+        with self.lock:
+            if self.running:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self.stacks = Counter()
+            self.idle = 0
+            self.started = time.monotonic()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True, name="sampling_profiler")
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """
+        Stop sampling, returns the folded stacks and the sampling duration, or None if it was not running
+        """
+        with self.lock:
+            if not self.running:
+                return None
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            return self.stacks, time.monotonic() - self.started
+
+    def _frame_name(self, frame):
+        return os.path.basename(frame.f_code.co_filename), frame.f_code.co_name
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if self._frame_name(frame) in self.idle_frames:
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append("{}:{}".format(*self._frame_name(frame)))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def top(self, stacks : Counter, n : int = 10):
+        """
+        Functions running in the most samples (the leaf of the stack), with their share of the busy samples
+        """
+        total = sum(stacks.values())
+        functions = Counter()
+        for stack, count in stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+        return [(function, count / total) for function, count in functions.most_common(n)] if total > 0 else []
+
+    def write_folded(self, stacks : Counter, path : str):
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
@@ -0,0 +1,106 @@
+import time
+import random
+import asyncio
+import threading
+import concurrent.futures
+from collections import deque
+
+import openai
+
+
+# Errors worth another attempt: the API or the network failed, not the request itself
+retryable_errors = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    TimeoutError,
+    concurrent.futures.TimeoutError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the API while the circuit breaker of an engine is open and no fallback is available
+    """
+
+
+class CircuitBreaker():
+    """
+    Opens after failure_threshold consecutive failures, calls then fail fast until reset_timeout has passed.
+    A single trial call is let through after that, its outcome closes the breaker or opens it again.
+    A trial that never reports back, e.g. a cancelled call, gives way to another one after reset_timeout.
+    """
+
+    def __init__(self, failure_threshold : int = 5, reset_timeout : float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = None # Start time of the trial call
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened is None:
+                return "closed"
+            return "half_open" if self.trial is not None or time.monotonic() - self.opened >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            now = time.monotonic()
+            if (self.trial is None or now - self.trial >= self.reset_timeout) and now - self.opened >= self.reset_timeout:
+                self.trial = now
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial is not None or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+                self.trial = None
+
+
+class LatencyTracker():
+    """
+    Latencies of the most recent successful calls, their percentiles set the hedging delay
+    """
+
+    def __init__(self, window : int = 200, min_samples : int = 20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds : float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q : float):
+        """
+        Latency under which a fraction q of the recent calls finished, None until there are enough samples
+        """
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def backoff(attempt : int, base : float = 0.5, cap : float = 8.0):
+    """
+    Full jitter exponential backoff, concurrent retries do not hit the API again all at once
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,93 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache():
+    """
+    LRU cache of API replies with a time to live, a memory cap and an optional on-disk tier
+    """
+
+    def __init__(self, max_entries : int = 1024, ttl : float = 24 * 3600, max_bytes : int = 16 * 1024 * 1024, disk_path : str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict() # key -> (expires_at, value), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk = None
+        self.disk_puts = 0
+        if disk_path is not None:
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            self.disk.commit()
+
+    @staticmethod
+    def make_key(engine : str, temperature : float, payload):
+        return hashlib.sha256(json.dumps([engine, temperature, payload], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, value) = self.entries.popitem(last=False)
+            self.size -= len(value)
+
+    def _put_memory(self, key, value, expires_at):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[1])
+        self.entries[key] = (expires_at, value)
+        self.size += len(value)
+        self._evict()
+
+    def get(self, key : str):
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                expires_at, value = self.entries[key]
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.size -= len(self.entries.pop(key)[1])
+
+            if self.disk is not None:
+                row = self.disk.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] > now:
+                    self._put_memory(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key : str, value : str):
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._put_memory(key, value, expires_at)
+
+            if self.disk is not None:
+                self.disk.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+                self.disk_puts += 1
+                if self.disk_puts % 100 == 0:
+                    self.disk.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+                self.disk.commit()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            }
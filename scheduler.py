@@ -0,0 +1,100 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KeyedScheduler():
+    """
+    Runs jobs in submission order per key, while different keys run in parallel on a bounded worker pool
+    """
+
+    def __init__(self, max_workers : int = 8, max_pending_per_key : int = 5):
+        self.max_pending_per_key = max_pending_per_key
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduler")
+        self.queues = {} # key -> jobs waiting or running, a key is present while it has work
+        self.lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        """
+        Queue function(*args) behind the other jobs of key. Returns False if the key has too many pending jobs.
+        """
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                if len(queue) >= self.max_pending_per_key:
+                    return False
+                queue.append((function, args))
+                return True
+            self.queues[key] = deque([(function, args)])
+        self.executor.submit(self._run, key)
+        return True
+
+    def _run(self, key):
+        with self.lock:
+            function, args = self.queues[key][0]
+        try:
+            function(*args)
+        except Exception as e:
+            print("Job failed:", e)
+
+        with self.lock:
+            queue = self.queues[key]
+            queue.popleft()
+            if len(queue) == 0:
+                del self.queues[key]
+                return
+        # One job per turn, the key goes back to the end of the pool queue so busy threads do not starve the others
+        self.executor.submit(self._run, key)
+
+    def pending(self, key=None):
+        with self.lock:
+            if key is not None:
+                return len(self.queues.get(key, ()))
+            return sum(len(queue) for queue in self.queues.values())
+
+    def shutdown(self, wait : bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+class AsyncKeyedScheduler(KeyedScheduler):
+    """
+    KeyedScheduler for the event loop, the worker pool is a semaphore bounding the running coroutines
+    """
+
+    def __init__(self, max_workers : int = 64, max_pending_per_key : int = 5):
+        self.max_pending_per_key = max_pending_per_key
+        self.max_workers = max_workers
+        self.semaphore = None # Created lazily, it must belong to the running loop
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        queue = self.queues.get(key)
+        if queue is not None:
+            if len(queue) >= self.max_pending_per_key:
+                return False
+            queue.append((function, args))
+            return True
+        self.queues[key] = deque([(function, args)])
+        asyncio.ensure_future(self._drain(key))
+        return True
+
+    async def _drain(self, key):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        queue = self.queues[key]
+        while len(queue) > 0:
+            function, args = queue[0]
+            async with self.semaphore: # Released after each job, waiting keys get their turn in order
+                try:
+                    result = function(*args)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    print("Job failed:", e)
+            queue.popleft()
+        del self.queues[key]
+
+    def shutdown(self, wait : bool = True):
+        pass
@@ -0,0 +1,225 @@
+import time
+import queue
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+
+class ChannelIndex():
+    """
+    Embeddings of the messages of one channel in a growing matrix, searched with a single product
+    """
+
+    def __init__(self):
+        self.vectors = None # Rows up to size are in use, the rest is room to grow
+        self.size = 0
+        self.thread_ids = np.zeros(0, dtype=np.int32)
+        self.threads = [] # Thread of each id
+        self.thread_id = {} # thread -> id
+        self.users = []
+        self.messages = []
+
+    def add(self, vectors : np.ndarray, threads : list, users : list, messages : list):
+        end = self.size + len(vectors)
+        if self.vectors is None or end > len(self.vectors):
+            capacity = max(64, end, 2 * self.size)
+            grown = np.zeros((capacity, vectors.shape[1]), dtype=np.float32)
+            thread_ids = np.zeros(capacity, dtype=np.int32)
+            if self.vectors is not None:
+                grown[:self.size] = self.vectors[:self.size]
+                thread_ids[:self.size] = self.thread_ids[:self.size]
+            self.vectors, self.thread_ids = grown, thread_ids
+
+        self.vectors[self.size:end] = vectors
+        for i, thread in enumerate(threads):
+            if thread not in self.thread_id:
+                self.thread_id[thread] = len(self.threads)
+                self.threads.append(thread)
+            self.thread_ids[self.size + i] = self.thread_id[thread]
+        self.users.extend(users)
+        self.messages.extend(messages)
+        self.size = end
+
+    def search(self, vector : np.ndarray, k : int, exclude_thread : str = None, min_score : float = -1.0):
+        """
+        The k messages closest to vector, as (score, thread, user, message) from the best one
+        """
+        if self.size == 0 or k < 1:
+            return []
+        scores = self.vectors[:self.size] @ vector # Rows are normalized, so this is the cosine similarity
+        if exclude_thread in self.thread_id:
+            scores[self.thread_ids[:self.size] == self.thread_id[exclude_thread]] = -np.inf
+        k = min(k, self.size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.threads[self.thread_ids[i]], self.users[i], self.messages[i]) for i in best if scores[i] >= min_score]
+
+
+class SemanticIndex():
+    """
+    Vector index of the messages of each channel, for retrieving related messages from other threads and for the search mode.
+    New messages are embedded in batches by a background thread. Embeddings are cached by text in SQLite along with the
+    indexed messages, so a channel is loaded back from disk on first use without calling the API again.
+    The messages stored before the index existed are added once by backfill().
+    """
+
+    def __init__(self, openai_client, path : str = None, batch_size : int = 64, batch_delay : float = 0.5, max_message_length : int = 2000):
+        self.openai_client = openai_client
+        self.batch_size = batch_size # Messages embedded in one API call
+        self.batch_delay = batch_delay # Seconds a new message waits for others to share its call
+        self.max_message_length = max_message_length # Characters embedded per message, the rest rarely changes what it is about
+
+        self.db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, channel TEXT, thread TEXT, user TEXT, message TEXT, key TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_channel ON entries (channel)")
+        # Messages of each thread to backfill and the position reached, the row of an empty channel and thread marks a started backfill
+        self.db.execute("CREATE TABLE IF NOT EXISTS backfill (channel TEXT, thread TEXT, upto INTEGER, target INTEGER, PRIMARY KEY (channel, thread))")
+        self.db.commit()
+
+        self.channels = {} # channel -> ChannelIndex, loaded on first use
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.embedded = 0
+        self.failed = 0
+        self.backfilled = 0
+        self.backfill_pending = 0
+
+        self.pending = queue.Queue()
+        threading.Thread(target=self._run, daemon=True, name="semantic_index").start()
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.openai_client.embedding_engine}\n{text}".encode("utf-8")).hexdigest()
+
+    def _channel(self, channel):
+        # Called with the lock held
+        if channel not in self.channels:
+            index = ChannelIndex()
+            rows = self.db.execute("SELECT entries.thread, entries.user, entries.message, embeddings.vector FROM entries JOIN embeddings ON entries.key = embeddings.key WHERE entries.channel = ? ORDER BY entries.id", (channel,)).fetchall()
+            if len(rows) > 0:
+                threads, users, messages, vectors = zip(*rows)
+                index.add(np.stack([np.frombuffer(vector, dtype=np.float32) for vector in vectors]), threads, users, messages)
+            self.channels[channel] = index
+        return self.channels[channel]
+
+    def embeddings(self, texts : list):
+        """
+        Normalized embeddings of texts as a matrix, from the cache or in batched API calls for the missing ones
+        """
+        texts = [text[:self.max_message_length] for text in texts]
+        keys = [self._key(text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500): # SQLite limits the number of parameters
+                chunk = list(set(keys[start:start + 500]))
+                rows = self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        self.cache_hits += sum(key in found for key in keys)
+
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.items())
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            vectors = np.asarray(self.openai_client.embed([text for _, text in batch]), dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", [(key, vector.tobytes()) for (key, _), vector in zip(batch, vectors)])
+                self.db.commit()
+            found.update((key, vector) for (key, _), vector in zip(batch, vectors))
+            self.embedded += len(batch)
+
+        return np.stack([found[key] for key in keys]) if len(keys) > 0 else np.zeros((0, 0), dtype=np.float32)
+
+    def add(self, channel : str, thread : str, user : str, message : str):
+        """
+        Queue a message for indexing, it becomes searchable once its batch is embedded
+        """
+        if len(message.strip()) > 0:
+            self.pending.put((channel, thread, user, message))
+
+    def backfill(self, history):
+        """
+        Index the messages already in the history store, once, from a background thread.
+        The threads and their sizes are saved when it starts, later messages are indexed by add() as they come.
+        An interrupted backfill resumes from the positions saved with each batch.
+        """
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM backfill LIMIT 1").fetchone() is None:
+                self.db.executemany("INSERT INTO backfill (channel, thread, upto, target) VALUES (?, ?, 0, ?)", [("", "", 0)] + list(history.thread_sizes()))
+                self.db.commit()
+            threads = self.db.execute("SELECT channel, thread, upto, target FROM backfill WHERE upto < target").fetchall()
+            self.backfill_pending = sum(target - upto for _, _, upto, target in threads) # Messages, empty ones included
+        if len(threads) > 0:
+            threading.Thread(target=self._backfill, args=(history, threads), daemon=True, name="semantic_index_backfill").start()
+
+    def _backfill(self, history, threads):
+        batch = []
+        progress = {} # (channel, thread) -> position reached with the batch
+        read = 0
+        try:
+            for channel, thread, upto, target in threads:
+                for user, message in history.read_history(channel, thread, upto, target):
+                    upto += 1
+                    read += 1
+                    progress[(channel, thread)] = upto
+                    if len(message.strip()) > 0:
+                        batch.append((channel, thread, user, message))
+                    if len(batch) >= self.batch_size:
+                        self._backfill_batch(batch, progress, read)
+                        batch, progress, read = [], {}, 0
+                progress[(channel, thread)] = target # Messages removed since the start leave nothing to read
+            self._backfill_batch(batch, progress, read)
+            self.backfill_pending = 0
+            print("Semantic index backfill done.")
+        except Exception as e:
+            print("Semantic index backfill stopped, it resumes on the next start:", e)
+
+    def _backfill_batch(self, batch, progress, read):
+        self._index(batch, progress)
+        with self.lock:
+            self.backfilled += len(batch)
+            self.backfill_pending = max(0, self.backfill_pending - read)
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._index(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print("Failed indexing messages:", e)
+
+    def _index(self, batch, progress={}):
+        # progress holds backfill positions, saved in the same transaction as the entries so a resumed backfill adds none twice
+        channels, threads, users, messages = zip(*batch) if len(batch) > 0 else ((), (), (), ())
+        vectors = self.embeddings(list(messages))
+        keys = [self._key(message[:self.max_message_length]) for message in messages]
+        with self.lock:
+            self.db.executemany("INSERT INTO entries (channel, thread, user, message, key) VALUES (?, ?, ?, ?, ?)", zip(channels, threads, users, messages, keys))
+            self.db.executemany("UPDATE backfill SET upto = ? WHERE channel = ? AND thread = ?", [(upto, channel, thread) for (channel, thread), upto in progress.items()])
+            self.db.commit()
+            for channel in set(channels):
+                if channel in self.channels: # Channels not loaded yet read the new rows when they are
+                    rows = [i for i, entry_channel in enumerate(channels) if entry_channel == channel]
+                    self.channels[channel].add(vectors[rows], [threads[i] for i in rows], [users[i] for i in rows], [messages[i] for i in rows])
+
+    def search(self, channel : str, query : str, k : int = 5, exclude_thread : str = None, min_score : float = -1.0):
+        """
+        Messages of the channel closest to query, as (score, thread, user, message) from the best one
+        """
+        vector = self.embeddings([query])[0]
+        with self.lock:
+            return self._channel(channel).search(vector, k, exclude_thread, min_score)
+
+    def stats(self):
+        with self.lock:
+            return {"channels_loaded": len(self.channels), "messages_loaded": sum(index.size for index in self.channels.values()),
+                    "pending": self.pending.qsize(), "embedded": self.embedded, "cache_hits": self.cache_hits, "failed": self.failed,
+                    "backfilled": self.backfilled, "backfill_pending": self.backfill_pending}
@@ -0,0 +1,267 @@
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from slack_sdk.errors import SlackApiError
+
+
+class RateLimit():
+    """
+    Token bucket, rate in calls per second (None for no limit, the bucket can still be paused)
+    """
+
+    def __init__(self, rate : float = None, burst : int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0 # Set from Retry-After when Slack answers 429
+
+    def delay(self):
+        """
+        Seconds to wait before the next call, 0 if a call can be made now
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate is None:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0.0
+
+    def take(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _Job():
+
+    def __init__(self, method, function, kwargs, coalesce_key, future=None, after=()):
+        self.method = method
+        self.function = function
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.after = list(after) # Futures to wait for before the call is made
+        self.future = future if future is not None else Future()
+        self.started = False
+        self.attempts = 0
+
+
+class SlackDispatcher():
+    """
+    Sends Slack Web API calls from per-channel queues, within each method's rate limit tier.
+    Calls answered with 429 are retried after Retry-After.
+    """
+
+    # Calls per minute of the Slack rate limit tiers, and bursts allowed. None leaves the workspace limit
+    # of the method to the 429 handling, messages are only limited per channel.
+    method_limits = {
+        "chat.postMessage": None,
+        "chat.update": None,
+        "files.upload": (20, 2),
+        "files.getUploadURLExternal": (100, 10),
+        "files.completeUploadExternal": (100, 10),
+    }
+    default_limit = (20, 2)
+    channel_limit = (60, 3) # chat.postMessage allows about one message per second and channel
+
+    def __init__(self, max_workers : int = 4, max_retries : int = 3):
+        self.max_retries = max_retries
+        self.limits = {}
+        self.channel_limits = {}
+        self.queues = {} # channel -> jobs, a channel is present while it has work
+        self.ready = queue.Queue() # Channels whose first job can be picked up by a worker
+        self.lock = threading.Lock()
+
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+
+        self.workers = [threading.Thread(target=self._work, daemon=True, name=f"slack_dispatcher_{i}") for i in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _limit(self, method):
+        if method not in self.limits:
+            limit = self.method_limits.get(method, self.default_limit)
+            self.limits[method] = RateLimit(limit[0] / 60, limit[1]) if limit is not None else RateLimit()
+        return self.limits[method]
+
+    def _channel_limit(self, channel):
+        if channel not in self.channel_limits:
+            per_minute, burst = self.channel_limit
+            self.channel_limits[channel] = RateLimit(per_minute / 60, burst)
+        return self.channel_limits[channel]
+
+    def submit(self, method : str, channel : str, function, /, coalesce_key=None, after=(), **kwargs):
+        """
+        Queue function(**kwargs) behind the other calls to the channel and return its future.
+        A call with the same coalesce_key as a queued one that has not started replaces its arguments.
+        The call keeps its place until the futures in after are done, without holding a worker, e.g. while images are uploaded.
+        """
+        with self.lock:
+            jobs = self.queues.get(channel)
+            if jobs is not None and coalesce_key is not None:
+                for job in jobs:
+                    if job.coalesce_key == coalesce_key and not job.started:
+                        job.kwargs = kwargs
+                        self.coalesced += 1
+                        return job.future
+
+            job = _Job(method, function, kwargs, coalesce_key, after=after)
+            if jobs is not None:
+                jobs.append(job)
+                return job.future
+            self.queues[channel] = deque([job])
+        self.ready.put(channel)
+        return job.future
+
+    def _requeue(self, channel, delay):
+        if delay > 0:
+            timer = threading.Timer(delay, self.ready.put, args=(channel,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.ready.put(channel)
+
+    def _work(self):
+        while True:
+            channel = self.ready.get()
+            with self.lock:
+                job = self.queues[channel][0]
+                waiting = next((future for future in job.after if not future.done()), None)
+                if waiting is not None:
+                    waiting.add_done_callback(lambda _, channel=channel: self.ready.put(channel)) # The channel is back once it is done
+                    continue
+                limits = [self._limit(job.method)] + ([self._channel_limit(channel)] if job.method == "chat.postMessage" else [])
+                delay = max(limit.delay() for limit in limits)
+                if delay > 0:
+                    self._requeue(channel, delay) # Over the limit, let the worker serve other channels meanwhile
+                    continue
+                for limit in limits:
+                    limit.take()
+                job.started = True
+                job.attempts += 1
+
+            try:
+                result = job.function(**job.kwargs)
+                job.future.set_result(result)
+            except SlackApiError as e:
+                if e.response.status_code == 429 and job.attempts <= self.max_retries:
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                    print(f"Rate limited on {job.method}, retrying in {retry_after}s.")
+                    with self.lock:
+                        self._limit(job.method).pause(retry_after)
+                        self.retried += 1
+                    self._requeue(channel, retry_after)
+                    continue
+                print("status: ", "KO", e)
+                job.future.set_exception(e)
+            except Exception as e:
+                print("status: ", "KO", e)
+                job.future.set_exception(e)
+
+            with self.lock:
+                self.sent += 1
+                jobs = self.queues[channel]
+                jobs.popleft()
+                if len(jobs) == 0:
+                    del self.queues[channel]
+                    continue
+            self.ready.put(channel) # Back to the end, busy channels do not starve the others
+
+    def stats(self):
+        with self.lock:
+            return {"queued": sum(len(jobs) for jobs in self.queues.values()), "sent": self.sent, "retried": self.retried, "coalesced": self.coalesced}
+
+
+class AsyncSlackDispatcher(SlackDispatcher):
+    """
+    SlackDispatcher for the event loop: each channel with queued calls has a task sending them in order,
+    within the same method and channel limits
+    """
+
+    def __init__(self, max_retries : int = 3):
+        self.max_retries = max_retries
+        self.limits = {}
+        self.channel_limits = {}
+        self.queues = {} # channel -> jobs, a channel is present while its task runs
+
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    def submit(self, method : str, channel : str, function, /, coalesce_key=None, after=(), **kwargs):
+        """
+        Queue the coroutine function(**kwargs) behind the other calls to the channel and return an asyncio future of its result.
+        A call with the same coalesce_key as a queued one that has not started replaces its arguments.
+        The call keeps its place until the futures in after are done.
+        """
+        jobs = self.queues.get(channel)
+        if jobs is not None and coalesce_key is not None:
+            for job in jobs:
+                if job.coalesce_key == coalesce_key and not job.started:
+                    job.kwargs = kwargs
+                    self.coalesced += 1
+                    return job.future
+
+        job = _Job(method, function, kwargs, coalesce_key, asyncio.get_running_loop().create_future(), after)
+        if jobs is not None:
+            jobs.append(job)
+            return job.future
+        self.queues[channel] = deque([job])
+        asyncio.ensure_future(self._work(channel))
+        return job.future
+
+    def _fail(self, job, error):
+        print("status: ", "KO", error)
+        if not job.future.done():
+            job.future.set_exception(error)
+            job.future.exception() # Reported here, callers that do not wait for the send need not retrieve it
+
+    async def _work(self, channel):
+        jobs = self.queues[channel]
+        while len(jobs) > 0:
+            job = jobs[0]
+            if len(job.after) > 0:
+                await asyncio.wait(job.after)
+            limits = [self._limit(job.method)] + ([self._channel_limit(channel)] if job.method == "chat.postMessage" else [])
+            delay = max(limit.delay() for limit in limits)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = max(limit.delay() for limit in limits)
+            for limit in limits:
+                limit.take()
+            job.started = True
+            job.attempts += 1
+
+            try:
+                result = await job.function(**job.kwargs)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except SlackApiError as e:
+                if e.response.status_code == 429 and job.attempts <= self.max_retries:
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                    print(f"Rate limited on {job.method}, retrying in {retry_after}s.")
+                    self._limit(job.method).pause(retry_after)
+                    self.retried += 1
+                    continue # The pause is waited for before the next attempt
+                self._fail(job, e)
+            except Exception as e:
+                self._fail(job, e)
+
+            self.sent += 1
+            jobs.popleft()
+        del self.queues[channel]
+
+    def stats(self):
+        return {"queued": sum(len(jobs) for jobs in self.queues.values()), "sent": self.sent, "retried": self.retried, "coalesced": self.coalesced}
@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ThreadSummarizer():
+    """
+    Condenses the older part of long threads into a stored summary, in the background
+    """
+
+    def __init__(self, history, openai_client, threshold : int = 30, keep_recent : int = 10, max_workers : int = 1):
+        self.history = history
+        self.openai_client = openai_client
+        self.threshold = threshold # Number of unsummarised older entries that triggers a new summary
+        self.keep_recent = keep_recent # Number of recent entries that are always sent verbatim
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def _summarized_upto(self, channel, thread):
+        summary = self.history.get_summary(channel, thread)
+        return summary["upto"] if summary is not None else 0
+
+    def maybe_summarize(self, channel, thread):
+        history = self.history.get_history(channel, thread)
+        if len(history) - self.keep_recent - self._summarized_upto(channel, thread) < self.threshold:
+            return
+
+        with self.lock:
+            if (channel, thread) in self.pending:
+                return
+            self.pending.add((channel, thread))
+        self.executor.submit(self._summarize, channel, thread)
+
+    def _summarize(self, channel, thread):
+        try:
+            history = self.history.get_history(channel, thread)
+            summary = self.history.get_summary(channel, thread)
+            upto = summary["upto"] if summary is not None else 0
+            new_upto = len(history) - self.keep_recent
+
+            # Only the entries added since the last summary are sent, along with the previous summary
+            messages = [f"<@{entry.user}>: {entry.message}" for entry in history[upto:new_upto]]
+            text = self.openai_client.summarize(messages, summary["message"] if summary is not None else None)
+            self.history.set_summary(channel, thread, text, new_upto)
+            print(f"Summarized thread {thread} up to entry {new_upto}.")
+        except Exception as e:
+            print("Failed summarizing thread:", e)
+        finally:
+            with self.lock:
+                self.pending.discard((channel, thread))
@@ -0,0 +1,199 @@
+import sys
+import zlib
+import time
+import queue
+import signal
+import asyncio
+import threading
+import multiprocessing
+
+from slack_bolt import App
+from slack_bolt.adapter.socket_mode import SocketModeHandler
+
+from events import event_channel
+
+
+def channel_worker(channel, processes):
+    """
+    Index of the worker process serving the channel
+    """
+    return zlib.crc32(channel.encode("utf-8")) % processes
+
+
+def _serve(dispatcher, events, drain_timeout):
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            item = events.get(timeout=1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive(): # The supervisor was killed, do not linger
+                break
+            continue
+        if item is None: # Drain requested, every event queued before it has been handed over
+            break
+        try:
+            dispatcher.handle(*item)
+        except Exception as e:
+            print("Failed handling event:", e)
+    if not dispatcher.drain(drain_timeout):
+        print("Some requests or replies were still pending after", drain_timeout, "seconds.")
+
+async def _serve_async(dispatcher, events, drain_timeout):
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            item = await loop.run_in_executor(None, events.get, True, 1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if item is None:
+            break
+        try:
+            dispatcher.handle(*item)
+        except Exception as e:
+            print("Failed handling event:", e)
+    if not await dispatcher.drain_async(drain_timeout):
+        print("Some requests or replies were still pending after", drain_timeout, "seconds.")
+
+def run_worker(args, index, events):
+    """
+    Entry point of a worker process: a bot with its own history, fed with the events of its channels
+    """
+    # Ctrl-C and SIGTERM reach the whole process group, the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    from app import BootTimer, start_bot
+    timer = BootTimer()
+    _, dispatcher = start_bot(args, timer, worker=index)
+    timer.report(f"Worker {index} ready")
+
+    if args.async_mode:
+        asyncio.run(_serve_async(dispatcher, events, args.drain_timeout))
+    else:
+        _serve(dispatcher, events, args.drain_timeout)
+
+
+class Supervisor():
+    """
+    Receives the Slack events and routes them by channel hash to worker processes, so each channel always lands on the same worker.
+    SIGHUP drains and restarts the workers one at a time, a worker that dies is started again.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = args.processes
+        self.context = multiprocessing.get_context("spawn") # Workers must not inherit the supervisor's Slack connection
+
+        self.queues = [None] * self.processes
+        self.workers = [None] * self.processes
+        self.restarting = set()
+        self.stopping = False
+        self.lock = threading.Lock()
+
+    def shard(self, channel):
+        return channel_worker(channel, self.processes)
+
+    def route(self, kind, body):
+        index = self.shard(event_channel(kind, body))
+        with self.lock:
+            self.queues[index].put((kind, body))
+
+    def _start_worker(self, index):
+        process = self.context.Process(target=run_worker, args=(self.args, index, self.queues[index]), name=f"worker_{index}")
+        process.start()
+        self.workers[index] = process
+
+    def _stop_worker(self, process, events):
+        events.put(None) # Handled after the events already queued
+        process.join(self.args.drain_timeout + 10)
+        if process.is_alive():
+            print(f"Worker {process.name} did not stop in time, terminating it.")
+            process.terminate()
+            process.join()
+
+    def restart(self, index):
+        """
+        Drain worker index and start a new one for its channels, their new events wait in its queue meanwhile
+        """
+        with self.lock:
+            if self.stopping or index in self.restarting:
+                return
+            self.restarting.add(index)
+            events, process = self.queues[index], self.workers[index]
+            self.queues[index] = self.context.Queue()
+
+        print(f"Draining worker {index}...")
+        self._stop_worker(process, events) # The new worker only starts once the history files are released
+        with self.lock:
+            self.restarting.discard(index)
+            if not self.stopping:
+                self._start_worker(index)
+                print(f"Worker {index} restarted.")
+
+    def rolling_restart(self):
+        for index in range(self.processes):
+            self.restart(index)
+
+    def _monitor(self):
+        while not self.stopping:
+            time.sleep(1.0)
+            with self.lock:
+                for index, process in enumerate(self.workers):
+                    if not self.stopping and index not in self.restarting and not process.is_alive():
+                        print(f"Worker {index} exited with code {process.exitcode}, starting it again.")
+                        self.queues[index] = self._salvage(self.queues[index])
+                        self._start_worker(index)
+
+    def _salvage(self, events):
+        # A worker killed while reading keeps the queue locked, its replacement reads from a new queue with the events that can still be taken
+        salvaged = self.context.Queue()
+        try:
+            while True:
+                salvaged.put(events.get_nowait())
+        except queue.Empty:
+            pass
+        return salvaged
+
+    def stop(self):
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        print("Draining workers...")
+        stoppers = [threading.Thread(target=self._stop_worker, args=(process, events)) for process, events in zip(self.workers, self.queues)]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
+
+    def start(self):
+        for index in range(self.processes):
+            self.queues[index] = self.context.Queue()
+            self._start_worker(index)
+        threading.Thread(target=self._monitor, daemon=True, name="supervisor_monitor").start()
+
+        app = App(token=self.args.slack_bot_token, token_verification_enabled=not self.args.fast_boot)
+
+        # This gets activated when the bot is tagged in a channel
+        @app.event("app_mention")
+        def handle_message_events(body, logger):
+            self.route("app_mention", body)
+
+        @app.action("top_k_callback")
+        def handle_top_k_callback(ack, body, logger):
+            ack()
+            self.route("top_k_callback", body)
+
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=self.rolling_restart, daemon=True).start())
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        try:
+            SocketModeHandler(app, self.args.slack_app_token).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
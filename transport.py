@@ -0,0 +1,144 @@
+import inspect
+import threading
+
+import aiohttp
+import requests
+import openai
+import openai.api_requestor
+from requests.adapters import HTTPAdapter
+from slack.web import WebClient
+
+
+class HttpTransport():
+    """
+    Keep-alive connection pools shared by the Slack and OpenAI clients
+    """
+
+    def __init__(self, pool_connections : int = 10, pool_maxsize : int = 20, timeout : tuple = (5, 120)):
+        self.timeout = timeout # (connect, read) seconds
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize) # pool_maxsize connections kept per host
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def use_for_openai(self):
+        # openai creates one session per thread with this private function, hand out the shared one instead
+        make_session = getattr(openai.api_requestor, "_make_session", None)
+        if not callable(make_session) or len(inspect.signature(make_session).parameters) > 0:
+            print(f"Unsupported openai version {openai.version.VERSION}, OpenAI requests use its default sessions.")
+            return False
+        openai.api_requestor._make_session = lambda: self.session
+        return True
+
+    def stats(self):
+        """
+        Requests and connections opened per host, a connection serving several requests was reused
+        """
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            host = stats.setdefault(pool.host, {"requests": 0, "connections": 0})
+            host["requests"] += pool.num_requests
+            host["connections"] += pool.num_connections
+        for host in stats.values():
+            host["reuse_rate"] = 1 - host["connections"] / host["requests"] if host["requests"] > 0 else 0.0
+        return stats
+
+
+class AsyncHttpTransport():
+    """
+    HttpTransport for the event loop, one aiohttp session with a pooled connector
+    """
+
+    def __init__(self, limit : int = 100, limit_per_host : int = 20, keepalive_timeout : float = 60, timeout : float = 120):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.session = None # Created on the running event loop
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def _count(self, host, name):
+        with self.lock:
+            host_counts = self.counts.setdefault(host, {"requests": 0, "connections": 0})
+            host_counts[name] += 1
+
+    async def _on_request_start(self, session, context, params):
+        self._count(params.url.host, "requests")
+
+    async def _on_connection_create_end(self, session, context, params):
+        context.new_connection = True
+
+    async def _on_request_end(self, session, context, params):
+        if getattr(context, "new_connection", False):
+            self._count(params.url.host, "connections")
+
+    def get_session(self):
+        if self.session is None:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create_end)
+            trace_config.on_request_end.append(self._on_request_end)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace_config])
+        return self.session
+
+    def use_for_openai(self):
+        # The context variable is copied into every task created afterwards from the current one
+        openai.aiosession.set(self.get_session())
+
+    def stats(self):
+        with self.lock:
+            stats = {host: dict(counts) for host, counts in self.counts.items()}
+        for host in stats.values():
+            host["reuse_rate"] = 1 - host["connections"] / host["requests"] if host["requests"] > 0 else 0.0
+        return stats
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class PooledWebClient(WebClient):
+    """
+    Slack WebClient sending its requests through an HttpTransport instead of a new urllib connection per call
+    """
+
+    def __init__(self, token : str, transport : HttpTransport, **kwargs):
+        super().__init__(token, **kwargs)
+        self.transport = transport
+        # The client sends every request through this private method, only replace it if it has the expected signature
+        perform = getattr(WebClient, "_perform_urllib_http_request", None)
+        self.pooled = callable(perform) and list(inspect.signature(perform).parameters) == ["self", "url", "args"]
+        if self.pooled:
+            self._perform_urllib_http_request = self._perform_pooled_http_request
+        else:
+            print("Unsupported slack WebClient version, Slack requests use its default urllib transport.")
+
+    def _perform_pooled_http_request(self, *, url, args):
+        # Same contract as the urllib implementation: returns {status, headers, body}
+        headers = dict(args["headers"])
+        request = {}
+        if args["json"]:
+            request["json"] = args["json"]
+        elif args["data"]:
+            headers.pop("Content-Type", None) # Multipart boundary set by requests
+            data = args["data"]
+            files = {key: (data.get("filename", getattr(value, "name", "Uploaded file")), value) for key, value in data.items() if getattr(value, "readable", None) and value.readable()}
+            request["data"] = {key: value for key, value in data.items() if key not in files}
+            request["files"] = files
+        elif args["params"]:
+            headers["Content-Type"] = "application/x-www-form-urlencoded" # The JSON type of the default headers does not match the body
+            request["data"] = args["params"]
+
+        response = self.transport.session.post(url, headers=headers, timeout=(self.transport.timeout[0], self.timeout), proxies={"http": self.proxy, "https": self.proxy} if self.proxy else None, **request)
+        body = response.content if response.headers.get("Content-Type", "").startswith("application/gzip") else response.text
+        response_headers = dict(response.headers)
+        if response.status_code == 429 and "Retry-After" in response.headers:
+            # The client copies the headers into a plain dict, keep the spelling its callers and the urllib implementation use
+            response_headers["Retry-After"] = response.headers["Retry-After"]
+        return {"status": response.status_code, "headers": response_headers, "body": body}